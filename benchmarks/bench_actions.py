@@ -0,0 +1,116 @@
+"""
+Measures the throughput of GmailActionsHandler against a local http stub of the gmail batch and
+batchModify endpoints, in messages modified per second
+    batch        -> label actions sent as multipart batches of modify requests
+    batch_modify -> label actions coalesced into batchModify calls
+The stub answers every request after --latency seconds, so the numbers reflect the client side cost
+and its concurrency, not gmail's
+
+    PYTHONPATH=.:mailer python benchmarks/bench_actions.py --sizes 1000 10000 --output actions.json
+"""
+import re
+import sys
+import time
+import argparse
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from harness import write_results
+from mailer.actions.actions_handler import GmailActionsHandler
+from mailer.rules.rules_model import Action
+
+logging.basicConfig(level=logging.WARNING)
+for name in ('mailer.actions_handler', 'utils.api_request'):
+    logging.getLogger(name).setLevel(logging.WARNING)
+
+CONTENT_ID_PATTERN = re.compile(rb'Content-ID: <([^>]+)>')
+
+
+class GmailStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.read_body()
+        time.sleep(self.latency)
+        if self.path.endswith('/batchModify'):
+            return self.respond(204, 'application/json', b'')
+        parts = b''.join(
+            b'--stub_boundary\r\nContent-Type: application/http\r\nContent-ID: <response-' + content_id + b'>\r\n\r\n'
+            b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n{"id": "' + content_id + b'"}\r\n'
+            for content_id in CONTENT_ID_PATTERN.findall(body)
+        )
+        self.respond(200, 'multipart/mixed; boundary=stub_boundary', parts + b'--stub_boundary--\r\n')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(latency):
+    GmailStubHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), GmailStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark action dispatch")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000], help="messages the actions apply to")
+    parser.add_argument('--workers', type=int, default=4, help="requests sent concurrently")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds the stub takes to answer a request")
+    parser.add_argument('--output', help="json file the results are written to")
+    args = parser.parse_args(sys.argv[1:])
+
+    server = start_stub(args.latency)
+    url = f"http://127.0.0.1:{server.server_port}"
+    actions = [Action(attribute='message', name='mark', value='read'), Action(attribute='message', name='move', value='inbox')]
+
+    results = []
+    for count in args.sizes:
+        message_ids = [f"bench{idx:08d}" for idx in range(count)]
+        for case, use_batch_modify in (('batch', False), ('batch_modify', True)):
+            handler = GmailActionsHandler(
+                None, None, max_workers=args.workers, batch_url=f"{url}/batch/gmail/v1",
+                api_url=f"{url}/gmail/v1", use_batch_modify=use_batch_modify
+            )
+            started_at = time.perf_counter()
+            outcomes = handler.dispatch_actions(actions, message_ids, 'token')
+            elapsed = time.perf_counter() - started_at
+            succeeded = sum(
+                1 for action_outcomes in outcomes for status in action_outcomes.values() if status and 200 <= status < 300
+            )
+            results.append({
+                'name': f"{case}-{count}",
+                'case': case,
+                'messages': count,
+                'modifications_succeeded': succeeded,
+                'seconds': round(elapsed, 3),
+                'messages_per_second': round(count / elapsed, 1) if elapsed else None,
+            })
+
+    server.shutdown()
+    write_results(args.output, 'actions', vars(args), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Compares the orm and copy bulk loaders of GmailMessageProcessor on synthetic mailboxes, timing only
+the user message and header rows written by the loader
+Every run happens in a transaction which is rolled back, so the database is left untouched
+
+    PYTHONPATH=.:mailer python benchmarks/bench_bulk_loader.py --sizes 10000 100000 --output bulk_loader.json
+"""
+import sys
+import time
+import argparse
+import logging
+
+from harness import rolled_back, summarize, write_results
+from mailer.ingestion.email_message_processor import GmailMessageProcessor
+from mailer.replay.synthetic_mailbox import SyntheticMailbox
+
+logging.basicConfig(level=logging.WARNING)
+logging.getLogger('mailer.gmail_message_processor').setLevel(logging.WARNING)
+
+USER_EMAIL = 'bench@example.com'
+
+
+def bench_loader(messages, loader, batch_size):
+    processor = GmailMessageProcessor(bulk_loader=loader)
+    elapsed = 0
+    with rolled_back():
+        processor.register_recipient(USER_EMAIL)
+        for start in range(0, len(messages), batch_size):
+            batch = messages[start:start + batch_size]
+            sender_pks = processor.create_senders(batch)
+            message_pks, _ = processor.create_messages(batch)
+            started_at = time.perf_counter()
+            processor.create_user_messages(message_pks, sender_pks, batch)
+            processor.create_message_headers(message_pks, batch)
+            elapsed += time.perf_counter() - started_at
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the orm and copy bulk loaders")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000], help="messages per mailbox")
+    parser.add_argument('--loaders', nargs='+', choices=['orm', 'copy'], default=['orm', 'copy'])
+    parser.add_argument('--batch-size', type=int, default=1000, help="messages written per call of the loader")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="json file the results are written to")
+    args = parser.parse_args(sys.argv[1:])
+
+    results = []
+    for count in args.sizes:
+        # Replies would be dropped by the unique thread id of messages
+        _, messages = SyntheticMailbox(USER_EMAIL, count, reply_rate=0, seed=args.seed).generate()
+        header_rows = sum(len(message['payload']['headers']) for message in messages)
+        for loader in args.loaders:
+            timings = summarize([bench_loader(messages, loader, args.batch_size) for _ in range(args.repeat)])
+            results.append({
+                'name': f"{loader}-{count}",
+                'loader': loader,
+                'messages': count,
+                'header_rows': header_rows,
+                **timings,
+                'messages_per_second': round(count / timings['median_seconds'], 1) if timings['median_seconds'] else None,
+            })
+
+    write_results(args.output, 'bulk_loader', vars(args), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Measures ingestion throughput on synthetic mailboxes
+    process  -> messages per second written by GmailMessageProcessor.process_messages
+    pipeline -> messages per second of a full sync served by the replay gmail service, fetching
+                and persisting included
+Every run happens in a transaction which is rolled back, so the database is left untouched
+
+    PYTHONPATH=.:mailer python benchmarks/bench_ingestion.py --sizes 1000 10000 --output ingestion.json
+"""
+import sys
+import time
+import datetime
+import argparse
+import logging
+
+from harness import rolled_back, write_results
+from mailer.ingestion.email_fetcher import GmailFetcher, PipelinedGmailFetcher, IngestionInterval, IngestionFilters
+from mailer.ingestion.email_message_processor import GmailMessageProcessor
+from mailer.ingestion.sync import full_sync
+from mailer.replay.replay_service import ReplayGmailService
+from mailer.replay.synthetic_mailbox import SyntheticMailbox
+
+logging.basicConfig(level=logging.WARNING)
+for name in ('mailer.gmail_message_processor', 'mailer.ingestion', 'mailer.google_auth'):
+    logging.getLogger(name).setLevel(logging.WARNING)
+
+USER_EMAIL = 'bench@example.com'
+
+
+def bench_process(messages, loader, batch_size):
+    processor = GmailMessageProcessor(bulk_loader=loader)
+    with rolled_back():
+        processor.register_recipient(USER_EMAIL)
+        started_at = time.perf_counter()
+        for start in range(0, len(messages), batch_size):
+            processor.process_messages(messages[start:start + batch_size])
+        elapsed = time.perf_counter() - started_at
+    return processor.processed_count, elapsed
+
+
+def bench_pipeline(mailbox, messages, loader, workers, latency):
+    gmail_service = ReplayGmailService(mailbox, messages, latency=latency)
+    # The interval of the messages, ending tomorrow so messages received today are listed
+    ingestion_interval = IngestionInterval(
+        start_date=(datetime.datetime.now() - datetime.timedelta(days=2)).date(),
+        end_date=(datetime.datetime.now() + datetime.timedelta(days=1)).date(),
+    )
+    # Quota is not what is measured
+    ingestion_filters = IngestionFilters(quota_units_per_second=10 ** 9, batch_size=100)
+    if workers > 1:
+        ingestion = PipelinedGmailFetcher(
+            gmail_service, USER_EMAIL, ingestion_interval, ingestion_filters, max_workers=workers
+        )
+    else:
+        ingestion = GmailFetcher(gmail_service, USER_EMAIL, ingestion_interval, ingestion_filters)
+
+    processor = GmailMessageProcessor(bulk_loader=loader)
+    with rolled_back():
+        recipient = processor.register_recipient(USER_EMAIL)
+        processor.create_labels(recipient, ingestion.fetch_labels())
+        started_at = time.perf_counter()
+        full_sync(ingestion, processor)
+        elapsed = time.perf_counter() - started_at
+    return processor.processed_count, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark message ingestion")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000], help="messages per mailbox")
+    parser.add_argument('--loaders', nargs='+', choices=['orm', 'copy'], default=['orm', 'copy'])
+    parser.add_argument('--batch-size', type=int, default=100, help="messages per process_messages call")
+    parser.add_argument('--workers', type=int, default=4, help="fetch workers of the pipeline benchmark")
+    parser.add_argument('--latency', type=float, default=0, help="seconds every replayed gmail request takes")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="json file the results are written to")
+    args = parser.parse_args(sys.argv[1:])
+
+    results = []
+    for count in args.sizes:
+        # Replies would be dropped by the unique thread id of messages
+        mailbox, messages = SyntheticMailbox(USER_EMAIL, count, reply_rate=0, seed=args.seed).generate()
+        header_rows = sum(len(message['payload']['headers']) for message in messages)
+        for loader in args.loaders:
+            for case, run in (
+                ('process', lambda: bench_process(messages, loader, args.batch_size)),
+                ('pipeline', lambda: bench_pipeline(mailbox, messages, loader, args.workers, args.latency)),
+            ):
+                processed, elapsed = run()
+                results.append({
+                    'name': f"{case}-{loader}-{count}",
+                    'case': case,
+                    'loader': loader,
+                    'messages': processed,
+                    'header_rows': header_rows,
+                    'seconds': round(elapsed, 3),
+                    'messages_per_second': round(processed / elapsed, 1) if elapsed else None,
+                })
+
+    write_results(args.output, 'ingestion', vars(args), results)
+
+
+if __name__ == '__main__':
+    main()
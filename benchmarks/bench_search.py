@@ -0,0 +1,91 @@
+"""
+Measures the latency of EmailSearch.fetch on synthetic mailboxes of a given number of header rows,
+for every rules file of benchmarks/rules or the given ones
+Mailboxes are loaded with the copy loader in a transaction which is rolled back, so the database is
+left untouched, rows already in the database are searched along with them and counted in header_rows
+
+    PYTHONPATH=.:mailer python benchmarks/bench_search.py --header-rows 10000 100000 1000000 --output search.json
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+import logging
+
+from django.db import connection
+from harness import rolled_back, measure, write_results
+from mailer.ingestion.email_message_processor import GmailMessageProcessor
+from mailer.replay.synthetic_mailbox import SyntheticMailbox
+from mailer.rules.rules_fetch import RulesFetch
+from mailer.search.email_search import EmailSearch
+
+logging.basicConfig(level=logging.WARNING)
+for name in ('mailer.gmail_message_processor', 'mailer.email_search', 'mailer.rules'):
+    logging.getLogger(name).setLevel(logging.WARNING)
+
+USER_EMAIL = 'bench@example.com'
+RULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules')
+
+
+def load_mailbox(header_rows, seed, batch_size=1000):
+    # Synthetic messages carry 17 headers on average
+    count = max(1, header_rows // 17)
+    _, messages = SyntheticMailbox(USER_EMAIL, count, days=30, reply_rate=0, seed=seed).generate()
+    processor = GmailMessageProcessor(bulk_loader='copy')
+    processor.register_recipient(USER_EMAIL)
+    started_at = time.perf_counter()
+    for start in range(0, len(messages), batch_size):
+        processor.process_messages(messages[start:start + batch_size])
+    load_seconds = time.perf_counter() - started_at
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+        cursor.execute("SELECT count(*) FROM db_messageheadervalues")
+        loaded_rows = cursor.fetchone()[0]
+    return len(messages), loaded_rows, load_seconds
+
+
+def search(rule_set):
+    try:
+        return len(EmailSearch.fetch('message', rule_set))
+    except Exception:
+        # fetch raises when no message matches
+        return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark rule searches")
+    parser.add_argument('--header-rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--rules', nargs='+', help="rules files, defaults to benchmarks/rules/*.json")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="json file the results are written to")
+    args = parser.parse_args(sys.argv[1:])
+
+    rule_files = args.rules or sorted(glob.glob(os.path.join(RULES_DIR, '*.json')))
+    rule_sets = {
+        os.path.splitext(os.path.basename(path))[0]: RulesFetch.read_rules_from_file(path).construct_rules()[0]
+        for path in rule_files
+    }
+
+    results = []
+    for header_rows in args.header_rows:
+        with rolled_back():
+            messages, loaded_rows, load_seconds = load_mailbox(header_rows, args.seed)
+            for rules_name, rule_set in rule_sets.items():
+                matches = search(rule_set)
+                results.append({
+                    'name': f"{rules_name}-{header_rows}",
+                    'rules': rules_name,
+                    'messages': messages,
+                    'header_rows': loaded_rows,
+                    'load_seconds': round(load_seconds, 3),
+                    'matches': matches,
+                    **measure(lambda: search(rule_set), repeat=args.repeat),
+                })
+
+    write_results(args.output, 'search', vars(args), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Regression check of the startup cost of the entry points, run with python -X importtime
+Fails when a command imports a module it should only import on first use, like django for --help,
+or when its imports take longer than their budget. Imports done by the interpreter itself are not
+counted
+
+    python benchmarks/check_importtime.py --budget-scale 2
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RULES_FILE = os.path.join(ROOT, 'benchmarks', 'rules', 'sender_subject.json')
+# Packages loaded by the db, the gmail clients and the rules models
+HEAVY_PACKAGES = ('django', 'googleapiclient', 'google_auth_oauthlib', 'httplib2', 'requests', 'pydantic', 'psycopg2')
+
+# name, arguments of the command, budget in milliseconds, packages it must not import
+CHECKS = [
+    ('action --help', ['mailer/action.py', '--help'], 50, HEAVY_PACKAGES),
+    ('populate --help', ['mailer/populate.py', '--help'], 50, HEAVY_PACKAGES),
+    ('schedule --help', ['mailer/schedule.py', '--help'], 50, HEAVY_PACKAGES),
+    ('daemon --help', ['mailer/daemon.py', '--help'], 50, HEAVY_PACKAGES),
+    (
+        'action --validate-rules',
+        ['mailer/action.py', 'file', RULES_FILE, '--validate-rules'],
+        300,
+        ('django', 'googleapiclient', 'google_auth_oauthlib', 'httplib2', 'requests', 'psycopg2'),
+    ),
+]
+
+
+"""
+Runs a command with -X importtime and reads the imports it reports
+Arguments:
+    args -> (list) -> arguments of the python command
+Returns:
+    imports -> (list of tuple) -> module name, cumulative microseconds and whether it is a top level import
+"""
+def import_times(args):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.path.join(ROOT, 'mailer')]))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', *args], cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        imports.append((name.strip(), int(cumulative), not name[1:].startswith(' ')))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of the entry points")
+    parser.add_argument('--budget-scale', type=float, default=1.0, help="multiplier of the budgets, for slower machines")
+    args = parser.parse_args(sys.argv[1:])
+
+    interpreter_modules = {name for name, _, _ in import_times(['-c', 'pass'])}
+    failures = 0
+    for name, command, budget_ms, forbidden in CHECKS:
+        imports = [entry for entry in import_times(command) if entry[0] not in interpreter_modules]
+        total_ms = sum(cumulative for _, cumulative, top_level in imports if top_level) / 1000
+        imported_forbidden = sorted({
+            module.split('.')[0] for module, _, _ in imports if module.split('.')[0] in forbidden
+        })
+        budget = budget_ms * args.budget_scale
+        problems = []
+        if total_ms > budget:
+            problems.append(f"imports took {total_ms:.0f}ms, over the {budget:.0f}ms budget")
+        if imported_forbidden:
+            problems.append(f"imported {', '.join(imported_forbidden)}")
+        failures += bool(problems)
+        print(f"{'FAIL' if problems else 'ok':<5} {name:<26} {total_ms:>7.1f}ms {'; '.join(problems)}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Compares two result files of a benchmark, matching results by name, and prints the ratio of every
+metric of the candidate to the baseline
+
+    python benchmarks/compare.py baseline.json candidate.json
+"""
+import sys
+import json
+import argparse
+
+# Metrics where a lower value is better, every other metric is a throughput
+LOWER_IS_BETTER = ('seconds', 'min_seconds', 'median_seconds', 'mean_seconds', 'load_seconds')
+METRICS = ('messages_per_second', 'seconds', 'min_seconds', 'median_seconds')
+
+
+def load_report(path):
+    with open(path) as report_file:
+        report = json.load(report_file)
+    return report, {result['name']: result for result in report['results']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument('baseline', help="result file of the baseline commit")
+    parser.add_argument('candidate', help="result file of the candidate commit")
+    parser.add_argument('--threshold', type=float, default=0.1, help="relative change reported as a regression")
+    args = parser.parse_args(sys.argv[1:])
+
+    baseline, baseline_results = load_report(args.baseline)
+    candidate, candidate_results = load_report(args.candidate)
+    if baseline['benchmark'] != candidate['benchmark']:
+        parser.error(f"Cannot compare {baseline['benchmark']} results to {candidate['benchmark']} results")
+
+    print(f"{baseline['benchmark']}: {baseline['commit']} -> {candidate['commit']}")
+    regressions = 0
+    for name, result in candidate_results.items():
+        base = baseline_results.get(name)
+        if not base:
+            print(f"{name:<40} only in candidate")
+            continue
+        for metric in METRICS:
+            if not result.get(metric) or not base.get(metric):
+                continue
+            ratio = result[metric] / base[metric]
+            # Speedup above 1 is always an improvement, whichever way the metric goes
+            speedup = 1 / ratio if metric in LOWER_IS_BETTER else ratio
+            flag = ''
+            if speedup < 1 - args.threshold:
+                flag = ' REGRESSION'
+                regressions += 1
+            print(f"{name:<40} {metric:<20} {base[metric]:>12} -> {result[metric]:>12} ({speedup:.2f}x){flag}")
+    for name in baseline_results.keys() - candidate_results.keys():
+        print(f"{name:<40} only in baseline")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Helpers shared by the benchmarks: timing, rolled back db runs and the json result files compared
+across commits with compare.py
+"""
+import os
+import sys
+import json
+import time
+import platform
+import datetime
+import statistics
+import subprocess
+from contextlib import contextmanager
+
+
+class Rollback(Exception):
+    pass
+
+
+"""
+Runs the block in a transaction which is rolled back, so the database is left untouched
+"""
+@contextmanager
+def rolled_back():
+    from django.db import transaction
+    try:
+        with transaction.atomic():
+            yield
+            raise Rollback()
+    except Rollback:
+        pass
+
+
+"""
+Times a function over several runs
+Arguments:
+    func   -> (callable) -> function to time, called without arguments
+    repeat -> (int) -> number of timed runs
+    warmup -> (int) -> untimed runs before the timed ones
+Returns:
+    timings -> (dict) -> min, median and mean seconds of the runs
+"""
+def measure(func, repeat=5, warmup=1):
+    for _ in range(warmup):
+        func()
+    runs = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - started_at)
+    return summarize(runs)
+
+
+"""
+Summarizes the seconds of runs timed by the caller, for benchmarks timing only part of a run
+Arguments:
+    runs -> (list of float) -> seconds of every run
+Returns:
+    timings -> (dict) -> min, median and mean seconds of the runs
+"""
+def summarize(runs):
+    return {
+        'min_seconds': round(min(runs), 6),
+        'median_seconds': round(statistics.median(runs), 6),
+        'mean_seconds': round(statistics.mean(runs), 6),
+        'runs': len(runs),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+"""
+Prints the results and writes them with the commit and environment they were measured on
+Arguments:
+    path       -> (str)  -> json file to write, None to only print
+    benchmark  -> (str)  -> name of the benchmark
+    parameters -> (dict) -> arguments of the run
+    results    -> (list of dict) -> one entry per measured case, identified by its name
+Returns:
+    None
+"""
+def write_results(path, benchmark, parameters, results):
+    for result in results:
+        print(json.dumps(result))
+    if not path:
+        return
+    report = {
+        'benchmark': benchmark,
+        'commit': git_commit(),
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'results': results,
+    }
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    print(f"Wrote results to {path}")
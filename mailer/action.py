@@ -1,12 +1,15 @@
 
 import sys
 import os
+import argparse
 import logging
+from contextlib import nullcontext
 
-from mailer.rules.rules_fetch import RulesFetch
-from mailer.actions.actions_handler import GmailActionsHandler
-from mailer.search.email_search import EmailSearch
+from mailer.utils.metrics import metrics
+from mailer.rules.rules_cache import RulesCache, DEFAULT_CACHE_DIR
 
+# Rules, django and the api clients are imported where they are first used, so --help and
+# --validate-rules do not pay for them
 logger = logging.getLogger("mailer.action")
 logging.basicConfig(level=logging.INFO)
 
@@ -14,37 +17,112 @@ def is_json_file(filepath):
     _, extension = os.path.splitext(filepath)
     return extension.lower() == '.json'
 
-def initialize(args):
-    args = sys.argv[1:]
-    rule_config_type, rule_config_value, access_token = args
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Apply rule actions to the messages in db matching the rules")
+    parser.add_argument('rule_config_type', help="file")
+    parser.add_argument('rule_config_value', help="filepath to rules json")
+    parser.add_argument('access_token', nargs='?', help="access token for the gmail api, not needed with --validate-rules")
+    parser.add_argument('--validate-rules', action='store_true', help="only validate the rules file, without connecting to db or gmail api")
+    parser.add_argument('--rules-cache', default=DEFAULT_CACHE_DIR, help="directory the validated rules and compiled rules query are cached in, keyed by the hash of the rules file, empty to disable")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="dispatch actions for chunks of matching messages as they are read from db")
+    parser.add_argument('--metrics-file', help="file the run's metrics are written to, json if it ends with .json and prometheus text otherwise")
+    parser.add_argument('--profile-sql', action='store_true', help="capture the sql statements of the run and explain the rules query before applying actions")
+    parser.add_argument('--profile-report', help="with --profile-sql, json file the statements and query plans are written to")
+    return parser.parse_args(args)
 
-    if not access_token:
-        raise Exception("Missing access token")
-    
+def load_rules(args, cache=None):
+    from mailer.rules.rules_fetch import RulesFetch
+
+    rule_config_type, rule_config_value = args.rule_config_type, args.rule_config_value
     allowed_rule_config_types = ['file']
     if rule_config_type not in allowed_rule_config_types or not is_json_file(rule_config_value):
         raise Exception(f"Invalid config type {rule_config_type}, allowed types: {allowed_rule_config_types}")
-    
 
     rules_fetcher = None
     if rule_config_type == 'file':
-        rules_fetcher = RulesFetch.read_rules_from_file(rule_config_value)
+        rules_fetcher = RulesFetch.read_rules_from_file(rule_config_value, cache)
 
-    resource_fetcher = EmailSearch()
-    
     if not rules_fetcher:
         raise Exception("Error initializing rules fetcher service")
-    
+
+    return rules_fetcher
+
+def validate_rules(args):
+    from mailer.rules.rules_model import iter_conditions
+
+    try:
+        rule_set, actions = load_rules(args).construct_rules()
+    except Exception as err:
+        logger.error(f"Invalid rules file {args.rule_config_value}: {err}")
+        return 1
+    conditions = list(iter_conditions(rule_set.rules))
+    logger.info(
+        f"Rules file {args.rule_config_value} is valid: {len(conditions)} conditions in {len(rule_set.rules)} rules, "
+        f"{len(actions)} actions"
+    )
+    return 0
+
+def initialize(args):
+    from mailer.search.email_search import EmailSearch
+
+    access_token = args.access_token
+    if not access_token:
+        raise Exception("Missing access token")
+
+    cache = RulesCache(args.rules_cache) if args.rules_cache else None
+    rules_fetcher = load_rules(args, cache)
+    resource_fetcher = EmailSearch()
+
     return resource_fetcher, rules_fetcher, access_token
 
-def main():
+def apply_actions(args, profiler=None):
+    from mailer.actions.actions_handler import GmailActionsHandler
 
-    resource_fetcher, rules_fetcher, access_token = initialize(sys.argv[1])
+    resource_fetcher, rules_fetcher, access_token = initialize(args)
     handler = GmailActionsHandler(
         resource_fetcher,
         rules_fetcher
     )
-    handler.actions_handler(access_token, 'message')
+    # Compiled and cached before any action is applied, so the next run reuses the query even if this one fails
+    rule_set, _ = rules_fetcher.construct_rules()
+    resource_fetcher.compile_rules(rule_set)
+    rules_fetcher.save_compiled()
+    if profiler:
+        # Explained before any action is applied, so a slow rules file shows up first
+        profiler.explain_queryset('rules query', resource_fetcher.compiled_query(rule_set))
+    if args.use_async:
+        import asyncio
+        outcomes = asyncio.run(handler.actions_handler_async(access_token, 'message'))
+    else:
+        outcomes = handler.actions_handler(access_token, 'message')
+    for action_outcomes in outcomes:
+        succeeded = sum(1 for status in action_outcomes.values() if status and 200 <= status < 300)
+        logger.info(f"Action applied to {succeeded} of {len(action_outcomes)} messages")
     logger.info("Successfully dispatched actions for messages based on rules")
 
+def main():
+
+    args = parse_args(sys.argv[1:])
+    if args.validate_rules:
+        sys.exit(validate_rules(args))
+
+    profiler = None
+    if args.profile_sql:
+        from mailer.utils.sql_profiler import SQLProfiler
+        profiler = SQLProfiler()
+    try:
+        with profiler.profile() if profiler else nullcontext():
+            apply_actions(args, profiler)
+    finally:
+        if profiler:
+            # Explaining runs more queries, which fail too when the run failed on the db, its error is the one raised
+            try:
+                profiler.explain_captured()
+            except Exception:
+                logger.exception("Failed to explain the captured statements")
+            profiler.log_report(args.profile_report)
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+            logger.info(f"Wrote metrics to {args.metrics_file}")
+
 main()
\ No newline at end of file
@@ -1,49 +1,198 @@
 
 
-import json
+import time
+import random
+import asyncio
 import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from mailer.utils.api_requests import APIRequest
+from mailer.utils.multipart import MultipartBatchBody, iter_batch_response
+from mailer.utils.metrics import metrics, SIZE_BUCKETS
 from requests.exceptions import HTTPError
 
 logger = logging.getLogger('mailer.actions_handler')
 
+# Gmail accepts at most 100 requests in a batch and 1000 ids in a batchModify
+BATCH_REQUEST_LIMIT = 100
+BATCH_MODIFY_LIMIT = 1000
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ActionPlanner:
+    """
+    Merges the actions applied to messages into a single label delta per message, and groups the
+    messages sharing the same delta so each group is modified with batchModify calls
+    Arguments:
+        None
+    Returns:
+        None
+    """
+    # Labels added and removed by an action, keyed by attribute, name and value
+    action_label_deltas = {
+        ('message', 'move', 'inbox'): ({'INBOX'}, set()),
+        ('message', 'mark', 'read'): (set(), {'UNREAD'}),
+        ('message', 'mark', 'unread'): ({'UNREAD'}, set()),
+    }
+
+    def __init__(self):
+        self.message_deltas = {}
+
+    """
+    Applies actions to messages, a later action overrides an earlier one touching the same label
+    Arguments:
+        actions     -> (list of Action) -> The actions read from rules file
+        message_ids -> (list) -> Google message ids the actions apply to
+    Returns:
+        None
+    """
+    def add(self, actions, message_ids):
+        add_labels, remove_labels = set(), set()
+        for action in actions:
+            added, removed = self.action_label_deltas[(action.attribute, action.name, action.value)]
+            add_labels = (add_labels - removed) | added
+            remove_labels = (remove_labels - added) | removed
+
+        for message_id in message_ids:
+            message_add, message_remove = self.message_deltas.get(message_id, (set(), set()))
+            self.message_deltas[message_id] = (
+                (message_add - remove_labels) | add_labels,
+                (message_remove - add_labels) | remove_labels
+            )
+
+    """
+    Groups messages by their label delta
+    Arguments:
+        None
+    Returns:
+        plan -> (list of tuple) -> (labels to add, labels to remove, google message ids) per group
+    """
+    def plan(self):
+        groups = {}
+        for message_id, (add_labels, remove_labels) in self.message_deltas.items():
+            if add_labels or remove_labels:
+                groups.setdefault((tuple(sorted(add_labels)), tuple(sorted(remove_labels))), []).append(message_id)
+        return [(add_labels, remove_labels, message_ids) for (add_labels, remove_labels), message_ids in groups.items()]
+
+
 class GmailActionsHandler:
     """
     Initialize gmail fetcher using service object
     Arguments:
         resource_fetcher ->  (EmailSearch) -> ResourceFetcher object like email_search instance
         rules_fetcher    ->  (RuleFetch)   -> RuleFetcher object like rule_fetch instance
+        max_workers      ->  (int)         -> Batch requests sent concurrently
+        max_retries      ->  (int)         -> Retries of the requests of a batch failing with a retryable status
+        batch_url        ->  (str)         -> Gmail batch endpoint
+        api_url          ->  (str)         -> Gmail api endpoint
+        use_batch_modify ->  (bool)        -> Coalesce the actions into batchModify calls instead of a
+                                              modify request per message and action
     Returns: 
         None
     """
-    def __init__(self, resource_fetcher, rules_fetcher):
+    def __init__(self, resource_fetcher, rules_fetcher, max_workers=4, max_retries=3,
+                 batch_url='https://www.googleapis.com/batch/gmail/v1',
+                 api_url='https://gmail.googleapis.com/gmail/v1', use_batch_modify=True):
         self.resource_fetcher = resource_fetcher
         self.rules_fetcher = rules_fetcher
-        self.api_requests = APIRequest('https://www.googleapis.com/batch/gmail/v1')
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.use_batch_modify = use_batch_modify
+        self.api_requests = APIRequest(batch_url, pool_size=max_workers)
+        self.gmail_api_requests = APIRequest(api_url, pool_size=max_workers)
 
     """
     Construct a batch request for sending multiple requests
     Arguments:
-        request_configs -> (list) -> Configs like http endpoint, method, body
+        request_configs -> (list) -> Configs like content id, http endpoint, body
     Returns: 
-        batch_request_body -> (str) -> Batch request body for sending multiple requests
+        batch_request_body -> (MultipartBatchBody) -> Batch request body streamed as bytes chunks
     """
     def construct_batch_request(self, request_configs, boundary='batch_boundary'):
         logger.info(f"Constructing batch request for actions")
-        batch_request_body = ''
-        for idx, config in enumerate(request_configs):
-            endpoint, request_body = config['endpoint'], config['body']
-            batch_request_body += (
-                f'--{boundary}\r\n'
-                f'Content-Type: application/http\r\n'
-                f'Content-ID: <item{idx}>\r\n\r\n'
-                f'POST {endpoint} HTTP/1.1\r\n'
-                f'Content-Type: application/json\r\n\r\n'
-                f'{json.dumps(request_body)}\r\n'
-            )
-        
-        batch_request_body += f'--{boundary}--'
-        return batch_request_body
+        return MultipartBatchBody(request_configs, boundary)
+
+    """
+    Sends a batch of modify requests, retrying only the requests which failed with a retryable status
+    Arguments:
+        message_ids  -> (list) -> Google message ids, at most the batch request limit
+        body         -> (dict) -> Modify request body applied to every message
+        access_token -> (str)  -> Access token for using the endpoint
+    Returns: 
+        outcomes -> (dict) -> Google message id to the status code of its request, None if the batch failed
+    """
+    def send_modify_batch(self, message_ids, body, access_token):
+        outcomes = {}
+        pending = list(message_ids)
+        headers = {
+            "Content-Type": f"multipart/mixed; boundary=batch_boundary",
+            "Authorization": f"Bearer {access_token}"
+        }
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(random.uniform(0, 2 ** attempt))
+            # Content ids map the parts of the response back to the message ids
+            request_configs = [
+                {
+                    'content_id': message_id,
+                    'endpoint': f'/gmail/v1/users/me/messages/{message_id}/modify',
+                    'body': body
+                }
+                for message_id in pending
+            ]
+            metrics.observe('gmail_batch_size', len(pending), buckets=SIZE_BUCKETS, method='messages.modify')
+            try:
+                with metrics.timer('gmail_api_request_seconds', method='messages.modify'):
+                    res = self.api_requests.post(
+                        headers=headers, data=self.construct_batch_request(request_configs), stream=True
+                    )
+            except HTTPError as err:
+                logger.error(err)
+                outcomes.update({message_id: err.response.status_code if err.response is not None else None for message_id in pending})
+                if err.response is None or err.response.status_code not in RETRYABLE_STATUSES:
+                    break
+                continue
+
+            outcomes.update({message_id: None for message_id in pending})
+            with res:
+                for content_id, status, _ in iter_batch_response(res):
+                    if content_id in outcomes:
+                        outcomes[content_id] = status
+            pending = [message_id for message_id in pending if outcomes[message_id] in RETRYABLE_STATUSES]
+            if not pending:
+                break
+            metrics.increment('gmail_retries_total', len(pending), method='messages.modify')
+            logger.warning(f"Retrying {len(pending)} rate limited or failed requests of the batch")
+        return outcomes
+
+    """
+    Modifies the labels of messages in chunks of the batch request limit, sent concurrently
+    Arguments:
+        message_ids      -> (list) -> Google message ids
+        access_token     -> (str)  -> Access token for using the endpoint
+        add_label_ids    -> (list) -> Labels to add
+        remove_label_ids -> (list) -> Labels to remove
+    Returns: 
+        outcomes -> (dict) -> Google message id to the status code of its request
+    """
+    def modify_labels(self, message_ids, access_token, add_label_ids=None, remove_label_ids=None):
+        body = {}
+        if add_label_ids:
+            body['addLabelIds'] = list(add_label_ids)
+        if remove_label_ids:
+            body['removeLabelIds'] = list(remove_label_ids)
+
+        message_ids = list(dict.fromkeys(message_ids))
+        chunks = [message_ids[idx:idx + BATCH_REQUEST_LIMIT] for idx in range(0, len(message_ids), BATCH_REQUEST_LIMIT)]
+        outcomes = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for chunk_outcomes in pool.map(lambda chunk: self.send_modify_batch(chunk, body, access_token), chunks):
+                outcomes.update(chunk_outcomes)
+
+        failed = [message_id for message_id, status in outcomes.items() if status != 200]
+        if failed:
+            logger.error(f"Failed to modify {len(failed)} of {len(outcomes)} messages: {failed[:10]}")
+        return outcomes
     
     """
     Adds given label to given list of messages
@@ -52,28 +201,12 @@ class GmailActionsHandler:
         message_ids  -> (list) -> Google message ids
         access_token -> (str)  -> Access token for using the endpoint
     Returns: 
-        None
+        outcomes -> (dict) -> Google message id to the status code of its request
     """
     def add_label_to_messages(self, label, message_ids, access_token):
-        request_configs = []
-        for message_id in message_ids:
-            request_configs.append(
-                {
-                    'endpoint': f'/gmail/v1/users/me/messages/{message_id}/modify',
-                    'body': {"addLabelIds": [label]}
-                }
-            )
-        payload = self.construct_batch_request(request_configs)
-        try:
-            headers = {
-                "Content-Type": f"multipart/mixed; boundary=batch_boundary",
-                "Authorization": f"Bearer {access_token}"
-            }
-            res = self.api_requests.post(headers=headers, data=payload)
-            logger.info(f"Added label {label} from messages")
-            logger.debug(res)
-        except HTTPError as err:
-            logger.error(err)
+        outcomes = self.modify_labels(message_ids, access_token, add_label_ids=[label])
+        logger.info(f"Added label {label} to messages")
+        return outcomes
 
     """
     Removes given label to given list of messages
@@ -82,35 +215,93 @@ class GmailActionsHandler:
         message_ids  -> (list) -> Google message ids
         acccess_token -> (str)  -> Access token for using the endpoint
     Returns: 
-        None
+        outcomes -> (dict) -> Google message id to the status code of its request
     """
     def remove_label_from_messages(self, label, message_ids, access_token):
-        request_configs = []
-        for message_id in message_ids:
-            request_configs.append(
-                {
-                    'endpoint': f'/gmail/v1/users/me/messages/{message_id}/modify',
-                    'body': {"removeLabelIds": [label]}
-                }
-            )
-        payload = self.construct_batch_request(request_configs)
-        try:
-            headers = {
-                "Content-Type": f"multipart/mixed; boundary=batch_boundary",
-                "Authorization": f"Bearer {access_token}"
-            }
-            res = self.api_requests.post(headers=headers, data=payload)
-            logger.info(f"Removed label {label} from messages")
-            logger.debug(res)
-        except HTTPError as err:
-            logger.error(err)
+        outcomes = self.modify_labels(message_ids, access_token, remove_label_ids=[label])
+        logger.info(f"Removed label {label} from messages")
+        return outcomes
     
+    """
+    Modifies the labels of messages with batchModify calls of up to 1000 ids, sent concurrently
+    Arguments:
+        message_ids      -> (list) -> Google message ids
+        access_token     -> (str)  -> Access token for using the endpoint
+        add_label_ids    -> (list) -> Labels to add
+        remove_label_ids -> (list) -> Labels to remove
+    Returns: 
+        outcomes -> (dict) -> Google message id to the status code of the call it was part of
+    """
+    def batch_modify_labels(self, message_ids, access_token, add_label_ids=None, remove_label_ids=None):
+        headers = {"Authorization": f"Bearer {access_token}"}
+
+        def send_chunk(chunk):
+            body = {'ids': chunk, 'addLabelIds': list(add_label_ids or []), 'removeLabelIds': list(remove_label_ids or [])}
+            metrics.observe('gmail_batch_size', len(chunk), buckets=SIZE_BUCKETS, method='messages.batchModify')
+            try:
+                with metrics.timer('gmail_api_request_seconds', method='messages.batchModify'):
+                    res = self.gmail_api_requests.post('users/me/messages/batchModify', json=body, headers=headers)
+                status = getattr(res, 'status_code', 200)
+            except HTTPError as err:
+                logger.error(err)
+                status = err.response.status_code if err.response is not None else None
+            return {message_id: status for message_id in chunk}
+
+        message_ids = list(dict.fromkeys(message_ids))
+        chunks = [message_ids[idx:idx + BATCH_MODIFY_LIMIT] for idx in range(0, len(message_ids), BATCH_MODIFY_LIMIT)]
+        outcomes = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for chunk_outcomes in pool.map(send_chunk, chunks):
+                outcomes.update(chunk_outcomes)
+        logger.info(f"Modified labels of {len(message_ids)} messages in {len(chunks)} batchModify calls")
+        return outcomes
+
+    """
+    Merges the actions into one label delta per message and applies each distinct delta with batchModify
+    Arguments:
+        actions      -> (list of Action) -> The actions read from rules file
+        message_ids  -> (list) -> Google message ids
+        access_token -> (str)  -> Access token for using the endpoint
+    Returns: 
+        outcomes -> (list of dict) -> Per label delta, google message id to the status code of its call
+    """
+    def planned_actions_dispatcher(self, actions, message_ids, access_token):
+        planner = ActionPlanner()
+        planner.add(actions, message_ids)
+        outcomes = []
+        for add_label_ids, remove_label_ids, grouped_message_ids in planner.plan():
+            logger.info(f"Dispatching label delta +{list(add_label_ids)} -{list(remove_label_ids)}")
+            outcomes.append(
+                self.batch_modify_labels(grouped_message_ids, access_token, add_label_ids, remove_label_ids)
+            )
+        return outcomes
+
+    """
+    Dispatches actions on messages, coalesced into batchModify calls unless use_batch_modify is off
+    Arguments:
+        actions      -> (list of Action) -> The actions read from rules file
+        message_ids  -> (list) -> Google message ids
+        access_token -> (str)  -> Access token for using the endpoint
+    Returns: 
+        outcomes -> (list of dict) -> Google message id to the status code of its request
+    """
+    def dispatch_actions(self, actions, message_ids, access_token):
+        with metrics.timer('stage_seconds', stage='actions'):
+            if self.use_batch_modify:
+                outcomes = self.planned_actions_dispatcher(actions, message_ids, access_token)
+            else:
+                outcomes = self.actions_dispatcher(actions, message_ids=message_ids, access_token=access_token)
+        statuses = Counter(status or 'failed' for action_outcomes in outcomes for status in action_outcomes.values())
+        for status, count in statuses.items():
+            metrics.increment('actions_messages_total', count, status=status)
+        return outcomes
+
     """
     Based on the actions dispactches the corresponding method to perform the action
     Arguments:
         actions  -> (list of Action)  -> The actions read from rules file
     Returns: 
-        None
+        outcomes -> (list of dict) -> Per action, google message id to the status code of its request
     """
     def actions_dispatcher(self, actions, **kwargs):
         attribute_action_map = {
@@ -134,10 +325,12 @@ class GmailActionsHandler:
             }
         }
 
+        outcomes = []
         for action in actions:
             func, params = attribute_action_map[action.attribute][action.name][action.value]
             logger.info(f"Disptching action for {action.name}")
-            func(**params)
+            outcomes.append(func(**params))
+        return outcomes
 
     """
     Actions handler to construct rules, fetches resources and invoke actions dispatcher
@@ -145,7 +338,7 @@ class GmailActionsHandler:
         acccess_token -> (str)  -> Access token for using the endpoint
         resource_type -> (str) -> Resource type to fetch the resource
     Returns: 
-        None
+        outcomes -> (list of dict) -> Per action, google message id to the status code of its request
     """
     def actions_handler(self, access_token, resource_type):
         rules, actions = self.rules_fetcher.construct_rules()
@@ -153,4 +346,58 @@ class GmailActionsHandler:
         resource_args_map = {
             'message': {'message_ids': resources}
         }
-        self.actions_dispatcher(actions, access_token=access_token, **resource_args_map[resource_type])
+        return self.dispatch_actions(actions, access_token=access_token, **resource_args_map[resource_type])
+
+    """
+    Actions handler reading the matching resources in chunks and dispatching the actions of every
+    chunk as soon as it is read, so reading from db and the action requests overlap
+    The search and its cursor run on a single db thread, dispatches on worker threads. At most
+    max_dispatches chunks are dispatched at once, each with its own pool of max_workers requests,
+    and the next chunk is only read once a dispatch slot is free
+    Arguments:
+        acccess_token  -> (str) -> Access token for using the endpoint
+        resource_type  -> (str) -> Resource type to fetch the resource
+        chunk_size     -> (int) -> Resources dispatched together
+        max_dispatches -> (int) -> Chunks dispatched concurrently
+    Returns: 
+        outcomes -> (list of dict) -> Per dispatch, google message id to the status code of its request
+    """
+    async def actions_handler_async(self, access_token, resource_type, chunk_size=BATCH_MODIFY_LIMIT, max_dispatches=2):
+        rules, actions = self.rules_fetcher.construct_rules()
+        loop = asyncio.get_running_loop()
+        dispatch_slots = asyncio.Semaphore(max_dispatches)
+        dispatches = []
+
+        async def dispatch(message_ids):
+            try:
+                return await asyncio.to_thread(self.dispatch_actions, actions, message_ids, access_token)
+            finally:
+                dispatch_slots.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=1) as db_pool:
+                chunks = self.resource_fetcher.iter_fetch(resource_type, rules, chunk_size)
+                while True:
+                    await dispatch_slots.acquire()
+                    # A failed dispatch stops reading, instead of being reported once every chunk is dispatched
+                    for task in dispatches:
+                        if task.done() and task.exception():
+                            dispatch_slots.release()
+                            raise task.exception()
+                    message_ids = await loop.run_in_executor(db_pool, next, chunks, None)
+                    if message_ids is None:
+                        dispatch_slots.release()
+                        break
+                    logger.info(f"Dispatching actions for {len(message_ids)} messages")
+                    dispatches.append(asyncio.create_task(dispatch(message_ids)))
+                if not dispatches:
+                    raise Exception('No messages found matching rules')
+            results = await asyncio.gather(*dispatches)
+        finally:
+            for task in dispatches:
+                task.cancel()
+
+        outcomes = []
+        for dispatch_outcomes in results:
+            outcomes.extend(dispatch_outcomes)
+        return outcomes
@@ -1,7 +1,10 @@
+import datetime
+import threading
+from google.auth.exceptions import GoogleAuthError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build, build_from_document
 from googleapiclient.errors import HttpError
 
 import logging
@@ -9,29 +12,116 @@ logger = logging.getLogger('mailer.google_auth')
 logger.setLevel(logging.INFO)
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 
+
+class TokenRefresher(threading.Thread):
+    """
+    Daemon thread refreshing credentials shortly before they expire, so the workers sharing the
+    credentials of a service never block on a refresh in the middle of a request
+    Arguments:
+        credentials    (Credentials) -> google credentials object
+        margin         (float) -> seconds before expiry at which the credentials are refreshed
+        retry_interval (float) -> seconds to wait before retrying a failed refresh
+        token_path     (str)   -> File the refreshed credentials are written to, if any
+    Returns:
+        None
+    """
+    def __init__(self, credentials, margin=300, retry_interval=60, token_path=None):
+        super().__init__(daemon=True)
+        self.credentials = credentials
+        self.margin = margin
+        self.retry_interval = retry_interval
+        self.token_path = token_path
+        self.stopped = threading.Event()
+
+    """
+    Seconds to wait before the next refresh, None when the credentials can not be refreshed
+    Arguments:
+        None
+    Returns:
+        seconds -> (float)
+    """
+    def seconds_until_refresh(self):
+        if not self.credentials.expiry or not getattr(self.credentials, 'refresh_token', None):
+            return None
+        # google auth keeps expiry as a naive utc datetime
+        remaining = (self.credentials.expiry - datetime.datetime.utcnow()).total_seconds()
+        return max(0, remaining - self.margin)
+
+    def run(self):
+        while not self.stopped.is_set():
+            wait = self.seconds_until_refresh()
+            if wait is None or self.stopped.wait(wait):
+                break
+            # Network failures are retried like rejected refreshes, the services keep using the credentials
+            try:
+                self.credentials.refresh(Request())
+                logger.info(f"Refreshed credentials expiring at {self.credentials.expiry}")
+            except GoogleAuthError:
+                logger.exception("Failed to refresh credentials")
+                self.stopped.wait(self.retry_interval)
+                continue
+            except Exception:
+                logger.exception("Unexpected error refreshing credentials")
+                self.stopped.wait(self.retry_interval)
+                continue
+            if self.token_path:
+                try:
+                    GoogleAuthenticator.save_credentials(self.credentials, self.token_path)
+                except OSError as error:
+                    logger.error(f"Failed to save refreshed credentials to {self.token_path}: {error}")
+
+    def stop(self):
+        self.stopped.set()
+
+
 class GoogleAuthenticator():
+    SCOPES = SCOPES
+    # Discovery documents keyed by service name and version, kept as the raw json since
+    # building a service mutates the parsed document
+    discovery_documents = {}
+    # Built service objects and the refresher of their credentials, keyed by service name,
+    # version and credentials
+    services = {}
+    token_refreshers = {}
+    lock = threading.Lock()
 
     """
-    Method to fetch access token using refresh token if it expires
-    and saves it to credentials.json
+    Method to fetch access token using refresh token if it expires, or through the local
+    oauth flow when it can not be refreshed, and saves it to the token file
 
     Arguments:
         credentials (dict) -> google credentials object
         SCOPES      (list) -> Scope of the gmail service (read only, write only etc)
+        token_path  (str)  -> File the refreshed credentials are written to
     Returns: 
-        None
+        credentials (dict) -> refreshed google credentials object
     """
-    @staticmethod
-    def refresh_token(credentials, SCOPES):
+    @classmethod
+    def refresh_token(cls, credentials, SCOPES, token_path="token.json"):
         logger.info("Refreshing credentials")
         if credentials and credentials.expired and credentials.refresh_token:
             credentials.refresh(Request())
         else:
+            # The oauth flow is only loaded when a user has to grant access again
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(
                 "credentials.json", SCOPES
             )
-        credentials = flow.run_local_server(port=0)
-        with open("token.json", "w") as token:
+            credentials = flow.run_local_server(port=0)
+        cls.save_credentials(credentials, token_path)
+        return credentials
+
+    """
+    Writes credentials to a token file, read back by from_file
+    Arguments:
+        credentials (Credentials) -> google credentials object
+        token_path  (str)  -> File the credentials are written to
+    Returns: 
+        None
+    """
+    @staticmethod
+    def save_credentials(credentials, token_path):
+        with open(token_path, "w") as token:
             token.write(credentials.to_json())
 
     """
@@ -48,9 +138,9 @@ class GoogleAuthenticator():
         
         credentials = Credentials.from_authorized_user_file(file_path, cls.SCOPES)
         if not credentials or not credentials.valid:
-            cls.refresh_token(credentials, cls.SCOPES)
+            credentials = cls.refresh_token(credentials, cls.SCOPES, file_path)
 
-        return cls.init_service(credentials, service_name, version)
+        return cls.init_service(credentials, service_name, version, token_path=file_path)
     
     """
     Alternative constructor for reading credentials from cli
@@ -66,20 +156,66 @@ class GoogleAuthenticator():
         credentials = Credentials.from_authorized_user_info(info=config)
         return cls.init_service(credentials, service_name, version)
 
+    """
+    Key identifying credentials across runs, the refresh token outlives the access token
+    Arguments:
+        credentials (Credentials) -> google credentials object
+    Returns:
+        key (tuple)
+    """
+    @staticmethod
+    def credentials_key(credentials):
+        refresh_token = getattr(credentials, 'refresh_token', None)
+        return (getattr(credentials, 'client_id', None), refresh_token or credentials.token)
+
+    """
+    Discovery document of a service, read once from the documents bundled with googleapiclient
+    Arguments:
+        service_name (str) -> google service name
+        version      (str) -> api version to use
+    Returns:
+        document (str) -> discovery document json, None if it is not bundled
+    """
+    @classmethod
+    def discovery_document(cls, service_name, version):
+        key = (service_name, version)
+        if key not in cls.discovery_documents:
+            cls.discovery_documents[key] = discovery_cache.get_static_doc(service_name, version)
+        return cls.discovery_documents[key]
+
     """
     Initialize and return service object using credentials
+    Services are cached per credentials, the first one built for credentials starts a refresher
+    keeping them valid for every worker using the service
     Arguments:
         credentials  (dict) -> dict of credentials with token, refresh token, expiry etc
         service_name (str)  -> google service name
         version      (str)  -> api version to use
+        token_path   (str)  -> File the credentials were read from, refreshed ones are written back to it
     Returns: 
         service_object () -> gmail service object
     """
     @classmethod
-    def init_service(cls, credentials, service_name, version):
-        try:
-            service =  build(service_name, version, credentials=credentials)
-            logger.info("Service initialized")
+    def init_service(cls, credentials, service_name, version, token_path=None):
+        key = (service_name, version, cls.credentials_key(credentials))
+        with cls.lock:
+            if key in cls.services:
+                logger.info("Service reused from cache")
+                return cls.services[key]
+            try:
+                document = cls.discovery_document(service_name, version)
+                if document:
+                    service = build_from_document(document, credentials=credentials)
+                else:
+                    service = build(service_name, version, credentials=credentials)
+                logger.info("Service initialized")
+            except HttpError as error:
+                logger.error(f"Error initalizing service: {error}")
+                return None
+
+            cls.services[key] = service
+            refresher = TokenRefresher(credentials, token_path=token_path)
+            if refresher.seconds_until_refresh() is not None:
+                refresher.start()
+                cls.token_refreshers[key] = refresher
             return service
-        except HttpError as error:
-            logger.error(f"Error initalizing service: {error}")
@@ -0,0 +1,135 @@
+import sys
+import json
+import signal
+import argparse
+import datetime
+import logging
+import threading
+
+from mailer.utils.metrics import metrics
+
+# Django, pydantic and the api clients are imported where they are first used, so --help does not pay for them
+logger = logging.getLogger("mailer.daemon")
+logging.basicConfig(level=logging.INFO)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Keep the gmail messages of a user in db in sync as change notifications arrive")
+    parser.add_argument('user_email', help="email address of the user")
+    parser.add_argument('config_type', help="cli, file or replay")
+    parser.add_argument('config_value', help="credentials json, filepath to credentials json or directory of a replay mailbox")
+    parser.add_argument('--listen', default='127.0.0.1:8085', help="host:port the pub/sub push requests are received on")
+    parser.add_argument('--push-token', help="token the push endpoint url must carry as ?token=")
+    parser.add_argument('--watch-topic', help="pub/sub topic to watch the mailbox on, renewed daily, omit when the watch is set up elsewhere")
+    parser.add_argument('--rules', help="rules json, only the headers its conditions reference are fetched")
+    parser.add_argument('--access-token', help="with --rules, apply the rule actions to matching messages as they are ingested")
+    parser.add_argument('--workers', type=int, default=4, help="message batches fetched concurrently, 1 fetches serially")
+    parser.add_argument('--format', choices=['metadata', 'full'], default='metadata', help="gmail message format to fetch")
+    parser.add_argument('--bulk-loader', choices=['orm', 'copy'], default='orm', help="how header and user message rows are written")
+    parser.add_argument('--metrics-file', help="file the metrics are written to on exit, json if it ends with .json and prometheus text otherwise")
+    return parser.parse_args(args)
+
+def parse_listen(listen):
+    host, _, port = listen.rpartition(':')
+    if not host or not port.isdigit():
+        raise Exception(f"Invalid listen address {listen}, expected host:port")
+    return host, int(port)
+
+def initialize(args):
+    config_type, config_value = args.config_type, args.config_value
+
+    allowed_config_types = ['cli', 'file', 'replay']
+    if config_type not in allowed_config_types:
+        raise Exception(f"Invalid config type {config_type}, allowed types: {allowed_config_types}")
+
+    gmail_service = None
+    if config_type in ('cli', 'file'):
+        from mailer.authentication.authenticator import GoogleAuthenticator
+        if config_type == 'cli':
+            gmail_service = GoogleAuthenticator().from_config(json.loads(config_value))
+        else:
+            gmail_service = GoogleAuthenticator().from_file(config_value)
+    elif config_type == 'replay':
+        from mailer.replay.replay_service import ReplayGmailService
+        gmail_service = ReplayGmailService.from_directory(config_value)
+
+    if not gmail_service:
+        raise Exception("Error initializing gmail service")
+
+    return gmail_service
+
+"""
+Builds the daemon of the user, the gmail service, db connection and actions handler it holds are
+reused by every sync
+Arguments:
+    args   -> (Namespace) -> parsed arguments
+    source -> (NotificationSource) -> source of the change notifications
+Returns:
+    daemon -> (SyncDaemon)
+"""
+def build_daemon(args, source):
+    from mailer.ingestion.email_fetcher import GmailFetcher, PipelinedGmailFetcher, IngestionInterval, IngestionFilters
+    from mailer.ingestion.email_message_processor import GmailMessageProcessor
+    from mailer.ingestion.daemon import SyncDaemon
+
+    gmail_service = initialize(args)
+    ingestion_interval = IngestionInterval(
+        start_date=(datetime.datetime.now() - datetime.timedelta(days=1)).date(),
+    )
+    ingestion_filters = IngestionFilters(message_format=args.format)
+    processor = GmailMessageProcessor(bulk_loader=args.bulk_loader)
+    rules_fetcher, rule_set, actions, handler = None, None, [], None
+    if args.rules:
+        from mailer.rules.rules_fetch import RulesFetch
+        from mailer.rules.rules_model import metadata_headers
+        rules_fetcher = RulesFetch.read_rules_from_file(args.rules)
+        if not rules_fetcher:
+            raise Exception("Error initializing rules fetcher service")
+        rule_set, actions = rules_fetcher.construct_rules()
+        ingestion_filters.metadata_headers = metadata_headers(rule_set)
+    if rule_set and args.access_token:
+        from mailer.actions.actions_handler import GmailActionsHandler
+        handler = GmailActionsHandler(None, rules_fetcher)
+    else:
+        # Without a token to apply them, the rules are not evaluated
+        rule_set = None
+
+    if args.workers > 1:
+        ingestion = PipelinedGmailFetcher(
+            gmail_service, args.user_email, ingestion_interval, ingestion_filters, max_workers=args.workers
+        )
+    else:
+        ingestion = GmailFetcher(gmail_service, args.user_email, ingestion_interval, ingestion_filters)
+
+    # Register sender
+    recipient = processor.register_recipient(args.user_email)
+
+    # Updating user and system labels
+    message_labels = ingestion.fetch_labels()
+    processor.create_labels(recipient, message_labels)
+
+    return SyncDaemon(
+        ingestion, processor, source, rule_set=rule_set, actions_handler=handler, actions=actions,
+        access_token=args.access_token, watch_topic=args.watch_topic,
+    )
+
+def main():
+
+    args = parse_args(sys.argv[1:])
+    from mailer.ingestion.notifications import PushNotificationSource
+
+    host, port = parse_listen(args.listen)
+    source = PushNotificationSource(host, port, verification_token=args.push_token)
+    stopped = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stopped.set())
+    try:
+        build_daemon(args, source).run(stopped)
+    finally:
+        source.close()
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+            logger.info(f"Wrote metrics to {args.metrics_file}")
+    logger.info("Stopped")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.24 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='last_history_id',
+            field=models.TextField(null=True),
+        ),
+    ]
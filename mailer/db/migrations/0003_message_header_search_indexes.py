@@ -0,0 +1,59 @@
+# Generated by Django 3.2.24 on 2026-10-18 11:04
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+import django.db.models.expressions
+import django.db.models.functions.text
+
+
+BACKFILL_HEADER_COLUMNS = """
+UPDATE db_message SET
+    from_header = (SELECT value FROM db_messageheadervalues WHERE message_id_id = db_message.id AND header = 'From' LIMIT 1),
+    to_header = (SELECT value FROM db_messageheadervalues WHERE message_id_id = db_message.id AND header = 'To' LIMIT 1),
+    subject_header = (SELECT value FROM db_messageheadervalues WHERE message_id_id = db_message.id AND header = 'Subject' LIMIT 1)
+"""
+
+TRIGRAM_INDEXES = [
+    ('header_value_trgm_idx', 'db_messageheadervalues', 'value'),
+    ('message_from_trgm_idx', 'db_message', 'from_header'),
+    ('message_to_trgm_idx', 'db_message', 'to_header'),
+    ('message_subject_trgm_idx', 'db_message', 'subject_header'),
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0002_user_last_history_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='from_header',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='subject_header',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='to_header',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='messageheadervalues',
+            index=models.Index(django.db.models.expressions.F('header'), django.db.models.functions.text.Lower('value'), name='header_lower_value_idx'),
+        ),
+        migrations.RunSQL(BACKFILL_HEADER_COLUMNS, migrations.RunSQL.noop),
+        TrigramExtension(),
+    ] + [
+        # Substring predicates compile to lower(column) LIKE '%value%'
+        migrations.RunSQL(
+            f"CREATE INDEX {name} ON {table} USING gin (lower({column}) gin_trgm_ops)",
+            f"DROP INDEX {name}",
+        )
+        for name, table, column in TRIGRAM_INDEXES
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations
+
+
+# 0003 copied the first value of every header, messages with several values get all of them
+BACKFILL_MULTI_VALUED_HEADER_COLUMNS = """
+UPDATE db_message SET {column} = header_values.joined_value
+FROM (
+    SELECT message_id_id, string_agg(value, E'\\n' ORDER BY id) AS joined_value
+    FROM db_messageheadervalues
+    WHERE header = '{header}'
+    GROUP BY message_id_id
+    HAVING count(*) > 1
+) header_values
+WHERE db_message.id = header_values.message_id_id
+"""
+
+HEADER_COLUMNS = [
+    ('From', 'from_header'),
+    ('To', 'to_header'),
+    ('Subject', 'subject_header'),
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0003_message_header_search_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            BACKFILL_MULTI_VALUED_HEADER_COLUMNS.format(header=header, column=column), migrations.RunSQL.noop
+        )
+        for header, column in HEADER_COLUMNS
+    ]
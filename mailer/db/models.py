@@ -1,8 +1,10 @@
 from django.db import models
+from django.db.models.functions import Lower
 
 class User(models.Model):
     email = models.CharField(max_length=254, unique=True)
     username = models.CharField(max_length=254, unique=True)
+    last_history_id = models.TextField(null=True)
 
 class Message(models.Model):
     message_id = models.TextField(unique=True)
@@ -11,9 +13,21 @@ class Message(models.Model):
     size_estimate = models.IntegerField()
     internal_date = models.DateTimeField()
     snippet = models.TextField()
+    # Denormalized copies of the headers rules search on, see HEADER_COLUMNS
+    from_header = models.TextField(null=True)
+    to_header = models.TextField(null=True)
+    subject_header = models.TextField(null=True)
     user_id = models.ManyToManyField(User, through='UserMessage')
     labels = models.ManyToManyField('Label', related_name='labels')    
 
+    HEADER_COLUMNS = {
+        'From': 'from_header',
+        'To': 'to_header',
+        'Subject': 'subject_header',
+    }
+    # A header given several times has all its values in the column, joined by the separator
+    HEADER_VALUE_SEPARATOR = '\n'
+
 class UserMessage(models.Model):
 
     class UserTypes(models.TextChoices):
@@ -43,3 +57,6 @@ class MessageHeaderValues(models.Model):
 
     class Meta:
         unique_together = ('message_id', 'header', 'value',)
+        indexes = [
+            models.Index('header', Lower('value'), name='header_lower_value_idx'),
+        ]
@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connections
+
+from mailer.actions.actions_handler import BATCH_MODIFY_LIMIT
+from mailer.utils.metrics import metrics
+
+logger = logging.getLogger('mailer.async_pipeline')
+
+
+class AsyncSyncPipeline:
+    """
+    Runs a sync as asyncio stages connected by bounded queues, so fetching batches from gmail,
+    persisting them with the rules evaluated and applying the rule actions overlap
+    googleapiclient, the django orm and requests are blocking, so each stage runs its calls on an
+    executor and the event loop only awaits them: batches on a pool of fetch workers each with its
+    own http object, db writes on a single thread holding one connection, actions on worker threads
+    Arguments:
+        ingestion           -> (GmailFetcher) -> fetcher of the user, a PipelinedGmailFetcher to fetch concurrently
+        processor           -> (GmailMessageProcessor) -> processor of the user
+        actions_handler     -> (GmailActionsHandler) -> handler applying the actions, None to only ingest
+        actions             -> (list of Action) -> actions applied to the messages matching the rules
+        access_token        -> (str) -> access token for applying the actions
+        max_workers         -> (int) -> message batches fetched concurrently
+        max_pending_batches -> (int) -> fetched batches waiting for the db writer
+        action_chunk_size   -> (int) -> matching messages collected before dispatching their actions
+    Returns:
+        None
+    """
+    def __init__(self, ingestion, processor, actions_handler=None, actions=None, access_token=None,
+                 max_workers=4, max_pending_batches=8, action_chunk_size=BATCH_MODIFY_LIMIT):
+        self.ingestion = ingestion
+        self.processor = processor
+        self.actions_handler = actions_handler
+        self.actions = actions or []
+        self.access_token = access_token
+        # httplib2 is not thread safe, only fetchers handing out an http object per thread fetch concurrently
+        self.max_workers = max_workers if hasattr(ingestion, 'get_thread_http') else 1
+        self.max_pending_batches = max(max_pending_batches, self.max_workers)
+        self.action_chunk_size = action_chunk_size
+        self.fetch_pool = None
+        self.db_pool = None
+
+    """
+    Runs a blocking call on an executor
+    Arguments:
+        executor -> (Executor) -> executor to run the call on, None for the loop's default
+        func     -> (callable) -> blocking function
+    Returns:
+        result -> () -> value returned by the function
+    """
+    @staticmethod
+    async def run_in(executor, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+    def fetch_batch_blocking(self, message_ids):
+        get_thread_http = getattr(self.ingestion, 'get_thread_http', None)
+        http = get_thread_http() if get_thread_http else None
+        with metrics.timer('stage_seconds', stage='fetch'):
+            return self.ingestion.get_message_in_batch(message_ids, http=http)
+
+    """
+    Fetch stage task fetching a batch of messages and handing it to the db writer
+    Arguments:
+        message_ids -> (list) -> message ids of a listed page
+        batches     -> (asyncio.Queue) -> queue consumed by the persist stage
+        fetch_slots -> (asyncio.Semaphore) -> released once the batch is queued
+    Returns:
+        None
+    """
+    async def fetch_batch(self, message_ids, batches, fetch_slots):
+        try:
+            resources = await self.run_in(self.fetch_pool, self.fetch_batch_blocking, message_ids)
+            await batches.put(resources)
+        finally:
+            fetch_slots.release()
+
+    """
+    Fetch stage of a full sync, pages through message ids and fetches the pages concurrently
+    Listing waits while max_workers batches are being fetched or waiting to be queued
+    Arguments:
+        batches -> (asyncio.Queue) -> queue consumed by the persist stage
+    Returns:
+        None
+    """
+    async def list_messages(self, batches):
+        fetch_slots = asyncio.Semaphore(self.max_workers)
+        tasks = []
+        next_page_token = None
+        page_num = 1
+        try:
+            while True:
+                try:
+                    message_ids, next_page_token = await self.run_in(
+                        None, self.ingestion.list_messages_page, next_page_token
+                    )
+                except Exception as error:
+                    # Raised rather than ending the listing, a partial listing must not look complete
+                    # or the sync cursor would move past the messages never listed
+                    logger.error(f"Failed to list messages: {error}")
+                    raise
+
+                await fetch_slots.acquire()
+                tasks.append(asyncio.create_task(self.fetch_batch(message_ids, batches, fetch_slots)))
+                logger.info(f"Dispatched message batch page {page_num} with {len(message_ids)} messages")
+                page_num += 1
+
+                if not next_page_token:
+                    break
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        await batches.put(None)
+
+    """
+    Fetch stage of an incremental sync, pages through the history of the mailbox
+    Arguments:
+        start_history_id -> (str) -> history id of the last sync
+        batches          -> (asyncio.Queue) -> queue consumed by the persist stage
+    Returns:
+        None
+    """
+    async def list_history(self, start_history_id, batches):
+        history = self.ingestion.fetch_history(start_history_id)
+        while True:
+            changes = await self.run_in(None, next, history, None)
+            if changes is None:
+                break
+            await batches.put(changes)
+        await batches.put(None)
+
+    """
+    Persist stage, writes the batches in db on the db thread and hands the messages matching the
+    rules to the act stage
+    Arguments:
+        batches -> (asyncio.Queue) -> fetched batches, None once the fetch stage is done
+        matches -> (asyncio.Queue) -> queue consumed by the act stage
+        process -> (callable) -> processor method writing a batch and returning the matching message ids
+    Returns:
+        matched_ids -> (list) -> google message ids matching the rules
+    """
+    async def persist(self, batches, matches, process):
+        matched_ids = []
+        while True:
+            batch = await batches.get()
+            if batch is None:
+                break
+            batch_matched_ids = await self.run_in(self.db_pool, process, batch)
+            matched_ids.extend(batch_matched_ids)
+            if batch_matched_ids and self.actions_handler:
+                await matches.put(batch_matched_ids)
+        await matches.put(None)
+        return matched_ids
+
+    """
+    Act stage, dispatches the actions once action_chunk_size matching messages are collected
+    Arguments:
+        matches -> (asyncio.Queue) -> matching message ids, None once the persist stage is done
+    Returns:
+        None
+    """
+    async def act(self, matches):
+        pending = []
+        while True:
+            matched_ids = await matches.get()
+            if matched_ids is not None:
+                pending.extend(matched_ids)
+            if pending and (matched_ids is None or len(pending) >= self.action_chunk_size):
+                await self.run_in(
+                    None, self.actions_handler.dispatch_actions, self.actions, pending, self.access_token
+                )
+                logger.info(f"Dispatched actions for {len(pending)} ingested messages matching rules")
+                pending = []
+            if matched_ids is None:
+                break
+
+    """
+    Runs the fetch, persist and act stages concurrently, the first stage failing cancels the others
+    Arguments:
+        fetch   -> (coroutine function) -> fetch stage taking the batches queue
+        process -> (callable) -> processor method writing a batch and returning the matching message ids
+    Returns:
+        matched_ids -> (list) -> google message ids matching the rules
+    """
+    async def run(self, fetch, process):
+        batches = asyncio.Queue(maxsize=self.max_pending_batches)
+        matches = asyncio.Queue()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as self.fetch_pool, \
+                ThreadPoolExecutor(max_workers=1) as self.db_pool:
+            stages = [
+                asyncio.create_task(fetch(batches)),
+                asyncio.create_task(self.persist(batches, matches, process)),
+            ]
+            if self.actions_handler:
+                stages.append(asyncio.create_task(self.act(matches)))
+            try:
+                results = await asyncio.gather(*stages)
+            finally:
+                for stage in stages:
+                    stage.cancel()
+                await self.run_in(self.db_pool, connections.close_all)
+        return results[1]
+
+    """
+    Lists and ingests the messages of the interval
+    Arguments:
+        None
+    Returns:
+        history_id  -> (str)  -> history id read before listing, the next sync starts from it
+        matched_ids -> (list) -> google message ids matching the rules
+    """
+    async def full_sync(self):
+        # Reading the history id before listing so changes made while listing are replayed next run
+        profile = await self.run_in(None, self.ingestion.fetch_profile) or {}
+        matched_ids = await self.run(self.list_messages, self.processor.process_messages)
+        return profile.get('historyId'), matched_ids
+
+    """
+    Ingests the changes of the mailbox since the last sync
+    Arguments:
+        start_history_id -> (str) -> history id of the last sync
+    Returns:
+        history_id  -> (str)  -> latest history id, the next sync starts from it
+        matched_ids -> (list) -> google message ids matching the rules
+    """
+    async def incremental_sync(self, start_history_id):
+        history_ids = []
+
+        def process_history(changes):
+            history_ids.append(changes['history_id'])
+            return self.processor.process_history(changes)
+
+        matched_ids = await self.run(
+            functools.partial(self.list_history, start_history_id), process_history
+        )
+        # Every page reports the latest history id, keeping the first one as the changes
+        # after it are yet to be paged through
+        return (history_ids[0] if history_ids else None), matched_ids
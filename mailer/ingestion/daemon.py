@@ -0,0 +1,165 @@
+import time
+import logging
+from django.db import connection
+
+from mailer.ingestion.sync import sync
+from mailer.rules.rules_evaluator import RuleEvaluator
+from mailer.utils.metrics import metrics
+
+logger = logging.getLogger('mailer.daemon')
+
+# Gmail stops publishing a watch after 7 days, it is renewed daily as recommended
+WATCH_RENEWAL_SECONDS = 24 * 60 * 60
+# Date conditions are compiled relative to the time the evaluator is built, so it is rebuilt hourly
+EVALUATOR_MAX_AGE_SECONDS = 60 * 60
+
+
+class SyncDaemon:
+    """
+    Keeps the mailbox of a user in sync as change notifications arrive, instead of on a schedule
+    The gmail service, the processor and its db connection and the actions handler are created once
+    and reused by every sync, each notification triggers an incremental sync from the stored history
+    id and the actions of the rules are applied to the added messages they match
+    Arguments:
+        ingestion       -> (GmailFetcher) -> fetcher of the user
+        processor       -> (GmailMessageProcessor) -> processor of the user, with its recipient registered
+        source          -> (NotificationSource) -> source of the change notifications
+        rule_set        -> (RuleSet) -> rules evaluated on the added messages, None to only ingest
+        actions_handler -> (GmailActionsHandler) -> handler applying the actions of the rules
+        actions         -> (list of Action) -> actions applied to the messages matching the rules
+        access_token    -> (str) -> access token for applying the actions
+        watch_topic     -> (str) -> pub/sub topic gmail publishes the changes of the mailbox to, None
+                                    when the watch is set up outside of the daemon
+    Returns:
+        None
+    """
+    def __init__(self, ingestion, processor, source, rule_set=None, actions_handler=None, actions=None,
+                 access_token=None, watch_topic=None):
+        self.ingestion = ingestion
+        self.processor = processor
+        self.source = source
+        self.rule_set = rule_set
+        self.evaluator_built_at = None
+        self.actions_handler = actions_handler
+        self.actions = actions or []
+        self.access_token = access_token
+        self.watch_topic = watch_topic
+        self.watch_renewed_at = None
+
+    @property
+    def user_email(self):
+        return self.processor.recipient.email
+
+    """
+    Asks gmail to publish the changes of the mailbox to the watch topic, when one is set and the
+    watch is due for renewal
+    Arguments:
+        None
+    Returns:
+        None
+    """
+    def renew_watch(self):
+        if not self.watch_topic:
+            return
+        if self.watch_renewed_at and time.monotonic() - self.watch_renewed_at < WATCH_RENEWAL_SECONDS:
+            return
+        response = self.ingestion.gmail_service.users().watch(
+            userId=self.ingestion.user_email or self.ingestion.ingestion_filters.user_id,
+            body={'topicName': self.watch_topic},
+        ).execute()
+        self.watch_renewed_at = time.monotonic()
+        logger.info(f"Watching {self.user_email} on {self.watch_topic} from history id {response.get('historyId')}")
+
+    """
+    The db connection is kept open between syncs, it is only reopened when the server dropped it
+    Arguments:
+        None
+    Returns:
+        None
+    """
+    @staticmethod
+    def ensure_db_connection():
+        if connection.connection is not None and not connection.is_usable():
+            logger.warning("Db connection was lost, reconnecting")
+            connection.close()
+
+    """
+    Syncs the changes since the stored history id and applies the actions to the matching messages
+    Arguments:
+        None
+    Returns:
+        matched_ids -> (list) -> google message ids of the added messages matching the rules
+    """
+    def sync(self):
+        self.ensure_db_connection()
+        if self.rule_set and (
+            self.evaluator_built_at is None or time.monotonic() - self.evaluator_built_at > EVALUATOR_MAX_AGE_SECONDS
+        ):
+            self.processor.rule_evaluator = RuleEvaluator(self.rule_set)
+            self.evaluator_built_at = time.monotonic()
+        history_id, matched_ids = sync(self.ingestion, self.processor, self.processor.recipient.last_history_id)
+        if history_id:
+            self.processor.update_sync_cursor(history_id)
+        if self.actions_handler and matched_ids:
+            self.actions_handler.dispatch_actions(self.actions, matched_ids, self.access_token)
+            logger.info(f"Dispatched actions for {len(matched_ids)} messages matching rules")
+        return matched_ids
+
+    """
+    Applies a burst of notifications with a single sync, notifications of other mailboxes and the
+    ones already covered by the stored history id are skipped
+    Arguments:
+        notifications -> (list of Notification) -> notifications taken from the source
+    Returns:
+        synced -> (bool) -> whether a sync ran
+    """
+    def handle(self, notifications):
+        metrics.increment('notifications_total', len(notifications))
+        notifications = [
+            notification for notification in notifications if notification.email_address == self.user_email
+        ]
+        cursor = int(self.processor.recipient.last_history_id or 0)
+        pending = [notification for notification in notifications if notification.history_id > cursor]
+        if not pending:
+            logger.info(f"Skipping {len(notifications)} notifications already synced")
+            return False
+
+        started_at = time.monotonic()
+        with metrics.timer('stage_seconds', stage='notification_sync'):
+            matched_ids = self.sync()
+        # Latency from the oldest notification being published to its changes being applied
+        published_at = [notification.published_at for notification in pending if notification.published_at]
+        if published_at:
+            metrics.observe('notification_latency_seconds', time.time() - min(published_at))
+        logger.info(
+            f"Synced {len(pending)} notifications up to history id {max(n.history_id for n in pending)} in "
+            f"{time.monotonic() - started_at:.2f}s, {len(matched_ids)} messages matched rules"
+        )
+        return True
+
+    """
+    Catches up with the changes made while the daemon was not running, then applies notifications
+    until stopped
+    Arguments:
+        stopped      -> (threading.Event) -> set to stop the daemon
+        poll_timeout -> (float) -> seconds to wait for a notification before checking stopped again
+    Returns:
+        None
+    """
+    def run(self, stopped, poll_timeout=1.0):
+        self.renew_watch()
+        self.sync()
+        logger.info(f"Waiting for notifications of {self.user_email}")
+        while not stopped.is_set():
+            notification = self.source.get(timeout=poll_timeout)
+            if notification is None:
+                self.renew_watch()
+                continue
+            notifications = [notification, *self.source.drain()]
+            try:
+                self.handle(notifications)
+            except Exception:
+                # The next notification syncs again from the stored history id
+                logger.exception(f"Failed to sync {len(notifications)} notifications")
+            self.source.ack(notifications)
+        self.source.close()
@@ -1,7 +1,21 @@
+import time
+import queue
 import datetime
+import functools
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from typing_extensions import Literal
 from pydantic import BaseModel, Field, PastDate, FutureDate, EmailStr
 from googleapiclient.errors import HttpError
+from mailer.ingestion.rate_limiter import (
+    TokenBucket, AdaptiveBatchSize, is_retryable_error, backoff_delay,
+    QUOTA_UNITS, USER_QUOTA_UNITS_PER_SECOND, BATCH_REQUEST_LIMIT
+)
+from mailer.ingestion.message_cache import MessageCache
+from mailer.rules.rules_model import metadata_headers
+from mailer.utils.metrics import metrics, SIZE_BUCKETS
 
 
 logger = logging.getLogger('mailer.ingestion')
@@ -12,7 +26,17 @@ class IngestionInterval(BaseModel):
 
 class IngestionFilters(BaseModel):
     user_id: EmailStr = Field(default='me')
-    max_results: int = Field(default=10)
+    max_results: int = Field(default=100, le=500)
+    batch_size: int = Field(default=10, ge=1, le=BATCH_REQUEST_LIMIT)
+    max_batch_size: int = Field(default=BATCH_REQUEST_LIMIT, ge=1, le=BATCH_REQUEST_LIMIT)
+    quota_units_per_second: int = Field(default=USER_QUOTA_UNITS_PER_SECOND, gt=0)
+    max_retries: int = Field(default=5, ge=0)
+    # Only headers, labels, snippet and sizes are stored, so bodies are not fetched by default
+    message_format: Literal['metadata', 'full'] = Field(default='metadata')
+    metadata_headers: List[str] = Field(default_factory=metadata_headers)
+
+class SyncCursorExpired(Exception):
+    pass
 
 class GmailFetcher:
     """
@@ -22,15 +46,40 @@ class GmailFetcher:
         user_email         (str) -> user email for which emails will be fetched
         ingestion_interval (IngestionInterval) -> start and end date
         ingestion_filters  (IngestionFilters)  -> filters for fetching emails
+        global_quota       (TokenBucket) -> quota budget shared with the fetchers of other users, if any
+        message_cache      (MessageCache) -> cache of raw messages consulted before fetching, if any
     Returns: 
         None
     """
-    def __init__(self, gmail_service, user_email=None, ingestion_interval=None, ingestion_filters=None):
+    def __init__(self, gmail_service, user_email=None, ingestion_interval=None, ingestion_filters=None,
+                 global_quota=None, message_cache=None):
         self.gmail_service = gmail_service
         self.user_email = user_email
         self.ingestion_interval = ingestion_interval or IngestionInterval()
         self.ingestion_filters = ingestion_filters or IngestionFilters()
-        self.resources = []
+        self.quota = TokenBucket(self.ingestion_filters.quota_units_per_second)
+        self.global_quota = global_quota
+        self.message_cache = message_cache
+        self.cache_format = MessageCache.format_key(
+            self.ingestion_filters.message_format, self.ingestion_filters.metadata_headers
+        )
+        self.batch_size = AdaptiveBatchSize(
+            initial=self.ingestion_filters.batch_size,
+            maximum=self.ingestion_filters.max_batch_size
+        )
+
+    """
+    Blocks until the units are available in the user's budget and in the global one
+    Arguments:
+        units -> (float) -> quota units to consume
+    Returns: 
+        None
+    """
+    def acquire_quota(self, units):
+        with metrics.timer('quota_wait_seconds'):
+            self.quota.acquire(units)
+            if self.global_quota:
+                self.global_quota.acquire(units)
 
     """
     To fetch system and user labels before fetching messages
@@ -49,6 +98,23 @@ class GmailFetcher:
         except HttpError as error:
             logger.error(f"Failed to fetch labels: {error}")
 
+    """
+    To fetch the mailbox profile, used to read the current history id before a full sync
+    Arguments:
+        None
+    Returns: 
+        profile -> (dict) -> Email address, message totals and current history id of the mailbox
+    """
+    def fetch_profile(self):
+        try:
+            profile = self.gmail_service.users().getProfile(
+                userId=self.user_email or self.ingestion_filters.user_id,
+            ).execute()
+            logger.info(f"Fetched mailbox profile for {self.user_email}")
+            return profile
+        except HttpError as error:
+            logger.error(f"Failed to fetch profile: {error}")
+
     """
     To construct filters for fetching messages
     Arguments:
@@ -71,37 +137,141 @@ class GmailFetcher:
     """
     Google's batch request requires a callback function
     Arguments:
+        resources  -> (list) -> list collecting the responses of the batch
+        retries    -> (list) -> list collecting the request ids which failed with a retryable error
         request_id -> () -> request id for the resource in the batch for which the callback is invoked
         response   -> () -> response in for the resource the batch for which the callback is invoked
         exception  -> () -> exceptions if any
     Returns: 
         None
     """
-    def batch_request_callback(self, request_id, response, exception):
+    def batch_request_callback(self, resources, retries, request_id, response, exception):
         if exception:
-            logger.error(f"Failed to fetch resource : {request_id} {exception}")
-        
-        self.resources.append(response)
+            if is_retryable_error(exception):
+                retries.append(request_id)
+            else:
+                logger.error(f"Failed to fetch resource : {request_id} {exception}")
+            return
+
+        resources.append(response)
 
     """
-    Construct a batch request for messages and executes them
+    Construct a single batch request for messages and executes it
     Arguments:
-        message_ids -> (list) -> message ids fetched during list messages
+        message_ids -> (list) -> message ids, at most the gmail batch request limit
+        http        -> (httplib2.Http) -> http object to execute the batch with, defaults to the service's
     Returns: 
-        None
+        resources -> (list) -> messages returned by the batch
+        retries   -> (list) -> message ids which failed with a retryable error
     """
-    def get_message_in_batch(self, message_ids):
+    def execute_batch(self, message_ids, http=None):
+        resources, retries = [], []
+        callback = functools.partial(self.batch_request_callback, resources, retries)
+        format_params = {'format': self.ingestion_filters.message_format}
+        if self.ingestion_filters.message_format == 'metadata':
+            format_params['metadataHeaders'] = self.ingestion_filters.metadata_headers
         batch_request = self.gmail_service.new_batch_http_request()
-        logger.info("Fetching messages in batch from gmail api, please wait....")
         for message_id in message_ids:
             batch_request.add(
                 self.gmail_service.users().messages().get(
                     userId=self.user_email or self.ingestion_filters.user_id,
-                    id=message_id
+                    id=message_id,
+                    **format_params
                 ), 
-                callback=self.batch_request_callback
-            )                
-        batch_request.execute()
+                callback=callback,
+                request_id=message_id
+            )
+        self.acquire_quota(QUOTA_UNITS['messages.get'] * len(message_ids))
+        metrics.observe('gmail_batch_size', len(message_ids), buckets=SIZE_BUCKETS, method='messages.get')
+        try:
+            with metrics.timer('gmail_api_request_seconds', method='messages.get'):
+                batch_request.execute(http=http)
+        except HttpError as error:
+            if not is_retryable_error(error):
+                raise error
+            logger.warning(f"Batch request failed with retryable error: {error}")
+            metrics.increment('gmail_retries_total', len(message_ids), method='messages.get')
+            return [], list(message_ids)
+        metrics.increment('gmail_messages_fetched_total', len(resources))
+        if retries:
+            metrics.increment('gmail_retries_total', len(retries), method='messages.get')
+        return resources, retries
+
+    """
+    Fetches messages in batches sized by the adaptive batch size, batches grow while they succeed
+    and shrink when gmail rate limits them. Only the failed sub requests are retried with backoff
+    Fetched messages are added to the message cache. Cached messages are only served for the
+    messages whose current history id is known, listed messages carry none so a full sync always
+    fetches them, as a cached message may hold labels changed since
+    Arguments:
+        message_ids -> (list) -> message ids fetched during list messages
+        http        -> (httplib2.Http) -> http object to execute the batches with, defaults to the service's
+        history_ids -> (dict) -> message id to its current history id, for the messages it is known of
+    Returns: 
+        resources -> (list) -> messages returned by the batches
+    """
+    def get_message_in_batch(self, message_ids, http=None, history_ids=None):
+        resources = []
+        pending = list(message_ids)
+        if self.message_cache and history_ids:
+            cached = self.message_cache.get_many(
+                {message_id: history_ids[message_id] for message_id in pending if message_id in history_ids},
+                self.cache_format
+            )
+            resources.extend(cached.values())
+            pending = [message_id for message_id in pending if message_id not in cached]
+            metrics.increment('message_cache_hits_total', len(cached))
+            metrics.increment('message_cache_misses_total', len(pending))
+            logger.info(f"Found {len(cached)} of {len(message_ids)} messages in cache")
+        attempts = {}
+        logger.info("Fetching messages in batch from gmail api, please wait....")
+        while pending:
+            batch_size = self.batch_size.current
+            batch_ids, pending = pending[:batch_size], pending[batch_size:]
+            fetched, retries = self.execute_batch(batch_ids, http=http)
+            resources.extend(fetched)
+            if self.message_cache:
+                self.message_cache.put_many(fetched, self.cache_format)
+            if not retries:
+                self.batch_size.grow()
+                continue
+
+            self.batch_size.shrink()
+            self.quota.drain()
+            retry_ids = []
+            for message_id in retries:
+                attempts[message_id] = attempts.get(message_id, 0) + 1
+                if attempts[message_id] > self.ingestion_filters.max_retries:
+                    logger.error(f"Failed to fetch resource : {message_id} after {attempts[message_id] - 1} retries")
+                else:
+                    retry_ids.append(message_id)
+            if retry_ids:
+                delay = backoff_delay(max(attempts[message_id] for message_id in retry_ids))
+                logger.warning(f"Rate limited, retrying {len(retry_ids)} messages in {delay:.2f}s")
+                time.sleep(delay)
+                pending = retry_ids + pending
+        return resources
+
+    """
+    Lists a page of message ids matching the ingestion filters
+    Arguments:
+        page_token -> (str) -> token of the page to list, None for the first page
+    Returns: 
+        message_ids     -> (list) -> message ids in the page
+        next_page_token -> (str)  -> token of the next page, None for the last page
+    """
+    def list_messages_page(self, page_token=None):
+        query_params = self.construct_message_filters()
+        self.acquire_quota(QUOTA_UNITS['messages.list'])
+        with metrics.timer('gmail_api_request_seconds', method='messages.list'):
+            response = self.gmail_service.users().messages().list(
+                userId=self.user_email or self.ingestion_filters.user_id,
+                q=query_params, 
+                maxResults=self.ingestion_filters.max_results,
+                pageToken=page_token 
+            ).execute()
+        messages = response.get('messages', [])
+        return [message['id'] for message in messages], response.get('nextPageToken')
         
     """
     Generator function which fetches paginated results of messages, it has only message and thread ids
@@ -115,27 +285,233 @@ class GmailFetcher:
         page_num = 1
         while True:
             try:
-                query_params = self.construct_message_filters()
-                response = self.gmail_service.users().messages().list(
-                    userId=self.user_email or self.ingestion_filters.user_id,
-                    q=query_params, 
-                    maxResults=self.ingestion_filters.max_results,
-                    pageToken=next_page_token 
-                ).execute()
-                next_page_token = response.get('nextPageToken')
-                messages = response.get('messages', [])
-                message_ids = [message['id'] for message in messages]
-
-                self.get_message_in_batch(message_ids)
+                with metrics.timer('stage_seconds', stage='fetch'):
+                    message_ids, next_page_token = self.list_messages_page(next_page_token)
+                    resources = self.get_message_in_batch(message_ids)
                 logger.info(f"Fetched message batch page {page_num} with {len(message_ids)} messages")
                 page_num += 1
-                yield self.resources
-                self.resources = []
+                yield resources
 
                 if not next_page_token:
                     break
 
             except HttpError as error:
-                logger.error(f"Failed to fetch labels: {error}")
+                # A skipped page would never be fetched again once the sync cursor moves past it
+                logger.error(f"Failed to fetch messages: {error}")
+                raise
+
+    """
+    Folds a page of history records into the set of changes to apply
+    Messages added and deleted within the same page are dropped, label changes
+    of newly added messages are skipped since the fetched message carries its current labels
+    The last record of the page modifying a message is the history id the message is at once the
+    page is applied, later pages hold the changes after it
+    Arguments:
+        history_records -> (list of dict) -> history records returned by history list
+    Returns: 
+        changes -> (dict) -> added message ids, deleted message ids, label additions and removals and
+                             the history id of the added messages
+    """
+    @staticmethod
+    def construct_history_changes(history_records):
+        added, deleted = [], set()
+        labels_added, labels_removed = [], []
+        history_ids = {}
+        for record in history_records:
+            for message in record.get('messages', []):
+                history_ids[message['id']] = max(int(record['id']), history_ids.get(message['id'], 0))
+            for item in record.get('messagesAdded', []):
+                added.append(item['message']['id'])
+            for item in record.get('messagesDeleted', []):
+                deleted.add(item['message']['id'])
+            for item in record.get('labelsAdded', []):
+                labels_added.append({'message_id': item['message']['id'], 'label_ids': item.get('labelIds', [])})
+            for item in record.get('labelsRemoved', []):
+                labels_removed.append({'message_id': item['message']['id'], 'label_ids': item.get('labelIds', [])})
+
+        added_ids = list(dict.fromkeys(message_id for message_id in added if message_id not in deleted))
+        skipped = deleted.union(added_ids)
+        return {
+            'added': added_ids,
+            'history_ids': {message_id: history_ids[message_id] for message_id in added_ids if message_id in history_ids},
+            'deleted': list(deleted),
+            'labels_added': [change for change in labels_added if change['message_id'] not in skipped],
+            'labels_removed': [change for change in labels_removed if change['message_id'] not in skipped],
+        }
 
-        return self.resources
+    """
+    Generator function which fetches the changes to the mailbox since the given history id
+    Arguments:
+        start_history_id -> (str) -> history id stored at the end of the previous sync
+    Returns: 
+        changes -> (dict) -> yields added messages, deleted message ids and label changes per page,
+                             along with the history id to store as the next sync cursor
+    Raises:
+        SyncCursorExpired -> when gmail no longer has history for the given id and a full sync is needed
+    """
+    def fetch_history(self, start_history_id):
+        next_page_token = None
+        page_num = 1
+        while True:
+            try:
+                self.acquire_quota(QUOTA_UNITS['history.list'])
+                with metrics.timer('gmail_api_request_seconds', method='history.list'):
+                    response = self.gmail_service.users().history().list(
+                        userId=self.user_email or self.ingestion_filters.user_id,
+                        startHistoryId=start_history_id,
+                        historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+                        maxResults=self.ingestion_filters.max_results,
+                        pageToken=next_page_token
+                    ).execute()
+            except HttpError as error:
+                if error.resp.status == 404:
+                    raise SyncCursorExpired(f"History id {start_history_id} is no longer available") from error
+                raise error
+
+            next_page_token = response.get('nextPageToken')
+            changes = self.construct_history_changes(response.get('history', []))
+            changes['messages'] = self.get_message_in_batch(changes['added'], history_ids=changes['history_ids'])
+            changes['history_id'] = response.get('historyId')
+
+            logger.info(
+                f"Fetched history page {page_num} with {len(changes['messages'])} added, "
+                f"{len(changes['deleted'])} deleted messages"
+            )
+            page_num += 1
+            yield changes
+
+            if not next_page_token:
+                break
+
+
+class PipelinedGmailFetcher(GmailFetcher):
+    """
+    Gmail fetcher which overlaps listing pages, fetching message batches and persisting them
+    A lister thread pages through message ids and submits each page to a bounded worker pool,
+    fetched batches are handed to the consumer through a bounded queue. Listing blocks once
+    max_pending_batches batches are in flight or waiting to be consumed
+    Arguments:
+        gmail_service       ()    -> gmail service object
+        user_email          (str) -> user email for which emails will be fetched
+        ingestion_interval  (IngestionInterval) -> start and end date
+        ingestion_filters   (IngestionFilters)  -> filters for fetching emails
+        global_quota        (TokenBucket) -> quota budget shared with the fetchers of other users, if any
+        message_cache       (MessageCache) -> cache of raw messages consulted before fetching, if any
+        max_workers         (int) -> number of batches executed concurrently
+        max_pending_batches (int) -> number of batches fetched ahead of the consumer
+    Returns: 
+        None
+    """
+    def __init__(self, gmail_service, user_email=None, ingestion_interval=None, ingestion_filters=None,
+                 global_quota=None, message_cache=None, max_workers=4, max_pending_batches=8):
+        super().__init__(gmail_service, user_email, ingestion_interval, ingestion_filters, global_quota, message_cache)
+        self.max_workers = max_workers
+        self.max_pending_batches = max(max_pending_batches, max_workers)
+        self.thread_local = threading.local()
+
+    """
+    httplib2 connections are not thread safe, so each worker executes its batches on its own
+    authorized http object built from the service credentials
+    Arguments:
+        None
+    Returns: 
+        http -> (httplib2.Http) -> http object of the current thread, None to use the service's
+    """
+    def get_thread_http(self):
+        credentials = getattr(self.gmail_service._http, 'credentials', None)
+        if credentials is None:
+            return None
+        if not hasattr(self.thread_local, 'http'):
+            import httplib2
+            import google_auth_httplib2
+            self.thread_local.http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+        return self.thread_local.http
+
+    """
+    Worker task fetching a batch of messages and handing it to the consumer
+    Arguments:
+        message_ids -> (list) -> message ids of a listed page
+        results     -> (queue.Queue) -> queue consumed by fetch_messages
+    Returns: 
+        None
+    """
+    def fetch_batch(self, message_ids, results):
+        try:
+            with metrics.timer('stage_seconds', stage='fetch'):
+                resources = self.get_message_in_batch(message_ids, http=self.get_thread_http())
+            results.put(resources)
+        except Exception as err:
+            results.put(err)
+
+    """
+    Lister thread paging through message ids and submitting batches to the worker pool
+    A listing error is handed to the consumer after the batches already submitted, so a failed
+    listing is never mistaken for a complete one, and the end of the results is always signalled
+    Arguments:
+        results  -> (queue.Queue) -> queue consumed by fetch_messages
+        in_flight -> (threading.Semaphore) -> released by the consumer for every batch it takes
+        stopped  -> (threading.Event) -> set when the consumer stops early
+    Returns: 
+        None
+    """
+    def list_and_dispatch(self, results, in_flight, stopped):
+        next_page_token = None
+        page_num = 1
+        error = None
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                while not stopped.is_set():
+                    try:
+                        message_ids, next_page_token = self.list_messages_page(next_page_token)
+                    except Exception as err:
+                        logger.error(f"Failed to list messages: {err}")
+                        error = err
+                        break
+
+                    while not in_flight.acquire(timeout=1):
+                        if stopped.is_set():
+                            return
+                    pool.submit(self.fetch_batch, message_ids, results)
+                    logger.info(f"Dispatched message batch page {page_num} with {len(message_ids)} messages")
+                    page_num += 1
+
+                    if not next_page_token:
+                        break
+        except Exception as err:
+            error = err
+        finally:
+            for item in ([error] if error else []) + [None]:
+                # The consumer stops reading once it stopped, the queue may then stay full
+                while not stopped.is_set():
+                    try:
+                        results.put(item, timeout=1)
+                        break
+                    except queue.Full:
+                        continue
+
+    """
+    Generator function which yields message batches as the worker pool fetches them
+    Batches are yielded in completion order, not page order
+    Arguments:
+        None
+    Returns: 
+        resources -> (list) -> yields list of fetched resources
+    """
+    def fetch_messages(self):
+        results = queue.Queue(maxsize=self.max_pending_batches)
+        in_flight = threading.BoundedSemaphore(self.max_pending_batches)
+        stopped = threading.Event()
+        lister = threading.Thread(target=self.list_and_dispatch, args=(results, in_flight, stopped), daemon=True)
+        lister.start()
+        try:
+            while True:
+                resources = results.get()
+                if resources is None:
+                    break
+                # Listing errors hold no slot, the generator ends on any error so the slot is not released
+                if isinstance(resources, Exception):
+                    raise resources
+                in_flight.release()
+                yield resources
+        finally:
+            stopped.set()
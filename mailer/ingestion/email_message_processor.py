@@ -1,37 +1,125 @@
-import os
 import logging
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
-import django
-django.setup()
+from mailer.utils.django_setup import setup_django
+setup_django()
 
 from datetime import datetime
-from django.db import transaction
+from django.db import transaction, connection
+from django.db.models import Q
 from db.models import Message, User, UserMessage, Label, MessageHeaderValues
+from mailer.utils.metrics import metrics
 logger = logging.getLogger('mailer.gmail_message_processor')
 logger.setLevel(logging.INFO)
 
+class CopyRowStream:
+    """
+    File like object streaming rows in the text format of postgres COPY
+    Rows are encoded as they are read, so the payload is never held in memory as a whole
+    Arguments:
+        rows -> (iterable of tuple) -> row values, None is written as NULL
+    Returns:
+        None
+    """
+    ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = b''
+
+    def encode_row(self, row):
+        values = ('\\N' if value is None else str(value).translate(self.ESCAPES) for value in row)
+        return ('\t'.join(values) + '\n').encode('utf-8')
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.buffer += self.encode_row(row)
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+
 class GmailMessageProcessor:
-    recipient = None
+    """
+    Initialize processor persisting the messages of a recipient, all state is per instance so
+    processors of several recipients can run side by side
+    Arguments:
+        recipient      -> (django object) -> django object of recipient, set by register_recipient
+        bulk_loader    -> (str) -> orm or copy, see bulk_insert
+        rule_evaluator -> (RuleEvaluator) -> rules applied to messages as they are persisted
+    Returns: 
+        None
+    """
+    def __init__(self, recipient=None, bulk_loader='orm', rule_evaluator=None):
+        self.recipient = recipient
+        self.bulk_loader = bulk_loader
+        self.rule_evaluator = rule_evaluator
+        # Messages written by process_messages, used to report throughput
+        self.processed_count = 0
+
     """
     Populates message and associated tables for given list of messages
     Arguments:
         messages_data -> (list of dict) -> messages returned by gmail api
     Returns: 
-        None
+        matched_ids -> (list) -> google message ids matching the rule evaluator, if one is set
     """
-    @classmethod
-    def process_messages(cls, messages_data):
-        with transaction.atomic():
-            cls.create_senders(messages_data)
-            cls.create_messages(messages_data)
+    def process_messages(self, messages_data):
+        if not messages_data:
+            return []
+        with metrics.timer('stage_seconds', stage='persist'), transaction.atomic():
+            with metrics.timer('db_step_seconds', step='create_senders'):
+                sender_pks = self.create_senders(messages_data)
+            with metrics.timer('db_step_seconds', step='create_messages'):
+                message_pks, created_message_ids = self.create_messages(messages_data)
 
-            # Bulk create is not returning pk, need to check why. Filtering as a hack
-            created_messages = Message.objects.filter(message_id__in=[message_data['id'] for message_data in messages_data])
+            with metrics.timer('db_step_seconds', step='create_message_labels'):
+                self.create_message_labels(message_pks, messages_data)
+            # Existing messages already have their sender and recipient rows
+            with metrics.timer('db_step_seconds', step='create_user_messages'):
+                self.create_user_messages(
+                    message_pks, sender_pks,
+                    [message_data for message_data in messages_data if message_data['id'] in created_message_ids]
+                )
+            with metrics.timer('db_step_seconds', step='create_message_headers'):
+                self.create_message_headers(message_pks, messages_data)
+        self.processed_count += len(messages_data)
+        metrics.increment('messages_processed_total', len(messages_data))
 
-            cls.create_message_labels(created_messages, messages_data)
-            cls.create_user_messages(created_messages, messages_data) 
-            cls.create_message_headers(created_messages, messages_data)
+        if not self.rule_evaluator:
+            return []
+        return self.rule_evaluator.matching_ids(
+            [message_data for message_data in messages_data if message_data['id'] in message_pks]
+        )
     
+    """
+    Applies a page of mailbox changes fetched through the history api
+    Arguments:
+        changes -> (dict) -> added messages, deleted message ids and label changes
+    Returns: 
+        matched_ids -> (list) -> google message ids of added messages matching the rule evaluator
+    """
+    def process_history(self, changes):
+        with transaction.atomic():
+            matched_ids = self.process_messages(changes['messages'])
+            self.delete_messages(changes['deleted'])
+            self.update_message_labels(changes['labels_added'], changes['labels_removed'])
+        return matched_ids
+
+    """
+    Stores the history id from which the next incremental sync starts
+    Arguments:
+        history_id -> (str) -> history id returned by gmail api
+    Returns: 
+        None
+    """
+    def update_sync_cursor(self, history_id):
+        User.objects.filter(pk=self.recipient.pk).update(last_history_id=history_id)
+        self.recipient.last_history_id = history_id
+        logger.info(f"Updated sync cursor to {history_id} for {self.recipient.email}")
+
     """
     Initally registers the recipient for which message are processed
     Arguments:
@@ -39,21 +127,53 @@ class GmailMessageProcessor:
     Returns: 
         recipient -> (django object) -> django object of recipient
     """
-    @classmethod
-    def register_recipient(cls, recipient_email):
-        cls.recipient, _ = User.objects.get_or_create(email=recipient_email, username=recipient_email)
-        logger.info(f"Registered recipient {cls.recipient.email}")
-        return cls.recipient
+    def register_recipient(self, recipient_email):
+        self.recipient, _ = User.objects.get_or_create(email=recipient_email, username=recipient_email)
+        logger.info(f"Registered recipient {self.recipient.email}")
+        return self.recipient
+
+    """
+    Inserts rows ignoring conflicts and resolves the primary keys of both the inserted and
+    the already existing rows in a single statement
+    Arguments:
+        model      -> (django model) -> model of the table to insert into
+        columns    -> (list) -> field names of the row values
+        rows       -> (list of tuple) -> row values in the order of columns
+        key_column -> (str)  -> unique field identifying a row
+    Returns: 
+        row_pks -> (dict) -> key column value to (primary key, inserted) of the row
+    """
+    @staticmethod
+    def insert_returning_pks(model, columns, rows, key_column):
+        if not rows:
+            return {}
+        table = connection.ops.quote_name(model._meta.db_table)
+        column_names = ", ".join(connection.ops.quote_name(model._meta.get_field(column).column) for column in columns)
+        key = connection.ops.quote_name(model._meta.get_field(key_column).column)
+        pk = connection.ops.quote_name(model._meta.pk.column)
+        placeholders = ", ".join(f"({', '.join(['%s'] * len(columns))})" for _ in rows)
+        query = (
+            f"WITH data ({column_names}) AS (VALUES {placeholders}), "
+            f"inserted AS ("
+            f"INSERT INTO {table} ({column_names}) SELECT * FROM data ON CONFLICT DO NOTHING RETURNING {pk}, {key}"
+            f") "
+            f"SELECT {key}, {pk}, true FROM inserted "
+            f"UNION ALL "
+            f"SELECT existing.{key}, existing.{pk}, false FROM {table} existing JOIN data ON existing.{key} = data.{key}"
+        )
+        metrics.increment('db_rows_written_total', len(rows), table=model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(query, [value for row in rows for value in row])
+            return {row_key: (row_pk, inserted) for row_key, row_pk, inserted in cursor.fetchall()}
 
     """
     From the list of messages get the list of senders and populate users table
     Arguments:
         messages_data -> (list of dict) -> messages returned by gmail api
     Returns: 
-        users -> (list of django object) -> django object of users
+        sender_pks -> (dict) -> email of the sender to primary key of the user
     """
-    @classmethod
-    def create_senders(cls, messages_data):
+    def create_senders(self, messages_data):
         users = set()
         # Ignoring cc, bcc to add support later
         for message in messages_data:
@@ -62,13 +182,11 @@ class GmailMessageProcessor:
                     users.add(header['value'])
 
         try:
-            user_objs = [
-                User(email=email_id,username=email_id)
-                for email_id in users
-            ]
-            User.objects.bulk_create(user_objs, ignore_conflicts=True)
-            logger.info(f"Populated message senders for recipient {cls.recipient.email}")
-            return users
+            user_pks = self.insert_returning_pks(
+                User, ['email', 'username'], [(email_id, email_id) for email_id in users], 'email'
+            )
+            logger.info(f"Populated message senders for recipient {self.recipient.email}")
+            return {email_id: pk for email_id, (pk, _) in user_pks.items()}
         except Exception as err:
             raise err
 
@@ -80,8 +198,7 @@ class GmailMessageProcessor:
     Returns: 
         None
     """
-    @classmethod
-    def create_labels(cls, user, label_data):
+    def create_labels(self, user, label_data):
         mail_labels = label_data.get('labels', [])
         labels = [
             Label(
@@ -96,125 +213,229 @@ class GmailMessageProcessor:
         ]
         try:
             Label.objects.bulk_create(labels, ignore_conflicts=True)
-            logger.info(f"Populated static message labels for recipient {cls.recipient.email}")
+            logger.info(f"Populated static message labels for recipient {self.recipient.email}")
         except Exception as err:
             raise err
 
     """
     From the list of messages get the list of messages and populate messages table
+    Messages which conflict with an existing message or thread are left out of the result
     Arguments:
         messages_data -> (list of dict) -> messages returned by gmail api
     Returns: 
-        None
+        message_pks         -> (dict) -> google message id to primary key of the message
+        created_message_ids -> (set)  -> google message ids inserted by this call
     """
-    @classmethod
-    def create_messages(cls, messages_data):
-        messages = [
-            Message(
-                message_id=message_data['id'],
-                thread_id=message_data['threadId'],
-                history_id=message_data['historyId'],
-                size_estimate=message_data['sizeEstimate'],
-                internal_date=datetime.fromtimestamp(int(message_data['internalDate']) / 1000),
-                snippet=message_data['snippet']
-            )
-            for message_data in messages_data
-        ]
+    def create_messages(self, messages_data):
+        header_names = list(Message.HEADER_COLUMNS)
+        messages = []
+        for message_data in messages_data:
+            headers = {}
+            for header in message_data['payload']['headers']:
+                headers.setdefault(header['name'], []).append(header['value'])
+            messages.append((
+                message_data['id'],
+                message_data['threadId'],
+                message_data['historyId'],
+                message_data['sizeEstimate'],
+                datetime.fromtimestamp(int(message_data['internalDate']) / 1000),
+                message_data['snippet'],
+                *(
+                    Message.HEADER_VALUE_SEPARATOR.join(headers[header_name]) if header_name in headers else None
+                    for header_name in header_names
+                ),
+            ))
         try:
-            Message.objects.bulk_create(messages, ignore_conflicts=True)
-            logger.info(f"Populated messages for recipient {cls.recipient.email}")
+            row_pks = self.insert_returning_pks(
+                Message,
+                [
+                    'message_id', 'thread_id', 'history_id', 'size_estimate', 'internal_date', 'snippet',
+                    *Message.HEADER_COLUMNS.values()
+                ],
+                messages,
+                'message_id'
+            )
+            logger.info(f"Populated messages for recipient {self.recipient.email}")
+            message_pks = {message_id: pk for message_id, (pk, _) in row_pks.items()}
+            created_message_ids = {message_id for message_id, (_, inserted) in row_pks.items() if inserted}
+            return message_pks, created_message_ids
         except Exception as err:
             raise err
 
     """
     From the list of messages get the list of labels and associate it to messages
     Arguments:
-        messages      -> (list of django objects) -> message objects in db
+        message_pks   -> (dict) -> google message id to primary key of the message
         messages_data -> (list of dict) -> messages returned by gmail api
     Returns: 
         None
     """
-    @classmethod
-    def create_message_labels(cls, messages, message_data):
-        message_labels = []
+    def create_message_labels(self, message_pks, message_data):
+        message_labels = set()
         for message in message_data:
-            message_labels.extend(message['labelIds'])
+            message_labels.update(message.get('labelIds', []))
 
-        label_objects = Label.objects.filter(label_name__in=message_labels)
-        grouped_label_objects = {obj.name: obj for obj in label_objects}
+        grouped_label_pks = dict(Label.objects.filter(name__in=message_labels).values_list('name', 'pk'))
 
+        MessageLabel = Message.labels.through
+        label_rows = [
+            MessageLabel(message_id=message_pks[message['id']], label_id=grouped_label_pks[label_id])
+            for message in message_data if message['id'] in message_pks
+            for label_id in message.get('labelIds', []) if label_id in grouped_label_pks
+        ]
         try:
-            for message_obj, raw_message in zip(messages, message_data):
-                raw_message_labels = raw_message['labelIds']
-                message_label_objects = [grouped_label_objects[label_id] for label_id in raw_message_labels]
-                message_obj.labels.add(*message_label_objects)
-            logger.info(f"Populated message labels table for {cls.recipient.email}")
+            MessageLabel.objects.bulk_create(label_rows, ignore_conflicts=True)
+            metrics.increment('db_rows_written_total', len(label_rows), table=MessageLabel._meta.db_table)
+            logger.info(f"Populated message labels table for {self.recipient.email}")
         except Exception as err:
             raise err
 
     """
     From the list of messages get the list of senders, recipents and associate it to messages
     Arguments:
-        messages      -> (list of django objects) -> message objects in db
+        message_pks   -> (dict) -> google message id to primary key of the message
+        sender_pks    -> (dict) -> email of the sender to primary key of the user
         messages_data -> (list of dict) -> messages returned by gmail api
     Returns: 
         None
     """
-    @classmethod
-    def create_user_messages(cls, messages, message_data):
-        users = {'sender': []}
-        user_msg_map = []
-        grouped_msg_objects = {obj.message_id: obj for obj in messages}
-
-        for message in message_data:
-            sender = None
-            for header in message['payload']['headers']:
-                if header['name'] in ['From']:
-                    sender = header['value']
-                    users['sender'].append(sender)
-
-
-            user_msg_map.append({'sender': sender, 'message': message['id']})
-        
-        user_objects = User.objects.filter(email__in=users['sender'])
-        grouped_user_objects = {obj.email: obj for obj in user_objects}
-
-        user_messages = []
-        for msg_map in user_msg_map:
-            sender_obj = grouped_user_objects.get(msg_map.get('sender'))
-            recipient_obj = cls.recipient
-            message_obj = grouped_msg_objects.get(msg_map.get('message'))
-            user_messages.extend(
-                 [
-                     UserMessage(user_id=sender_obj, message_id=message_obj, user_type=UserMessage.UserTypes.SENDER),
-                     UserMessage(user_id=recipient_obj, message_id=message_obj, user_type=UserMessage.UserTypes.RECIPIENT)
-                ]
-            )
+    def create_user_messages(self, message_pks, sender_pks, message_data):
+        def user_message_rows():
+            for message in message_data:
+                message_pk = message_pks.get(message['id'])
+                if not message_pk:
+                    continue
+                for header in message['payload']['headers']:
+                    if header['name'] in ['From'] and header['value'] in sender_pks:
+                        yield (sender_pks[header['value']], message_pk, UserMessage.UserTypes.SENDER.value)
+                yield (self.recipient.pk, message_pk, UserMessage.UserTypes.RECIPIENT.value)
 
         try:
-            UserMessage.objects.bulk_create(user_messages)    
-            logger.info(f"Populated user message table for {cls.recipient.email}")
+            self.bulk_insert(UserMessage, ['user_id', 'message_id', 'user_type'], user_message_rows())
+            logger.info(f"Populated user message table for {self.recipient.email}")
         except Exception as err:
             raise err
 
     """
     From the list of message headers and populate message headers table
     Arguments:
-        messages      -> (list of django objects) -> message objects in db
+        message_pks   -> (dict) -> google message id to primary key of the message
         messages_data -> (list of dict) -> messages returned by gmail api
     Returns: 
         None
     """
-    @classmethod
-    def create_message_headers(cls, messages, message_data):
-        message_headers = []
-        for message_obj, raw_message in zip(messages, message_data):
-            for header in raw_message['payload']['headers']:
-                message_headers.append(
-                    MessageHeaderValues(message_id=message_obj, header=header['name'], value=header['value'])
-                )
+    def create_message_headers(self, message_pks, message_data):
+        def message_header_rows():
+            for raw_message in message_data:
+                message_pk = message_pks.get(raw_message['id'])
+                if not message_pk:
+                    continue
+                for header in raw_message['payload']['headers']:
+                    yield (message_pk, header['name'], header['value'])
+
         try:
-            MessageHeaderValues.objects.bulk_create(message_headers, ignore_conflicts=True)
-            logger.info(f"Populated message headers table for {cls.recipient.email}")
+            self.bulk_insert(MessageHeaderValues, ['message_id', 'header', 'value'], message_header_rows())
+            logger.info(f"Populated message headers table for {self.recipient.email}")
+        except Exception as err:
+            raise err
+
+    """
+    Inserts rows ignoring conflicts using the configured bulk loader
+        orm  -> builds model instances and inserts them with bulk_create
+        copy -> streams the rows with COPY into a temporary staging table and merges them into
+                the table, skipping rows that conflict or are already present
+    Arguments:
+        model   -> (django model) -> model of the table to insert into
+        columns -> (list) -> field names of the row values
+        rows    -> (iterable of tuple) -> row values in the order of columns
+    Returns: 
+        None
+    """
+    def bulk_insert(self, model, columns, rows):
+        fields = [model._meta.get_field(column) for column in columns]
+        if self.bulk_loader == 'orm':
+            objects = [model(**{field.attname: value for field, value in zip(fields, row)}) for row in rows]
+            model.objects.bulk_create(objects, ignore_conflicts=True)
+            metrics.increment('db_rows_written_total', len(objects), table=model._meta.db_table)
+            return
+
+        quote_name = connection.ops.quote_name
+        table = quote_name(model._meta.db_table)
+        staging_table = quote_name(f"{model._meta.db_table}_staging")
+        column_names = ", ".join(quote_name(field.column) for field in fields)
+        # Tables without a unique constraint on the row values would accept duplicates on conflict
+        match_existing = " AND ".join(
+            f"existing.{quote_name(field.column)} = staging.{quote_name(field.column)}" for field in fields
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TEMPORARY TABLE IF NOT EXISTS {staging_table} AS "
+                f"SELECT {column_names} FROM {table} WITH NO DATA"
+            )
+            cursor.execute(f"TRUNCATE {staging_table}")
+            cursor.copy_expert(f"COPY {staging_table} ({column_names}) FROM STDIN", CopyRowStream(rows))
+            # Rows streamed to the staging table, as counted by COPY
+            metrics.increment('db_rows_written_total', max(cursor.rowcount, 0), table=model._meta.db_table)
+            cursor.execute(
+                f"INSERT INTO {table} ({column_names}) "
+                f"SELECT DISTINCT {column_names} FROM {staging_table} staging "
+                f"WHERE NOT EXISTS (SELECT 1 FROM {table} existing WHERE {match_existing}) "
+                f"ON CONFLICT DO NOTHING"
+            )
+
+    """
+    Deletes messages removed from the mailbox, associated rows are removed by cascade
+    Arguments:
+        message_ids -> (list) -> google message ids
+    Returns: 
+        None
+    """
+    def delete_messages(self, message_ids):
+        if not message_ids:
+            return
+        try:
+            Message.objects.filter(message_id__in=message_ids).delete()
+            logger.info(f"Deleted {len(message_ids)} messages for {self.recipient.email}")
+        except Exception as err:
+            raise err
+
+    """
+    Applies label additions and removals to already stored messages
+    Arguments:
+        labels_added   -> (list of dict) -> message id and the label ids added to it
+        labels_removed -> (list of dict) -> message id and the label ids removed from it
+    Returns: 
+        None
+    """
+    def update_message_labels(self, labels_added, labels_removed):
+        changes = labels_added + labels_removed
+        if not changes:
+            return
+
+        message_ids = {change['message_id'] for change in changes}
+        label_ids = {label_id for change in changes for label_id in change['label_ids']}
+        grouped_message_pks = dict(Message.objects.filter(message_id__in=message_ids).values_list('message_id', 'pk'))
+        grouped_label_pks = dict(Label.objects.filter(name__in=label_ids).values_list('name', 'pk'))
+
+        def label_pairs(label_changes):
+            for change in label_changes:
+                message_pk = grouped_message_pks.get(change['message_id'])
+                for label_id in change['label_ids']:
+                    label_pk = grouped_label_pks.get(label_id)
+                    if message_pk and label_pk:
+                        yield message_pk, label_pk
+
+        MessageLabel = Message.labels.through
+        try:
+            MessageLabel.objects.bulk_create(
+                [MessageLabel(message_id=message_pk, label_id=label_pk) for message_pk, label_pk in label_pairs(labels_added)],
+                ignore_conflicts=True
+            )
+            removed_query = Q()
+            for message_pk, label_pk in label_pairs(labels_removed):
+                removed_query |= Q(message_id=message_pk, label_id=label_pk)
+            if removed_query:
+                MessageLabel.objects.filter(removed_query).delete()
+            logger.info(f"Updated labels of {len(message_ids)} messages for {self.recipient.email}")
         except Exception as err:
             raise err
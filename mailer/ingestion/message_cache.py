@@ -0,0 +1,186 @@
+import json
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger('mailer.message_cache')
+
+
+# Bumped when the table layout changes, caches of older layouts are dropped and refilled
+SCHEMA_VERSION = 2
+
+
+class MessageCache:
+    """
+    On disk cache of the raw messages returned by gmail api, stored in sqlite keyed by user, message
+    id, history id and format. A message's history id changes with its labels, so a cached message is
+    only served for the exact history id the caller knows the message is at
+    Payloads are stored as compressed json, the least recently used entries are evicted once the
+    payloads exceed max_bytes. The file may be shared by several users, each only sees its messages
+    Arguments:
+        path       -> (str) -> sqlite database file
+        user_email -> (str) -> user the cached messages belong to
+        max_bytes  -> (int) -> size bound of the compressed payloads
+    Returns:
+        None
+    """
+    def __init__(self, path, user_email, max_bytes=1024 ** 3):
+        self.path = path
+        self.user_email = user_email
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Shared by the fetch workers of the process, every access holds the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            # Entries of the older layout have no user, they cannot be attributed and are dropped
+            self.connection.execute("DROP TABLE IF EXISTS messages")
+            self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "user_email TEXT NOT NULL, message_id TEXT NOT NULL, history_id INTEGER NOT NULL, format TEXT NOT NULL, "
+            "payload BLOB NOT NULL, size INTEGER NOT NULL, accessed_at REAL NOT NULL, "
+            "PRIMARY KEY (user_email, message_id, format, history_id))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS messages_accessed_at_idx ON messages (accessed_at)")
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM messages").fetchone()[0]
+
+    """
+    Key of the format messages were fetched in, metadata responses only hold the requested headers
+    Arguments:
+        message_format   -> (str)  -> metadata or full
+        metadata_headers -> (list) -> headers requested with the metadata format
+    Returns:
+        format_key -> (str)
+    """
+    @staticmethod
+    def format_key(message_format, metadata_headers=None):
+        if message_format == 'metadata':
+            return f"metadata:{','.join(sorted(metadata_headers or []))}"
+        return message_format
+
+    """
+    Reads the cached responses of messages at the given history ids, a message cached at another
+    history id may carry stale labels and is not served
+    Arguments:
+        history_ids -> (dict) -> google message id to the history id the message is known to be at
+        format_key  -> (str)  -> format the messages are needed in
+    Returns:
+        messages -> (dict) -> google message id to the message, for the cached ones
+    """
+    def get_many(self, history_ids, format_key):
+        if not history_ids:
+            return {}
+        keys = list(history_ids.items())
+        messages = {}
+        with self.lock:
+            for idx in range(0, len(keys), 400):
+                chunk = keys[idx:idx + 400]
+                rows = self.connection.execute(
+                    f"SELECT message_id, payload FROM messages WHERE user_email = ? AND format = ? AND "
+                    f"(message_id, history_id) IN (VALUES {', '.join('(?, ?)' for _ in chunk)})",
+                    [self.user_email, format_key, *(value for key in chunk for value in (key[0], int(key[1])))]
+                ).fetchall()
+                for message_id, payload in rows:
+                    messages[message_id] = json.loads(zlib.decompress(payload))
+            if messages:
+                self.connection.executemany(
+                    "UPDATE messages SET accessed_at = ? WHERE user_email = ? AND message_id = ? AND format = ? "
+                    "AND history_id = ?",
+                    [
+                        (time.time(), self.user_email, message_id, format_key, int(history_ids[message_id]))
+                        for message_id in messages
+                    ]
+                )
+        return messages
+
+    """
+    Stores fetched messages and evicts the least recently used entries past the size bound
+    Arguments:
+        messages   -> (list of dict) -> messages returned by gmail api
+        format_key -> (str) -> format the messages were fetched in
+    Returns:
+        None
+    """
+    def put_many(self, messages, format_key):
+        if not messages:
+            return
+        now = time.time()
+        rows = []
+        for message in messages:
+            payload = zlib.compress(json.dumps(message, separators=(',', ':')).encode('utf-8'))
+            rows.append((self.user_email, message['id'], int(message['historyId']), format_key, payload, len(payload), now))
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.total_bytes += sum(row[5] for row in rows)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    """
+    Deletes the least recently used entries until the payloads fit in 90% of the size bound
+    Other processes may share the file, so the size is recomputed before evicting
+    Arguments:
+        None
+    Returns:
+        None
+    """
+    def evict(self):
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM messages").fetchone()[0]
+        target = self.max_bytes * 0.9
+        evicted = 0
+        cursor = self.connection.execute("SELECT rowid, size FROM messages ORDER BY accessed_at")
+        rowids = []
+        for rowid, size in cursor:
+            if self.total_bytes - evicted <= target:
+                break
+            rowids.append((rowid,))
+            evicted += size
+        cursor.close()
+        self.connection.executemany("DELETE FROM messages WHERE rowid = ?", rowids)
+        self.total_bytes -= evicted
+        logger.info(f"Evicted {len(rowids)} cached messages, {self.total_bytes} bytes cached")
+
+    """
+    Streams the latest cached response of every message of the user, to rebuild the db without gmail api
+    Arguments:
+        format_key -> (str) -> format of the messages, None for any format
+        batch_size -> (int) -> messages per batch
+    Returns:
+        messages -> (list of dict) -> yields batches of messages
+    """
+    def iter_messages(self, format_key=None, batch_size=500):
+        query = (
+            "SELECT payload FROM messages latest WHERE user_email = ? AND history_id = ("
+            "SELECT MAX(history_id) FROM messages other WHERE other.user_email = latest.user_email "
+            "AND other.message_id = latest.message_id AND other.format = latest.format)"
+        )
+        params = [self.user_email]
+        if format_key:
+            query += " AND format = ?"
+            params.append(format_key)
+        # A separate connection so the batches can be consumed while other threads use the cache
+        connection = sqlite3.connect(self.path)
+        try:
+            cursor = connection.execute(query, params)
+            seen = set()
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                batch = []
+                for (payload,) in rows:
+                    message = json.loads(zlib.decompress(payload))
+                    # A message cached in several formats is yielded once
+                    if message['id'] not in seen:
+                        seen.add(message['id'])
+                        batch.append(message)
+                if batch:
+                    yield batch
+        finally:
+            connection.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
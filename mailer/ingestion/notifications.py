@@ -0,0 +1,204 @@
+import sys
+import json
+import time
+import queue
+import base64
+import argparse
+import datetime
+import logging
+import threading
+import urllib.request
+from typing import Optional
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pydantic import BaseModel
+
+logger = logging.getLogger('mailer.notifications')
+
+
+class Notification(BaseModel):
+    email_address: str
+    history_id: int
+    # Epoch seconds the notification was published at, used to report the latency of the sync
+    published_at: Optional[float] = None
+    message_id: Optional[str] = None
+
+    """
+    Reads the notification of gmail out of a pub/sub push request body
+    Arguments:
+        envelope -> (dict) -> push request body, the message data is the base64 encoded
+                              json of emailAddress and historyId
+    Returns:
+        notification -> (Notification)
+    """
+    @classmethod
+    def from_push(cls, envelope):
+        message = envelope['message']
+        data = json.loads(base64.b64decode(message['data']))
+        published_at = None
+        if message.get('publishTime'):
+            published_at = datetime.datetime.fromisoformat(message['publishTime'].replace('Z', '+00:00')).timestamp()
+        return cls(
+            email_address=data['emailAddress'],
+            history_id=int(data['historyId']),
+            published_at=published_at,
+            message_id=message.get('messageId') or message.get('message_id'),
+        )
+
+    def to_push(self, subscription='projects/local/subscriptions/gmail'):
+        data = json.dumps({'emailAddress': self.email_address, 'historyId': self.history_id})
+        published_at = datetime.datetime.fromtimestamp(self.published_at or time.time(), datetime.timezone.utc)
+        return {
+            'message': {
+                'data': base64.b64encode(data.encode('utf-8')).decode('ascii'),
+                'messageId': self.message_id or str(time.time_ns()),
+                'publishTime': published_at.isoformat().replace('+00:00', 'Z'),
+            },
+            'subscription': subscription,
+        }
+
+
+class NotificationSource:
+    """
+    Source of mailbox change notifications consumed by the sync daemon
+    Implementations hand out notifications with get and are told with ack once they are applied
+    Arguments:
+        None
+    Returns:
+        None
+    """
+    def get(self, timeout=None):
+        raise NotImplementedError
+
+    """
+    Takes the notifications already waiting, so a burst of them is applied with a single sync
+    Arguments:
+        None
+    Returns:
+        notifications -> (list of Notification)
+    """
+    def drain(self):
+        notifications = []
+        while True:
+            notification = self.get(timeout=0)
+            if notification is None:
+                return notifications
+            notifications.append(notification)
+
+    def ack(self, notifications):
+        pass
+
+    def close(self):
+        pass
+
+
+class QueueNotificationSource(NotificationSource):
+    """
+    In process notification source, the local stand-in for a pub/sub subscription
+    Notifications are published to it directly, by tests, the replay service or the push listener
+    Arguments:
+        maxsize -> (int) -> notifications held before publishers block, 0 for no limit
+    Returns:
+        None
+    """
+    def __init__(self, maxsize=0):
+        self.notifications = queue.Queue(maxsize=maxsize)
+
+    def publish(self, notification):
+        self.notifications.put(notification)
+
+    def get(self, timeout=None):
+        try:
+            if timeout == 0:
+                return self.notifications.get_nowait()
+            return self.notifications.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class PushRequestHandler(BaseHTTPRequestHandler):
+    def reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        server = self.server
+        token = parse_qs(urlsplit(self.path).query).get('token', [None])[0]
+        if server.verification_token and token != server.verification_token:
+            logger.warning("Rejected push request with an invalid token")
+            return self.reply(403)
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            notification = Notification.from_push(json.loads(body))
+        except (ValueError, KeyError, TypeError) as err:
+            logger.error(f"Rejected malformed push request: {err}")
+            return self.reply(400)
+        server.source.publish(notification)
+        # Replying is the ack of a push subscription
+        self.reply(204)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class PushNotificationSource(QueueNotificationSource):
+    """
+    Notification source receiving the requests of a pub/sub push subscription on a local http listener
+    Push requests are acknowledged once queued, a notification lost to a crash is caught up with by
+    the next one since syncs start from the stored history id rather than the notified one
+    Arguments:
+        host               -> (str) -> interface to listen on
+        port               -> (int) -> port to listen on, 0 to pick a free one
+        verification_token -> (str) -> token the push endpoint url must carry as ?token=, None to accept any
+    Returns:
+        None
+    """
+    def __init__(self, host='127.0.0.1', port=8085, verification_token=None):
+        super().__init__()
+        self.server = ThreadingHTTPServer((host, port), PushRequestHandler)
+        self.server.source = self
+        self.server.verification_token = verification_token
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"Listening for push notifications on http://{host}:{self.server.server_port}/")
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+"""
+Sends a notification to a push endpoint the way pub/sub would, to drive a daemon locally
+Arguments:
+    url          -> (str) -> push endpoint, with its ?token= if it requires one
+    notification -> (Notification) -> notification to send
+Returns:
+    status -> (int) -> http status of the reply
+"""
+def publish_push(url, notification):
+    request = urllib.request.Request(
+        url, data=json.dumps(notification.to_push()).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}, method='POST'
+    )
+    with urllib.request.urlopen(request) as response:
+        return response.status
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a gmail change notification to a push endpoint")
+    parser.add_argument('url', help="push endpoint of the daemon, like http://127.0.0.1:8085/")
+    parser.add_argument('user_email', help="email address of the changed mailbox")
+    parser.add_argument('history_id', type=int, help="history id of the change")
+    args = parser.parse_args(sys.argv[1:])
+    status = publish_push(args.url, Notification(email_address=args.user_email, history_id=args.history_id))
+    print(f"Published notification, endpoint replied {status}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import time
+import random
+import logging
+import threading
+import multiprocessing
+
+logger = logging.getLogger('mailer.rate_limiter')
+
+# Gmail api quota units consumed per method and the per user limit
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    'messages.get': 5,
+    'messages.list': 5,
+    'history.list': 2,
+}
+USER_QUOTA_UNITS_PER_SECOND = 250
+# Per project limit of 1,200,000 units per minute
+PROJECT_QUOTA_UNITS_PER_SECOND = 20000
+BATCH_REQUEST_LIMIT = 100
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket tracking quota units, refilled continuously at the given rate
+    Arguments:
+        rate     -> (float) -> units added per second
+        capacity -> (float) -> maximum units that can be consumed in a burst, defaults to rate
+    Returns:
+        None
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    """
+    Blocks until the given units are available and consumes them
+    Requests larger than the capacity wait for a full bucket and are charged in full, leaving the
+    bucket in debt which later requests wait to be repaid, so the rate holds for any request size
+    Arguments:
+        units -> (float) -> quota units to consume
+    Returns:
+        waited -> (float) -> seconds spent waiting
+    """
+    def acquire(self, units):
+        required = min(units, self.capacity)
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= required:
+                    self.tokens -= units
+                    return waited
+                wait = (required - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    """
+    Empties the bucket, used when gmail reports the quota as exhausted, a debt is kept
+    Arguments:
+        None
+    Returns:
+        None
+    """
+    def drain(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(0, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Token bucket shared by processes, its state lives in shared memory guarded by a process lock
+    Used to hold processes syncing different users within a global quota budget, it is handed to
+    the processes when they are started
+    Arguments:
+        rate     -> (float) -> units added per second
+        capacity -> (float) -> maximum units that can be consumed in a burst, defaults to rate
+        context  -> (multiprocessing context) -> context the processes are started with
+    Returns:
+        None
+    """
+    def __init__(self, rate, capacity=None, context=multiprocessing):
+        self.rate = rate
+        self.capacity = capacity or rate
+        # tokens and updated_at, the monotonic clock is shared by the processes of a host
+        self.state = context.Array('d', [self.capacity, time.monotonic()])
+        self.lock = self.state.get_lock()
+
+    @property
+    def tokens(self):
+        return self.state[0]
+
+    @tokens.setter
+    def tokens(self, value):
+        self.state[0] = value
+
+    @property
+    def updated_at(self):
+        return self.state[1]
+
+    @updated_at.setter
+    def updated_at(self, value):
+        self.state[1] = value
+
+
+class AdaptiveBatchSize:
+    """
+    Thread safe batch size which grows additively while batches succeed and halves when rate limited
+    Arguments:
+        initial -> (int) -> starting batch size
+        minimum -> (int) -> smallest batch size
+        maximum -> (int) -> largest batch size, capped at the gmail batch request limit
+        step    -> (int) -> increment after a successful batch
+    Returns:
+        None
+    """
+    def __init__(self, initial=10, minimum=1, maximum=BATCH_REQUEST_LIMIT, step=10):
+        self.minimum = minimum
+        self.maximum = min(maximum, BATCH_REQUEST_LIMIT)
+        self.step = step
+        self.size = max(minimum, min(initial, self.maximum))
+        self.lock = threading.Lock()
+
+    @property
+    def current(self):
+        return self.size
+
+    def grow(self):
+        with self.lock:
+            self.size = min(self.maximum, self.size + self.step)
+
+    def shrink(self):
+        with self.lock:
+            self.size = max(self.minimum, self.size // 2)
+            logger.info(f"Reduced batch size to {self.size}")
+
+
+"""
+Checks if an error returned by gmail api is worth retrying
+Arguments:
+    error -> (HttpError) -> error of the request or of a batch sub request
+Returns:
+    retryable -> (bool) -> True for rate limit and server errors
+"""
+def is_retryable_error(error):
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status == 429 or (status and status >= 500):
+        return True
+    details = getattr(error, 'error_details', None)
+    if isinstance(details, list):
+        return any(isinstance(detail, dict) and detail.get('reason') in RATE_LIMIT_REASONS for detail in details)
+    return False
+
+
+"""
+Exponential backoff with full jitter
+Arguments:
+    attempt  -> (int)   -> retry attempt, starting from 1
+    base     -> (float) -> seconds to wait on the first attempt
+    max_wait -> (float) -> maximum seconds to wait
+Returns:
+    seconds -> (float) -> seconds to sleep before retrying
+"""
+def backoff_delay(attempt, base=1, max_wait=32):
+    return random.uniform(0, min(max_wait, base * 2 ** (attempt - 1)))
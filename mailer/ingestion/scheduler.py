@@ -0,0 +1,180 @@
+import json
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional, Union
+from typing_extensions import Literal
+from pydantic import BaseModel, EmailStr
+
+from mailer.ingestion.email_fetcher import GmailFetcher, PipelinedGmailFetcher, IngestionInterval, IngestionFilters
+from mailer.ingestion.email_message_processor import GmailMessageProcessor
+from mailer.ingestion.rate_limiter import (
+    SharedTokenBucket, USER_QUOTA_UNITS_PER_SECOND, PROJECT_QUOTA_UNITS_PER_SECOND
+)
+from mailer.ingestion.sync import sync
+
+logger = logging.getLogger('mailer.scheduler')
+
+# Quota budget shared by the worker processes, set when a worker starts
+global_quota = None
+
+
+class Account(BaseModel):
+    user_email: EmailStr
+    config_type: Literal['cli', 'file', 'replay']
+    # Credentials json, filepath to credentials json or directory of a replay mailbox
+    config_value: Union[dict, str]
+
+    def build_service(self):
+        # Only the client of the config type is loaded
+        if self.config_type == 'replay':
+            from mailer.replay.replay_service import ReplayGmailService
+            return ReplayGmailService.from_directory(self.config_value)
+        from mailer.authentication.authenticator import GoogleAuthenticator
+        if self.config_type == 'file':
+            return GoogleAuthenticator().from_file(self.config_value)
+        config = self.config_value if isinstance(self.config_value, dict) else json.loads(self.config_value)
+        return GoogleAuthenticator().from_config(config)
+
+
+class AccountReport(BaseModel):
+    user_email: str
+    messages: int = 0
+    seconds: float = 0
+    messages_per_second: float = 0
+    history_id: Optional[str] = None
+    error: Optional[str] = None
+
+
+"""
+Initializer of the worker processes
+Arguments:
+    quota -> (SharedTokenBucket) -> quota budget shared by the worker processes
+Returns:
+    None
+"""
+def init_worker(quota):
+    global global_quota
+    global_quota = quota
+    logging.basicConfig(level=logging.INFO)
+
+
+"""
+Syncs the mailbox of an account in a worker process, with state scoped to the account
+Arguments:
+    account -> (Account) -> account to sync
+    options -> (dict)    -> workers, message_format, bulk_loader, full_sync, user_quota and ingestion_interval
+Returns:
+    report -> (AccountReport) -> messages written and throughput of the sync, or the error it failed with
+"""
+def ingest_account(account, options):
+    started_at = time.monotonic()
+    processor = GmailMessageProcessor(bulk_loader=options['bulk_loader'])
+    try:
+        gmail_service = account.build_service()
+        if not gmail_service:
+            raise Exception("Error initializing gmail service")
+
+        ingestion_filters = IngestionFilters(
+            message_format=options['message_format'], quota_units_per_second=options['user_quota']
+        )
+        fetcher_args = (
+            gmail_service, account.user_email, options['ingestion_interval'], ingestion_filters, global_quota
+        )
+        if options['workers'] > 1:
+            ingestion = PipelinedGmailFetcher(*fetcher_args, max_workers=options['workers'])
+        else:
+            ingestion = GmailFetcher(*fetcher_args)
+
+        recipient = processor.register_recipient(account.user_email)
+        processor.create_labels(recipient, ingestion.fetch_labels() or {})
+        start_history_id = None if options['full_sync'] else recipient.last_history_id
+        history_id, _ = sync(ingestion, processor, start_history_id)
+        if history_id:
+            processor.update_sync_cursor(history_id)
+        error = None
+    except Exception as err:
+        logger.exception(f"Failed to sync {account.user_email}")
+        history_id, error = None, str(err)
+
+    seconds = time.monotonic() - started_at
+    return AccountReport(
+        user_email=account.user_email,
+        messages=processor.processed_count,
+        seconds=round(seconds, 3),
+        messages_per_second=round(processor.processed_count / seconds, 2) if seconds else 0,
+        history_id=history_id,
+        error=error,
+    )
+
+
+class IngestionScheduler:
+    """
+    Syncs many accounts, sharded across a pool of processes which each sync one account at a time
+    Every account is held to its own quota budget and all of them to a global budget shared by
+    the processes, since the per user limit of gmail would let a domain exceed the project limit
+    Arguments:
+        accounts           -> (list of Account) -> accounts to sync
+        processes          -> (int)  -> accounts synced concurrently
+        workers            -> (int)  -> message batches of an account fetched concurrently
+        message_format     -> (str)  -> gmail message format to fetch
+        bulk_loader        -> (str)  -> orm or copy
+        full_sync          -> (bool) -> ignore the stored sync cursors
+        user_quota         -> (int)  -> quota units per second of an account
+        global_quota       -> (int)  -> quota units per second of all the accounts
+        ingestion_interval -> (IngestionInterval) -> start and end date of full syncs
+    Returns:
+        None
+    """
+    def __init__(self, accounts, processes=4, workers=4, message_format='metadata', bulk_loader='orm',
+                 full_sync=False, user_quota=USER_QUOTA_UNITS_PER_SECOND,
+                 global_quota=PROJECT_QUOTA_UNITS_PER_SECOND, ingestion_interval=None):
+        self.accounts = accounts
+        self.processes = processes
+        self.global_quota = global_quota
+        self.options = {
+            'workers': workers,
+            'message_format': message_format,
+            'bulk_loader': bulk_loader,
+            'full_sync': full_sync,
+            'user_quota': user_quota,
+            'ingestion_interval': ingestion_interval or IngestionInterval(),
+        }
+
+    """
+    Syncs the accounts and logs the throughput of each one as it completes
+    Processes are spawned rather than forked so they do not share the db connections of the parent
+    Arguments:
+        None
+    Returns:
+        reports -> (list of AccountReport) -> reports in completion order
+    """
+    def run(self):
+        context = multiprocessing.get_context('spawn')
+        quota = SharedTokenBucket(self.global_quota, context=context)
+        reports = []
+        started_at = time.monotonic()
+        with ProcessPoolExecutor(
+            max_workers=self.processes, mp_context=context, initializer=init_worker, initargs=(quota,)
+        ) as pool:
+            futures = [pool.submit(ingest_account, account, self.options) for account in self.accounts]
+            for future in as_completed(futures):
+                report = future.result()
+                reports.append(report)
+                if report.error:
+                    logger.error(f"Failed to sync {report.user_email} after {report.seconds}s: {report.error}")
+                else:
+                    logger.info(
+                        f"Synced {report.messages} messages for {report.user_email} in {report.seconds}s "
+                        f"({report.messages_per_second} messages/s)"
+                    )
+
+        seconds = time.monotonic() - started_at
+        total = sum(report.messages for report in reports)
+        failed = sum(1 for report in reports if report.error)
+        logger.info(
+            f"Synced {total} messages for {len(reports) - failed} of {len(reports)} accounts in {seconds:.1f}s "
+            f"({total / seconds if seconds else 0:.2f} messages/s)"
+        )
+        return reports
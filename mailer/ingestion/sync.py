@@ -0,0 +1,80 @@
+import logging
+
+from mailer.ingestion.email_fetcher import SyncCursorExpired
+
+logger = logging.getLogger('mailer.sync')
+
+"""
+Lists and ingests the messages of the interval
+Arguments:
+    ingestion -> (GmailFetcher) -> fetcher of the user
+    processor -> (GmailMessageProcessor) -> processor of the user
+Returns:
+    history_id  -> (str)  -> history id read before listing, the next sync starts from it
+    matched_ids -> (list) -> google message ids matching the rules
+"""
+def full_sync(ingestion, processor):
+    # Reading the history id before listing so changes made while listing are replayed next run
+    profile = ingestion.fetch_profile() or {}
+    matched_ids = []
+    for message_batch in ingestion.fetch_messages():
+        matched_ids.extend(processor.process_messages(message_batch))
+    return profile.get('historyId'), matched_ids
+
+"""
+Ingests the changes of the mailbox since the last sync
+Arguments:
+    ingestion        -> (GmailFetcher) -> fetcher of the user
+    processor        -> (GmailMessageProcessor) -> processor of the user
+    start_history_id -> (str) -> history id of the last sync
+Returns:
+    history_id  -> (str)  -> latest history id, the next sync starts from it
+    matched_ids -> (list) -> google message ids of added messages matching the rules
+"""
+def incremental_sync(ingestion, processor, start_history_id):
+    history_id = None
+    matched_ids = []
+    for changes in ingestion.fetch_history(start_history_id):
+        matched_ids.extend(processor.process_history(changes))
+        # Every page reports the latest history id, keeping the first one as the changes
+        # after it are yet to be paged through
+        history_id = history_id or changes['history_id']
+    return history_id, matched_ids
+
+"""
+Syncs the changes since the given history id, falling back to a full sync without one or
+when it expired
+Arguments:
+    ingestion        -> (GmailFetcher) -> fetcher of the user
+    processor        -> (GmailMessageProcessor) -> processor of the user
+    start_history_id -> (str) -> history id of the last sync, None for a full sync
+Returns:
+    history_id  -> (str)  -> history id the next sync starts from
+    matched_ids -> (list) -> google message ids matching the rules
+"""
+def sync(ingestion, processor, start_history_id):
+    if start_history_id:
+        try:
+            logger.info(f"Syncing changes since history id {start_history_id}")
+            return incremental_sync(ingestion, processor, start_history_id)
+        except SyncCursorExpired as err:
+            logger.warning(f"{err}, falling back to full sync")
+    return full_sync(ingestion, processor)
+
+"""
+Same as sync, run by an AsyncSyncPipeline
+Arguments:
+    pipeline         -> (AsyncSyncPipeline) -> pipeline of the user
+    start_history_id -> (str) -> history id of the last sync, None for a full sync
+Returns:
+    history_id  -> (str)  -> history id the next sync starts from
+    matched_ids -> (list) -> google message ids matching the rules
+"""
+async def async_sync(pipeline, start_history_id):
+    if start_history_id:
+        try:
+            logger.info(f"Syncing changes since history id {start_history_id}")
+            return await pipeline.incremental_sync(start_history_id)
+        except SyncCursorExpired as err:
+            logger.warning(f"{err}, falling back to full sync")
+    return await pipeline.full_sync()
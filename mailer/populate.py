@@ -1,57 +1,165 @@
 
 import sys
 import json
+import argparse
 import datetime
 import logging
+from contextlib import nullcontext
 
-from mailer.authentication.authenticator import GoogleAuthenticator
-from mailer.ingestion.email_fetcher import GmailFetcher, IngestionInterval
-from mailer.ingestion.email_message_processor import GmailMessageProcessor
+from mailer.utils.metrics import metrics
 
+# Django, pydantic and the api clients are imported where they are first used, so --help does not
+# pay for them and a run only loads the gmail client its config type needs
 logger = logging.getLogger("mailer.populate")
 logging.basicConfig(level=logging.INFO)
 
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Populate gmail messages of a user in db")
+    parser.add_argument('user_email', help="email address of the user")
+    parser.add_argument('config_type', help="cli, file or replay")
+    parser.add_argument('config_value', help="credentials json, filepath to credentials json or directory of a replay mailbox")
+    parser.add_argument('--full-sync', action='store_true', help="ignore the stored sync cursor and list the whole interval")
+    parser.add_argument('--workers', type=int, default=4, help="message batches fetched concurrently, 1 fetches serially")
+    parser.add_argument('--format', choices=['metadata', 'full'], default='metadata', help="gmail message format to fetch")
+    parser.add_argument('--rules', help="rules json, only the headers its conditions reference are fetched")
+    parser.add_argument('--access-token', help="with --rules, apply the rule actions to matching messages as they are ingested")
+    parser.add_argument('--bulk-loader', choices=['orm', 'copy'], default='orm', help="how header and user message rows are written")
+    parser.add_argument('--message-cache', help="sqlite file caching raw messages, incremental syncs do not fetch again messages cached at their history id")
+    parser.add_argument('--message-cache-size', type=int, default=1024, help="megabytes of messages kept in the cache")
+    parser.add_argument('--rebuild-from-cache', action='store_true', help="populate the db from the message cache without calling gmail api")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="run fetching, persisting and actions as concurrent asyncio stages")
+    parser.add_argument('--metrics-file', help="file the run's metrics are written to, json if it ends with .json and prometheus text otherwise")
+    parser.add_argument('--profile-sql', action='store_true', help="capture the sql statements of the run with their timings")
+    parser.add_argument('--profile-report', help="with --profile-sql, json file the statements and query plans are written to")
+    return parser.parse_args(args)
+
 def initialize(args):
-    args = sys.argv[1:]
-    user_email, config_type, config_value = args
+    user_email, config_type, config_value = args.user_email, args.config_type, args.config_value
     
-    allowed_config_types = ['cli', 'file']
+    allowed_config_types = ['cli', 'file', 'replay']
     if config_type not in allowed_config_types:
         raise Exception(f"Invalid config type {config_type}, allowed types: {allowed_config_types}")
 
     gmail_service = None
-    if config_type == 'cli':
-        gmail_service = GoogleAuthenticator().from_config(json.loads(config_value))
-    elif config_type == 'file':
-        gmail_service = GoogleAuthenticator().from_file(config_value)
+    if config_type in ('cli', 'file'):
+        from mailer.authentication.authenticator import GoogleAuthenticator
+        if config_type == 'cli':
+            gmail_service = GoogleAuthenticator().from_config(json.loads(config_value))
+        else:
+            gmail_service = GoogleAuthenticator().from_file(config_value)
+    elif config_type == 'replay':
+        from mailer.replay.replay_service import ReplayGmailService
+        gmail_service = ReplayGmailService.from_directory(config_value)
     
     if not gmail_service:
         raise Exception("Error initializing gmail service")
     
     return user_email, gmail_service
 
-def main():
+def rebuild_from_cache(processor, message_cache):
+    processor.register_recipient(message_cache.user_email)
+    for message_batch in message_cache.iter_messages():
+        processor.process_messages(message_batch)
+    logger.info(f"Rebuilt {processor.processed_count} messages from cache")
 
-    user_email, gmail_service = initialize(sys.argv[1])
-    ingestion = GmailFetcher(
-        gmail_service,
-        user_email,
-        IngestionInterval(
-            start_date=(datetime.datetime.now() - datetime.timedelta(days=1)).date(),
-        )
+def populate(args):
+    from mailer.ingestion.email_fetcher import GmailFetcher, PipelinedGmailFetcher, IngestionInterval, IngestionFilters
+    from mailer.ingestion.email_message_processor import GmailMessageProcessor
+    from mailer.ingestion.message_cache import MessageCache
+    from mailer.ingestion.sync import sync
+
+    message_cache = None
+    if args.message_cache:
+        message_cache = MessageCache(args.message_cache, args.user_email, max_bytes=args.message_cache_size * 1024 ** 2)
+    if args.rebuild_from_cache:
+        if not message_cache:
+            raise Exception("--rebuild-from-cache requires --message-cache")
+        return rebuild_from_cache(GmailMessageProcessor(bulk_loader=args.bulk_loader), message_cache)
+
+    user_email, gmail_service = initialize(args)
+    ingestion_interval = IngestionInterval(
+        start_date=(datetime.datetime.now() - datetime.timedelta(days=1)).date(),
     )
+    ingestion_filters = IngestionFilters(message_format=args.format)
+    processor = GmailMessageProcessor(bulk_loader=args.bulk_loader)
+    rules_fetcher, actions = None, []
+    if args.rules:
+        from mailer.rules.rules_fetch import RulesFetch
+        from mailer.rules.rules_model import metadata_headers
+        from mailer.rules.rules_evaluator import RuleEvaluator
+        rules_fetcher = RulesFetch.read_rules_from_file(args.rules)
+        if not rules_fetcher:
+            raise Exception("Error initializing rules fetcher service")
+        rule_set, actions = rules_fetcher.construct_rules()
+        ingestion_filters.metadata_headers = metadata_headers(rule_set)
+        if args.access_token:
+            processor.rule_evaluator = RuleEvaluator(rule_set)
+
+    if args.workers > 1:
+        ingestion = PipelinedGmailFetcher(
+            gmail_service, user_email, ingestion_interval, ingestion_filters,
+            message_cache=message_cache, max_workers=args.workers
+        )
+    else:
+        ingestion = GmailFetcher(
+            gmail_service, user_email, ingestion_interval, ingestion_filters, message_cache=message_cache
+        )
 
     # Register sender
-    recipient = GmailMessageProcessor.register_recipient(user_email)
+    recipient = processor.register_recipient(user_email)
 
     # Updating user and system labels
     message_labels = ingestion.fetch_labels()
-    GmailMessageProcessor.create_labels(recipient, message_labels)
+    processor.create_labels(recipient, message_labels)
+
+    handler = None
+    if processor.rule_evaluator:
+        from mailer.actions.actions_handler import GmailActionsHandler
+        handler = GmailActionsHandler(None, rules_fetcher)
 
     # Processing messages
-    for message_batch in ingestion.fetch_messages():
-        GmailMessageProcessor.process_messages(message_batch)
+    start_history_id = None if args.full_sync else recipient.last_history_id
+    if args.use_async:
+        import asyncio
+        from mailer.ingestion.async_pipeline import AsyncSyncPipeline
+        from mailer.ingestion.sync import async_sync
+        # Actions are applied by the pipeline while messages are ingested
+        pipeline = AsyncSyncPipeline(
+            ingestion, processor, handler, actions, args.access_token, max_workers=args.workers
+        )
+        history_id, matched_ids = asyncio.run(async_sync(pipeline, start_history_id))
+    else:
+        history_id, matched_ids = sync(ingestion, processor, start_history_id)
+
+    if history_id:
+        processor.update_sync_cursor(history_id)
 
     logger.info("Successfully populated messages in db")
 
-main()
\ No newline at end of file
+    if handler and matched_ids and not args.use_async:
+        handler.dispatch_actions(actions, matched_ids, args.access_token)
+        logger.info(f"Successfully dispatched actions for {len(matched_ids)} ingested messages matching rules")
+
+def main():
+
+    args = parse_args(sys.argv[1:])
+    profiler = None
+    if args.profile_sql:
+        from mailer.utils.sql_profiler import SQLProfiler
+        profiler = SQLProfiler()
+    try:
+        with profiler.profile() if profiler else nullcontext():
+            populate(args)
+    finally:
+        if profiler:
+            # Explaining runs more queries, which fail too when the run failed on the db, its error is the one raised
+            try:
+                profiler.explain_captured()
+            except Exception:
+                logger.exception("Failed to explain the captured statements")
+            profiler.log_report(args.profile_report)
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+            logger.info(f"Wrote metrics to {args.metrics_file}")
+
+main()
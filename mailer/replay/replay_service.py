@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import random
+import datetime
+import logging
+import httplib2
+from googleapiclient.errors import HttpError
+
+logger = logging.getLogger('mailer.replay')
+
+MAILBOX_FILE = 'mailbox.json'
+MESSAGES_FILE = 'messages.jsonl'
+
+
+"""
+Builds the error gmail api would return
+Arguments:
+    status  -> (int) -> http status
+    reason  -> (str) -> reason of the error detail
+    message -> (str) -> error message
+Returns:
+    error -> (HttpError)
+"""
+def replay_error(status, reason, message):
+    content = json.dumps({'error': {'code': status, 'message': message, 'errors': [{'reason': reason}]}})
+    return HttpError(httplib2.Response({'status': status}), content.encode('utf-8'), uri='replay')
+
+
+class ReplayRequest:
+    """
+    Request returned by the replay resources, executed like a googleapiclient HttpRequest
+    Arguments:
+        service -> (ReplayGmailService) -> service the request was built from
+        handler -> (callable) -> builds the response, raises HttpError on failure
+    Returns:
+        None
+    """
+    def __init__(self, service, handler):
+        self.service = service
+        self.handler = handler
+
+    def execute(self, http=None, num_retries=0):
+        self.service.simulate_latency()
+        return self.handler()
+
+
+class ReplayBatch:
+    """
+    Batch request executing its requests in order and invoking their callbacks like
+    googleapiclient BatchHttpRequest, sub requests may fail with rate limit errors when the
+    service simulates them
+    Arguments:
+        service -> (ReplayGmailService) -> service the batch was built from
+    Returns:
+        None
+    """
+    def __init__(self, service):
+        self.service = service
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request, callback, request_id or str(len(self.requests) + 1)))
+
+    def execute(self, http=None):
+        self.service.simulate_latency()
+        for request, callback, request_id in self.requests:
+            try:
+                if self.service.rate_limited():
+                    raise replay_error(429, 'rateLimitExceeded', 'Too many concurrent requests for user')
+                response, exception = request.handler(), None
+            except HttpError as error:
+                response, exception = None, error
+            if callback:
+                callback(request_id, response, exception)
+
+
+class ReplayResource:
+    """
+    Resource exposing the replay methods under the names of the gmail api resources
+    Arguments:
+        methods -> (dict) -> method name to callable
+    Returns:
+        None
+    """
+    def __init__(self, **methods):
+        self.__dict__.update(methods)
+
+
+class ReplayGmailService:
+    """
+    Stand in for the gmail service object serving a recorded or synthetic mailbox from disk, so
+    ingestion can run without an account and its throughput be measured reproducibly
+    Implements the calls made by GmailFetcher: labels list, getProfile, messages list with
+    pagination and date queries, messages get in full, metadata and minimal format, history list,
+    watch and batch requests. Messages delivered while watched are notified like gmail would
+    through a pub/sub topic, by calling notify with the email address and the new history id
+    Arguments:
+        mailbox         -> (dict) -> email address, history id, labels and history records
+        messages        -> (list of dict) -> messages in full format
+        latency         -> (float) -> seconds every request and batch takes
+        rate_limit_rate -> (float) -> share of batch sub requests failing with a rate limit error
+        seed            -> (int)   -> seed of the simulated rate limit errors
+    Returns:
+        None
+    """
+    def __init__(self, mailbox, messages, latency=0, rate_limit_rate=0, seed=0):
+        self.mailbox = mailbox
+        # Gmail lists messages newest first
+        self.messages = sorted(messages, key=lambda message: int(message['internalDate']), reverse=True)
+        self.messages_by_id = {message['id']: message for message in self.messages}
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.random = random.Random(seed)
+        # GmailFetcher workers look for credentials on the http object to build their own
+        self._http = None
+        self.watch_topic = None
+        self.notify = None
+
+    """
+    Alternative constructor reading a mailbox written by write_mailbox
+    Arguments:
+        directory -> (str) -> directory holding mailbox.json and messages.jsonl
+    Returns:
+        service -> (ReplayGmailService)
+    """
+    @classmethod
+    def from_directory(cls, directory, **kwargs):
+        with open(os.path.join(directory, MAILBOX_FILE)) as mailbox_file:
+            mailbox = json.load(mailbox_file)
+        with open(os.path.join(directory, MESSAGES_FILE)) as messages_file:
+            messages = [json.loads(line) for line in messages_file if line.strip()]
+        logger.info(f"Loaded replay mailbox {mailbox.get('emailAddress')} with {len(messages)} messages")
+        return cls(mailbox, messages, **kwargs)
+
+    def simulate_latency(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def rate_limited(self):
+        return self.rate_limit_rate and self.random.random() < self.rate_limit_rate
+
+    def users(self):
+        return ReplayResource(
+            labels=lambda: ReplayResource(list=self.list_labels),
+            messages=lambda: ReplayResource(list=self.list_messages, get=self.get_message),
+            history=lambda: ReplayResource(list=self.list_history),
+            getProfile=self.get_profile,
+            watch=self.watch,
+        )
+
+    def new_batch_http_request(self, callback=None):
+        return ReplayBatch(self)
+
+    def list_labels(self, userId=None):
+        return ReplayRequest(self, lambda: {'labels': self.mailbox.get('labels', [])})
+
+    def get_profile(self, userId=None):
+        return ReplayRequest(self, lambda: {
+            'emailAddress': self.mailbox.get('emailAddress'),
+            'messagesTotal': len(self.messages),
+            'historyId': self.mailbox.get('historyId'),
+        })
+
+    """
+    Filters the messages by the after: and before: terms of a query, other terms are ignored
+    Arguments:
+        query -> (str) -> gmail search query
+    Returns:
+        messages -> (list of dict) -> matching messages, newest first
+    """
+    def search(self, query):
+        after_ms, before_ms = None, None
+        for term in (query or '').split():
+            name, _, value = term.partition(':')
+            if name not in ('after', 'before'):
+                continue
+            date = datetime.datetime.strptime(value.replace('/', '-'), '%Y-%m-%d')
+            if name == 'after':
+                after_ms = int(date.timestamp() * 1000)
+            else:
+                before_ms = int(date.timestamp() * 1000)
+        return [
+            message for message in self.messages
+            if (after_ms is None or int(message['internalDate']) >= after_ms)
+            and (before_ms is None or int(message['internalDate']) < before_ms)
+        ]
+
+    def list_messages(self, userId=None, q=None, maxResults=100, pageToken=None, **kwargs):
+        def handler():
+            messages = self.search(q)
+            start = int(pageToken or 0)
+            end = start + min(maxResults or 100, 500)
+            response = {
+                'messages': [{'id': message['id'], 'threadId': message['threadId']} for message in messages[start:end]],
+                'resultSizeEstimate': len(messages),
+            }
+            if end < len(messages):
+                response['nextPageToken'] = str(end)
+            return response
+        return ReplayRequest(self, handler)
+
+    def get_message(self, userId=None, id=None, format='full', metadataHeaders=None, **kwargs):
+        def handler():
+            message = self.messages_by_id.get(id)
+            if message is None:
+                raise replay_error(404, 'notFound', 'Requested entity was not found.')
+            response = {key: value for key, value in message.items() if key != 'payload'}
+            if format == 'full':
+                response['payload'] = message['payload']
+            elif format == 'metadata':
+                names = {header.lower() for header in metadataHeaders or []}
+                response['payload'] = {
+                    'mimeType': message['payload'].get('mimeType'),
+                    'headers': [
+                        header for header in message['payload']['headers']
+                        if not names or header['name'].lower() in names
+                    ],
+                }
+            return response
+        return ReplayRequest(self, handler)
+
+    def list_history(self, userId=None, startHistoryId=None, historyTypes=None, maxResults=100, pageToken=None, **kwargs):
+        def handler():
+            history = self.mailbox.get('history', [])
+            oldest = int(history[0]['id']) if history else int(self.mailbox.get('historyId', 0))
+            if int(startHistoryId) < oldest - 1:
+                raise replay_error(404, 'notFound', 'Requested entity was not found.')
+            records = [record for record in history if int(record['id']) > int(startHistoryId)]
+            start = int(pageToken or 0)
+            end = start + min(maxResults or 100, 500)
+            response = {'history': records[start:end], 'historyId': self.mailbox.get('historyId')}
+            if end < len(records):
+                response['nextPageToken'] = str(end)
+            return response
+        return ReplayRequest(self, handler)
+
+    def watch(self, userId=None, body=None):
+        def handler():
+            self.watch_topic = (body or {}).get('topicName')
+            expiration_ms = int((time.time() + 7 * 24 * 60 * 60) * 1000)
+            return {'historyId': self.mailbox.get('historyId'), 'expiration': str(expiration_ms)}
+        return ReplayRequest(self, handler)
+
+    """
+    Adds a message to the mailbox as a new history record, and notifies the change when watched
+    Arguments:
+        message -> (dict) -> message in full format
+    Returns:
+        history_id -> (str) -> history id of the change
+    """
+    def deliver(self, message):
+        history_id = str(int(self.mailbox.get('historyId', 0)) + 1)
+        message = dict(message, historyId=history_id)
+        # Replaced rather than mutated, so requests being served keep a consistent view
+        self.messages = [message, *self.messages]
+        self.messages_by_id = dict(self.messages_by_id, **{message['id']: message})
+        reference = {'id': message['id'], 'threadId': message['threadId'], 'labelIds': message.get('labelIds', [])}
+        self.mailbox['history'] = [
+            *self.mailbox.get('history', []),
+            {'id': history_id, 'messages': [reference], 'messagesAdded': [{'message': reference}]},
+        ]
+        self.mailbox['historyId'] = history_id
+        if self.watch_topic and self.notify:
+            self.notify(self.mailbox.get('emailAddress'), int(history_id))
+        return history_id
+
+
+"""
+Writes a mailbox in the layout read by ReplayGmailService.from_directory
+Arguments:
+    directory -> (str)  -> directory to write to, created if missing
+    mailbox   -> (dict) -> email address, history id, labels and history records
+    messages  -> (iterable of dict) -> messages in full format
+Returns:
+    None
+"""
+def write_mailbox(directory, mailbox, messages):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, MAILBOX_FILE), 'w') as mailbox_file:
+        json.dump(mailbox, mailbox_file, indent=2)
+    with open(os.path.join(directory, MESSAGES_FILE), 'w') as messages_file:
+        for message in messages:
+            messages_file.write(json.dumps(message, separators=(',', ':')) + '\n')
@@ -0,0 +1,207 @@
+import sys
+import time
+import random
+import argparse
+import logging
+from email.utils import formatdate
+
+from mailer.replay.replay_service import write_mailbox
+
+logger = logging.getLogger('mailer.synthetic_mailbox')
+
+SYSTEM_LABELS = [
+    'INBOX', 'UNREAD', 'STARRED', 'IMPORTANT', 'SENT', 'DRAFT', 'SPAM', 'TRASH',
+    'CATEGORY_PERSONAL', 'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES', 'CATEGORY_FORUMS',
+]
+# Category of a message and the share of messages in it
+CATEGORY_WEIGHTS = {
+    'CATEGORY_PERSONAL': 0.25, 'CATEGORY_UPDATES': 0.3, 'CATEGORY_PROMOTIONS': 0.3,
+    'CATEGORY_SOCIAL': 0.1, 'CATEGORY_FORUMS': 0.05,
+}
+SUBJECT_TEMPLATES = {
+    'CATEGORY_PERSONAL': ['Lunch on {day}?', 'Notes from our call', 'Photos from the weekend', 'Quick question about {topic}'],
+    'CATEGORY_UPDATES': ['Your order #{number} has shipped', 'Invoice {number} for {month}', 'Security alert for your account',
+                         'Your {topic} report is ready', 'Build #{number} failed on main'],
+    'CATEGORY_PROMOTIONS': ['{percent}% off everything this {day}', 'Last chance: {topic} sale ends tonight',
+                            'New arrivals picked for you', 'Savings on {topic} inside'],
+    'CATEGORY_SOCIAL': ['{name} mentioned you in a comment', '{name} sent you a connection request', 'You have {number} new notifications'],
+    'CATEGORY_FORUMS': ['[{topic}] Weekly digest', 'Re: [{topic}] Proposal for the next release', '[{topic}] New thread started by {name}'],
+}
+TOPICS = ['billing', 'travel', 'deploy', 'design review', 'quarterly planning', 'shoes', 'electronics', 'python', 'postgres', 'hiring']
+NAMES = ['Alice', 'Bob', 'Carol', 'Dave', 'Erin', 'Frank', 'Grace', 'Heidi', 'Ivan', 'Judy', 'Mallory', 'Niaj', 'Olivia', 'Peggy']
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'weekend']
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December']
+DOMAINS = ['gmail.com', 'example.com', 'shop.example.net', 'news.example.org', 'github.com', 'linkedin.com', 'bank.example.com']
+
+
+class SyntheticMailbox:
+    """
+    Generates a synthetic mailbox with header distributions close to real ones: senders follow a
+    zipf distribution so a few newsletters and colleagues send most messages, messages fall into
+    gmail categories driving their subjects and labels, replies share threads, and every message
+    carries the transport headers (Received, DKIM-Signature, ...) making up most of a real header set
+    Arguments:
+        user_email -> (str) -> address of the mailbox
+        count      -> (int) -> number of messages
+        days       -> (float) -> messages are spread over the last days
+        senders    -> (int) -> number of distinct senders
+        reply_rate -> (float) -> share of messages replying to a recent thread
+        seed       -> (int) -> seed of the generator, the same seed generates the same messages dated relative to now
+    Returns:
+        None
+    """
+    def __init__(self, user_email, count, days=1, senders=500, reply_rate=0.2, seed=0):
+        self.user_email = user_email
+        self.count = count
+        self.days = days
+        self.reply_rate = reply_rate
+        self.random = random.Random(seed)
+        self.now_ms = int(time.time() * 1000)
+        self.senders = [self.make_sender(idx) for idx in range(senders)]
+        # Zipf weights, the sender of rank n sends 1 / n as many messages as the top sender
+        self.sender_weights = [1 / rank for rank in range(1, senders + 1)]
+        self.user_labels = [
+            {'id': f'Label_{idx}', 'name': name, 'type': 'user',
+             'messageListVisibility': 'show', 'labelListVisibility': 'labelShow'}
+            for idx, name in enumerate(['Receipts', 'Travel', 'Work', 'Newsletters'], start=1)
+        ]
+
+    def make_sender(self, idx):
+        name = self.random.choice(NAMES)
+        category = self.random.choices(list(CATEGORY_WEIGHTS), weights=list(CATEGORY_WEIGHTS.values()))[0]
+        domain = self.random.choice(DOMAINS)
+        local = f"{name.lower()}.{idx}" if category == 'CATEGORY_PERSONAL' else f"no-reply-{idx}"
+        return {'address': f"{local}@{domain}", 'display': f"{name} <{local}@{domain}>", 'category': category}
+
+    def subject(self, category):
+        template = self.random.choice(SUBJECT_TEMPLATES[category])
+        return template.format(
+            day=self.random.choice(DAYS), topic=self.random.choice(TOPICS), name=self.random.choice(NAMES),
+            number=self.random.randint(1000, 99999), month=self.random.choice(MONTHS),
+            percent=self.random.choice([10, 15, 20, 30, 50]),
+        )
+
+    def labels(self, category):
+        labels = [category]
+        if category != 'CATEGORY_PROMOTIONS' or self.random.random() < 0.3:
+            labels.append('INBOX')
+        if self.random.random() < 0.4:
+            labels.append('UNREAD')
+        if self.random.random() < 0.05:
+            labels.append('STARRED')
+        if category in ('CATEGORY_PERSONAL', 'CATEGORY_UPDATES') and self.random.random() < 0.3:
+            labels.append('IMPORTANT')
+        if self.random.random() < 0.1:
+            labels.append(self.random.choice(self.user_labels)['id'])
+        return labels
+
+    def headers(self, idx, sender, subject, internal_date_ms, thread):
+        date = formatdate(internal_date_ms / 1000)
+        sender_domain = sender['address'].split('@')[1]
+        headers = [
+            {'name': 'Delivered-To', 'value': self.user_email},
+            *(
+                {'name': 'Received', 'value': f"from mail{hop}.{sender_domain} by mx.google.com; {date}"}
+                for hop in range(self.random.randint(2, 5))
+            ),
+            {'name': 'ARC-Seal', 'value': f"i=1; a=rsa-sha256; t={internal_date_ms // 1000}; cv=none; d=google.com"},
+            {'name': 'Return-Path', 'value': f"<{sender['address']}>"},
+            {'name': 'DKIM-Signature', 'value': f"v=1; a=rsa-sha256; d={sender_domain}; s=selector1; bh={idx:x}"},
+            {'name': 'MIME-Version', 'value': '1.0'},
+            {'name': 'Date', 'value': date},
+            {'name': 'Message-ID', 'value': f"<{idx:08x}.{internal_date_ms}@{sender_domain}>"},
+            {'name': 'Subject', 'value': subject},
+            {'name': 'From', 'value': sender['display']},
+            {'name': 'To', 'value': self.user_email},
+            {'name': 'Content-Type', 'value': 'multipart/alternative; boundary="000000000000boundary"'},
+        ]
+        if sender['category'] == 'CATEGORY_PERSONAL' and self.random.random() < 0.2:
+            headers.append({'name': 'Cc', 'value': ', '.join(s['address'] for s in self.random.sample(self.senders, 2))})
+        if sender['category'] in ('CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES', 'CATEGORY_FORUMS'):
+            headers.append({'name': 'List-Unsubscribe', 'value': f"<mailto:unsubscribe@{sender_domain}>"})
+        if thread is not None:
+            headers.append({'name': 'In-Reply-To', 'value': thread['message_id']})
+            headers.append({'name': 'References', 'value': thread['message_id']})
+        return headers
+
+    """
+    Generates the messages, oldest first
+    Arguments:
+        None
+    Returns:
+        messages -> (list of dict) -> messages in the full format of gmail api
+    """
+    def messages(self):
+        span_ms = int(self.days * 24 * 60 * 60 * 1000)
+        dates = sorted(self.now_ms - self.random.randrange(span_ms) for _ in range(self.count))
+        threads = []
+        messages = []
+        for idx, internal_date_ms in enumerate(dates):
+            thread = self.random.choice(threads[-50:]) if threads and self.random.random() < self.reply_rate else None
+            if thread is None:
+                sender = self.random.choices(self.senders, weights=self.sender_weights)[0]
+                subject = self.subject(sender['category'])
+            else:
+                sender = thread['sender']
+                subject = f"Re: {thread['subject']}"
+            message_id = f"{internal_date_ms:x}{idx:06x}"
+            headers = self.headers(idx, sender, subject, internal_date_ms, thread)
+            if thread is None:
+                message_id_header = next(header['value'] for header in headers if header['name'] == 'Message-ID')
+                thread = {'id': message_id, 'sender': sender, 'subject': subject, 'message_id': message_id_header}
+                threads.append(thread)
+            messages.append({
+                'id': message_id,
+                'threadId': thread['id'],
+                'labelIds': self.labels(sender['category']),
+                'snippet': f"{subject} - {' '.join(self.random.choices(TOPICS, k=8))}"[:200],
+                'historyId': str(1000 + idx),
+                'internalDate': str(internal_date_ms),
+                # Log normal sizes, a few kilobytes with a long tail of large messages
+                'sizeEstimate': int(self.random.lognormvariate(9, 1)),
+                'payload': {'mimeType': 'multipart/alternative', 'headers': headers},
+            })
+        return messages
+
+    """
+    Generates the mailbox read by ReplayGmailService
+    Arguments:
+        None
+    Returns:
+        mailbox  -> (dict) -> email address, history id and labels
+        messages -> (list of dict) -> messages in full format
+    """
+    def generate(self):
+        messages = self.messages()
+        mailbox = {
+            'emailAddress': self.user_email,
+            'historyId': str(1000 + len(messages)),
+            'labels': [
+                {'id': label, 'name': label, 'type': 'system'} for label in SYSTEM_LABELS
+            ] + self.user_labels,
+            'history': [],
+        }
+        return mailbox, messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic mailbox replayed with the replay config type")
+    parser.add_argument('directory', help="directory the mailbox is written to")
+    parser.add_argument('--messages', type=int, default=10000, help="number of messages")
+    parser.add_argument('--days', type=float, default=1, help="messages are spread over the last days")
+    parser.add_argument('--senders', type=int, default=500, help="number of distinct senders")
+    parser.add_argument('--reply-rate', type=float, default=0.2, help="share of messages replying to a recent thread")
+    parser.add_argument('--user-email', default='replay@example.com', help="address of the mailbox")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(sys.argv[1:])
+
+    mailbox, messages = SyntheticMailbox(
+        args.user_email, args.messages, days=args.days, senders=args.senders, reply_rate=args.reply_rate, seed=args.seed
+    ).generate()
+    write_mailbox(args.directory, mailbox, messages)
+    logger.info(f"Wrote {len(messages)} messages to {args.directory}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,86 @@
+from collections import deque
+
+
+class PatternMatcher:
+    """
+    Aho-Corasick automaton matching many substring patterns in a single pass over a text,
+    so the cost of scanning a header value does not grow with the number of conditions
+    Patterns are added with a key, search returns the keys of all patterns found in the text
+    Arguments:
+        None
+    Returns:
+        None
+    """
+    def __init__(self):
+        self.transitions = [{}]
+        self.failures = [0]
+        self.outputs = [set()]
+        self.built = False
+
+    """
+    Adds a pattern to the automaton, an empty pattern matches every text
+    Arguments:
+        pattern -> (str) -> substring to match
+        key     -> ()    -> value reported by search when the pattern is found
+    Returns:
+        None
+    """
+    def add(self, pattern, key):
+        state = 0
+        for char in pattern:
+            next_state = self.transitions[state].get(char)
+            if next_state is None:
+                next_state = len(self.transitions)
+                self.transitions.append({})
+                self.failures.append(0)
+                self.outputs.append(set())
+                self.transitions[state][char] = next_state
+            state = next_state
+        self.outputs[state].add(key)
+        self.built = False
+
+    """
+    Computes the failure links breadth first, merging the outputs of each state's failure state
+    Arguments:
+        None
+    Returns:
+        None
+    """
+    def build(self):
+        pending = deque()
+        for next_state in self.transitions[0].values():
+            self.failures[next_state] = 0
+            pending.append(next_state)
+
+        while pending:
+            state = pending.popleft()
+            for char, next_state in self.transitions[state].items():
+                failure = self.failures[state]
+                while failure and char not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                failure = self.transitions[failure].get(char, 0)
+                self.failures[next_state] = failure if failure != next_state else 0
+                self.outputs[next_state] |= self.outputs[self.failures[next_state]]
+                pending.append(next_state)
+        self.built = True
+
+    """
+    Finds the patterns contained in a text
+    Arguments:
+        text -> (str) -> text to scan
+    Returns:
+        keys -> (set) -> keys of the patterns found
+    """
+    def search(self, text):
+        if not self.built:
+            self.build()
+        transitions, failures, outputs = self.transitions, self.failures, self.outputs
+        found = set(outputs[0])
+        state = 0
+        for char in text:
+            while state and char not in transitions[state]:
+                state = failures[state]
+            state = transitions[state].get(char, 0)
+            if outputs[state]:
+                found |= outputs[state]
+        return found
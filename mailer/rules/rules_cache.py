@@ -0,0 +1,176 @@
+import os
+import pickle
+import hashlib
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger('mailer.rules_cache')
+
+# Bumped when the pickled artifact changes shape, artifacts of other versions are ignored
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'mailer', 'rules')
+# Modules validating and parsing the rules, artifacts validated by other versions of them are not reused
+RULES_SOURCES = ('rules_model.py', 'rules_fetch.py', 'rules_cache.py')
+sources_fingerprint = None
+
+
+"""
+Hash of the sources validating and parsing the rules, read once per process
+Arguments:
+    None
+Returns:
+    fingerprint -> (bytes) -> sha256 digest
+"""
+def rules_sources_fingerprint():
+    global sources_fingerprint
+    if sources_fingerprint is None:
+        digest = hashlib.sha256()
+        for source_name in RULES_SOURCES:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), source_name), 'rb') as source_file:
+                digest.update(source_file.read())
+        sources_fingerprint = digest.digest()
+    return sources_fingerprint
+
+
+"""
+Hash the compiled rules of a rules file are cached under, editing the file or upgrading the code
+validating it changes it
+Arguments:
+    content -> (bytes) -> content of the rules file
+Returns:
+    digest -> (str) -> sha256 hex digest
+"""
+def rules_digest(content):
+    return hashlib.sha256(rules_sources_fingerprint() + content).hexdigest()
+
+
+class CompiledRules:
+    """
+    Validated rules and actions of a rules file, along with the compiled forms of the rules kept
+    on the rule set, like the where clause of the rules query
+    Arguments:
+        digest   -> (str) -> content hash of the rules file
+        rule_set -> (RuleSet) -> validated rules
+        actions  -> (list of Action) -> validated actions
+    Returns:
+        None
+    """
+    def __init__(self, digest, rule_set, actions):
+        self.digest = digest
+        self.rule_set = rule_set
+        self.actions = actions
+        # Compiled forms already written to disk, so unchanged artifacts are not written again
+        self.saved_forms = frozenset()
+
+    @property
+    def unsaved(self):
+        return frozenset(self.rule_set.compiled_forms) != self.saved_forms
+
+
+class RulesCache:
+    """
+    Cache of compiled rules keyed by the content hash of their rules file, held in memory for the
+    process and pickled on disk for later runs, so they skip validating the rules and compiling the
+    rules query. An edited file hashes differently and is compiled again, the least recently used
+    artifacts are removed once there are more than max_entries
+    Artifacts are pickles, the directory is created private to the user and must not be shared
+    Arguments:
+        directory   -> (str) -> directory of the artifacts
+        max_entries -> (int) -> artifacts kept on disk
+    Returns:
+        None
+    """
+    # Shared by the caches of every directory, entries are keyed by content
+    compiled = {}
+    lock = threading.Lock()
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_entries=32):
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def path(self, digest):
+        return os.path.join(self.directory, f"{digest}.v{CACHE_VERSION}.pickle")
+
+    """
+    Reads the compiled rules of a rules file, from memory or else from disk
+    Arguments:
+        digest -> (str) -> content hash of the rules file
+    Returns:
+        compiled -> (CompiledRules) -> None when the rules were not compiled yet
+    """
+    def get(self, digest):
+        with self.lock:
+            compiled = self.compiled.get(digest)
+        if compiled is not None:
+            return compiled
+
+        path = self.path(digest)
+        try:
+            with open(path, 'rb') as artifact_file:
+                compiled = pickle.load(artifact_file)
+            # Marks the artifact as recently used for pruning
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        # Any failure to load the artifact, like classes it refers to having changed, is a cache miss
+        except Exception as err:
+            logger.warning(f"Ignoring unreadable compiled rules {path}: {err}")
+            return None
+        if not isinstance(compiled, CompiledRules) or compiled.digest != digest:
+            logger.warning(f"Ignoring compiled rules {path} of other rules")
+            return None
+
+        compiled.saved_forms = frozenset(compiled.rule_set.compiled_forms)
+        with self.lock:
+            self.compiled[digest] = compiled
+        logger.info(f"Loaded compiled rules {digest[:12]} from cache")
+        return compiled
+
+    """
+    Stores compiled rules in memory, and on disk unless the artifact there is up to date
+    Arguments:
+        compiled -> (CompiledRules) -> compiled rules to store
+    Returns:
+        None
+    """
+    def put(self, compiled):
+        with self.lock:
+            self.compiled[compiled.digest] = compiled
+        path = self.path(compiled.digest)
+        if not compiled.unsaved and os.path.exists(path):
+            return
+
+        saved_forms = frozenset(compiled.rule_set.compiled_forms)
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            # Written aside and renamed, so concurrent runs never read a partial artifact
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as artifact_file:
+                    pickle.dump(compiled, artifact_file, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as err:
+            logger.warning(f"Failed to cache compiled rules in {self.directory}: {err}")
+            return
+        compiled.saved_forms = saved_forms
+        logger.info(f"Cached compiled rules {compiled.digest[:12]} in {self.directory}")
+        self.prune()
+
+    def prune(self):
+        try:
+            artifacts = [
+                entry for entry in os.scandir(self.directory)
+                if entry.name.endswith('.pickle') and entry.is_file()
+            ]
+        except OSError:
+            return
+        artifacts.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in artifacts[self.max_entries:]:
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
@@ -0,0 +1,127 @@
+import time
+import logging
+import itertools
+from collections import Counter
+from mailer.rules.rules_model import Rule, field_header_map, iter_conditions
+from mailer.rules.pattern_matcher import PatternMatcher
+
+logger = logging.getLogger('mailer.rules_evaluator')
+
+DAY_MILLISECONDS = 24 * 60 * 60 * 1000
+# Headers with at least this many contains / not_contains conditions are scanned with a PatternMatcher
+MULTI_PATTERN_THRESHOLD = 4
+
+
+class RuleEvaluator:
+    """
+    Compiles a rule set into a predicate evaluated in memory on messages returned by gmail api,
+    so rules can be applied while messages are ingested without querying the db
+    Needles are lower cased and date thresholds computed once, when the evaluator is created
+    Arguments:
+        rule_set -> (RuleSet) -> Rules to evaluate
+        now      -> (float)   -> Epoch seconds the date conditions are relative to, defaults to now
+    Returns:
+        None
+    """
+    def __init__(self, rule_set, now=None):
+        self.now_ms = int((now or time.time()) * 1000)
+        substring_conditions = Counter(
+            field_header_map[condition.field] for condition in iter_conditions(rule_set.rules)
+            if condition.predicate in ('contains', 'not_contains')
+        )
+        # Header name to the automaton holding all its substring conditions
+        self.matchers = {
+            header_name: PatternMatcher() for header_name, count in substring_conditions.items()
+            if count >= MULTI_PATTERN_THRESHOLD
+        }
+        self.pattern_keys = itertools.count()
+        self.predicate = self.compile_rule(rule_set.rules, rule_set.predicate)
+        for matcher in self.matchers.values():
+            matcher.build()
+        logger.info(f"Compiled rules for in memory evaluation")
+
+    """
+    Compiles a condition into a predicate taking the lower cased headers, the received time of a message
+    and the keys of the patterns found in its headers
+    Header predicates hold when any value of the header satisfies them and the negated ones when none does
+    Arguments:
+        condition -> (Condition) -> Condition read from user input
+    Returns:
+        predicate -> (callable) -> predicate(headers, received_ms, found) -> bool
+    """
+    def compile_condition(self, condition):
+        field_name, predicate, field_value = condition.field, condition.predicate, condition.value
+
+        if field_name in ('date_received_days', 'date_received_months'):
+            days = field_value if field_name == 'date_received_days' else 30 * field_value
+            threshold_ms = self.now_ms - days * DAY_MILLISECONDS
+            # Received less than n days ago is received after the threshold
+            if predicate == 'lesser_than':
+                return lambda headers, received_ms, found: received_ms >= threshold_ms
+            return lambda headers, received_ms, found: received_ms <= threshold_ms
+
+        header_name = field_header_map[field_name]
+        needle = field_value.lower()
+        if predicate in ('contains', 'not_contains') and header_name in self.matchers:
+            key = next(self.pattern_keys)
+            self.matchers[header_name].add(needle, key)
+            if predicate == 'contains':
+                return lambda headers, received_ms, found: key in found
+            return lambda headers, received_ms, found: key not in found
+
+        if predicate == 'contains':
+            return lambda headers, received_ms, found: any(needle in value for value in headers.get(header_name, ()))
+        elif predicate == 'not_contains':
+            return lambda headers, received_ms, found: not any(needle in value for value in headers.get(header_name, ()))
+        elif predicate == 'equal':
+            return lambda headers, received_ms, found: needle in headers.get(header_name, ())
+        elif predicate == 'not_equal':
+            return lambda headers, received_ms, found: needle not in headers.get(header_name, ())
+        raise ValueError(f"Invalid predicate {predicate} for field {field_name}")
+
+    """
+    Compiles conditions and nested rules combined by a predicate into a single predicate
+    Arguments:
+        conditions -> (list of Condition or Rule) -> Conditions and nested rules read from user input
+        predicate  -> (str) -> all or any
+    Returns:
+        predicate -> (callable) -> predicate(headers, received_ms, found) -> bool
+    """
+    def compile_rule(self, conditions, predicate):
+        predicates = tuple(
+            self.compile_rule(condition.conditions, condition.predicate) if isinstance(condition, Rule)
+            else self.compile_condition(condition)
+            for condition in conditions
+        )
+        if predicate == 'all':
+            return lambda headers, received_ms, found: all(item(headers, received_ms, found) for item in predicates)
+        return lambda headers, received_ms, found: any(item(headers, received_ms, found) for item in predicates)
+
+    """
+    Checks if a message matches the rules
+    Arguments:
+        message -> (dict) -> message returned by gmail api
+    Returns:
+        matched -> (bool)
+    """
+    def matches(self, message):
+        headers = {}
+        for header in message['payload']['headers']:
+            headers.setdefault(header['name'], []).append(header['value'].lower())
+
+        # Every header value is scanned once for all the substring conditions on the header
+        found = set()
+        for header_name, matcher in self.matchers.items():
+            for value in headers.get(header_name, ()):
+                found |= matcher.search(value)
+        return self.predicate(headers, int(message['internalDate']), found)
+
+    """
+    Filters the messages matching the rules
+    Arguments:
+        messages -> (list of dict) -> messages returned by gmail api
+    Returns:
+        message_ids -> (list) -> google message ids of the matching messages
+    """
+    def matching_ids(self, messages):
+        return [message['id'] for message in messages if self.matches(message)]
@@ -1,6 +1,7 @@
 import json
 import logging
 from mailer.rules.rules_model import Condition, Rule, RuleSet, Action
+from mailer.rules.rules_cache import CompiledRules, rules_digest
 
 logger = logging.getLogger('mailer.rules')
 
@@ -9,41 +10,56 @@ class RulesFetch:
     Initialize rules fetcher
     Arguments:
         rules_data -> (list of dict) -> Initalize the list of rules
+        digest     -> (str) -> Content hash of the rules file, the compiled rules are cached under it
+        cache      -> (RulesCache) -> Cache of compiled rules, None to validate the rules on every run
     Returns: 
         None
     """
-    def __init__(self, rules_data):
+    def __init__(self, rules_data, digest=None, cache=None):
         self.rules_data = rules_data
+        self.digest = digest
+        self.cache = cache if digest else None
+        self.compiled = None
 
     """
     Alternate constructor to read rules from json fiel
     Arguments:
         rule_file_path -> (str) -> local file path of rules json
+        cache          -> (RulesCache) -> Cache of compiled rules, None to validate the rules on every run
     Returns: 
         None
     """
     @classmethod
-    def read_rules_from_file(cls, rule_file_path):
+    def read_rules_from_file(cls, rule_file_path, cache=None):
         try:
-            with open(rule_file_path, 'r') as rules_file:
-                rules_data = json.load(rules_file)
+            with open(rule_file_path, 'rb') as rules_file:
+                content = rules_file.read()
+            rules_data = json.loads(content)
             logger.info(f"Initializing rules from file")
-            return cls(rules_data)
+            return cls(rules_data, digest=rules_digest(content), cache=cache)
         except FileNotFoundError as file_err:
             logger.error(file_err)
         except ValueError as val_err:
             logger.error(val_err)
     """
-    Validate and construct conditions object
+    Validate and construct conditions object, entries with conditions of their own are nested rules
     Arguments:
         conditionss -> (list of dict)
     Returns: 
-        condition object -> (Condition)
+        condition object -> (list of Condition or Rule)
     """
     def construct_conditions(self, conditions):
         validated_conditions = []
         try:
             for condition in conditions:
+                if 'conditions' in condition:
+                    validated_conditions.append(
+                        Rule(
+                            conditions=self.construct_conditions(condition.get('conditions', [])),
+                            predicate=condition.get('predicate'),
+                        )
+                    )
+                    continue
                 validated_conditions.append(
                     Condition(
                         field=condition.get('field'), 
@@ -80,7 +96,7 @@ class RulesFetch:
             raise val_err
     
     """
-    Validate and construct rules and actions
+    Validate and construct rules and actions, once per rules file when they are cached
     Arguments:
         None
     Returns: 
@@ -88,6 +104,11 @@ class RulesFetch:
         actions  -> (Action)  -> List of actions to be invoked on filtered messages
     """
     def construct_rules(self):
+        if self.compiled is None and self.cache:
+            self.compiled = self.cache.get(self.digest)
+        if self.compiled is not None:
+            return self.compiled.rule_set, self.compiled.actions
+
         data = self.rules_data
         rules = data.get('rules', [])
         rule_predicate = data.get('predicate')
@@ -104,6 +125,19 @@ class RulesFetch:
                 )
             rule_set = RuleSet(rules=validated_rules, predicate=rule_predicate)
             action_set = self.construct_actions(actions)
-            return rule_set, action_set
         except ValueError as val_err:
             raise val_err
+        self.compiled = CompiledRules(self.digest, rule_set, action_set)
+        self.save_compiled()
+        return rule_set, action_set
+
+    """
+    Caches the compiled rules, along with the compiled forms added to the rule set since they were cached
+    Arguments:
+        None
+    Returns:
+        None
+    """
+    def save_compiled(self):
+        if self.cache and self.compiled is not None:
+            self.cache.put(self.compiled)
@@ -1,5 +1,5 @@
 
-from pydantic import BaseModel, field_validator
+from pydantic import BaseModel, PrivateAttr, field_validator
 from typing import Union, List
 from typing_extensions import Literal
 
@@ -10,6 +10,14 @@ field_datatype_map = {
     'date_received_days': int,
     'date_received_months': int,
 }
+# Message headers the header fields of a condition are matched against
+field_header_map = {
+    'from': 'From',
+    'to': 'To',
+    'subject': 'Subject',
+}
+# Headers needed during ingestion irrespective of rules, From populates the senders
+ingestion_headers = ('From', 'Date')
 predicate_datatype_map = {
     str: ['contains', 'not_contains', 'equal', 'not_equal'],
     int: ['lesser_than', 'greater_than'],
@@ -56,6 +64,40 @@ class Rule(BaseModel):
 class RuleSet(BaseModel):
     rules: List[Union[Condition, Rule]]
     predicate: Literal[rule_predicates]
+    # Compiled forms of the rules, like the query of EmailSearch, pickled along with the rule set
+    _compiled_forms: dict = PrivateAttr(default_factory=dict)
+
+    @property
+    def compiled_forms(self):
+        return self._compiled_forms
+
+"""
+Generator over the conditions of rules, including the ones of nested rules
+Arguments:
+    rules -> (list of Condition or Rule) -> Conditions and rules read from user input
+Returns:
+    conditions -> (Condition) -> yields every condition
+"""
+def iter_conditions(rules):
+    for item in rules:
+        if isinstance(item, Rule):
+            yield from iter_conditions(item.conditions)
+        else:
+            yield item
+
+"""
+Headers to request when fetching messages in metadata format
+Arguments:
+    rule_set -> (RuleSet) -> Rules whose condition fields are fetched, all header fields when None
+Returns:
+    headers -> (list) -> Header names
+"""
+def metadata_headers(rule_set=None):
+    fields = set(field_header_map)
+    if rule_set is not None:
+        fields = {condition.field for condition in iter_conditions(rule_set.rules)}
+    headers = [field_header_map[field] for field in field_header_map if field in fields]
+    return list(dict.fromkeys([*ingestion_headers, *headers]))
 
 class Action(BaseModel):
     attribute: Literal[action_attributes]
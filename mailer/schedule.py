@@ -0,0 +1,57 @@
+import sys
+import json
+import argparse
+import datetime
+import logging
+
+from mailer.ingestion.rate_limiter import USER_QUOTA_UNITS_PER_SECOND, PROJECT_QUOTA_UNITS_PER_SECOND
+
+logger = logging.getLogger("mailer.schedule")
+logging.basicConfig(level=logging.INFO)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Populate gmail messages of many users in db")
+    parser.add_argument('accounts', help="filepath to a json list of accounts with user_email, config_type and config_value")
+    parser.add_argument('--processes', type=int, default=4, help="accounts synced concurrently")
+    parser.add_argument('--workers', type=int, default=4, help="message batches of an account fetched concurrently")
+    parser.add_argument('--format', choices=['metadata', 'full'], default='metadata', help="gmail message format to fetch")
+    parser.add_argument('--bulk-loader', choices=['orm', 'copy'], default='orm', help="how header and user message rows are written")
+    parser.add_argument('--full-sync', action='store_true', help="ignore the stored sync cursors and list the whole interval")
+    parser.add_argument('--user-quota', type=int, default=USER_QUOTA_UNITS_PER_SECOND, help="quota units per second of an account")
+    parser.add_argument('--global-quota', type=int, default=PROJECT_QUOTA_UNITS_PER_SECOND, help="quota units per second of all the accounts")
+    parser.add_argument('--report', help="filepath the per account throughput is written to as json")
+    return parser.parse_args(args)
+
+def main():
+
+    args = parse_args(sys.argv[1:])
+    # Imported past argument parsing, so --help does not set up django
+    from mailer.ingestion.email_fetcher import IngestionInterval
+    from mailer.ingestion.scheduler import Account, IngestionScheduler
+
+    with open(args.accounts) as accounts_file:
+        accounts = [Account(**account) for account in json.load(accounts_file)]
+
+    scheduler = IngestionScheduler(
+        accounts,
+        processes=args.processes,
+        workers=args.workers,
+        message_format=args.format,
+        bulk_loader=args.bulk_loader,
+        full_sync=args.full_sync,
+        user_quota=args.user_quota,
+        global_quota=args.global_quota,
+        ingestion_interval=IngestionInterval(
+            start_date=(datetime.datetime.now() - datetime.timedelta(days=1)).date(),
+        ),
+    )
+    reports = scheduler.run()
+
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump([report.model_dump() for report in reports], report_file, indent=2)
+        logger.info(f"Wrote throughput report to {args.report}")
+
+# Worker processes are spawned and import this module, so it only runs as a script
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,45 @@
-import os
+import inspect
+import hashlib
 import logging
 import datetime
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
 import django
-django.setup()
-from django.db.models import Q, Count
+from mailer.utils.django_setup import setup_django
+setup_django()
+from django.core.exceptions import EmptyResultSet
+from django.db import connection
+from django.db.migrations.recorder import MigrationRecorder
+from django.db.models import Q, Exists, OuterRef, BooleanField, DateTimeField, ExpressionWrapper
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Lower, Now
 
-from db.models import MessageHeaderValues
+from db.models import Message, MessageHeaderValues
+from mailer.rules.rules_model import field_header_map, Rule, iter_conditions
+from mailer.rules.pattern_matcher import PatternMatcher
+from mailer.utils.metrics import metrics
 logger = logging.getLogger('mailer.email_search')
 
+
+class PatternSlot:
+    """
+    Parameter of a compiled rules query standing for the primary keys of the messages matching a
+    prefiltered substring condition, bound when the query is run since they depend on the messages in db
+    Arguments:
+        position -> (int) -> position of the condition in iter_conditions order
+    Returns:
+        None
+    """
+    def __init__(self, position):
+        self.position = position
+
+
 class EmailSearch:
+    # Match from, to and subject conditions on the denormalized columns of the message table
+    use_denormalized_headers = True
+    # Fields with at least this many contains / not_contains conditions are matched by scanning their
+    # values once with a PatternMatcher, instead of evaluating a LIKE predicate per condition
+    multi_pattern_threshold = 50
+    # Sources and migrations the compiled sql depends on, see query_fingerprint
+    fingerprint = None
 
     """
     Initalize search service for resource based on provided rules
@@ -22,16 +52,44 @@ class EmailSearch:
     @classmethod
     def fetch(cls, resource_type, rules_data):
         if resource_type == 'message':
-            rules, rules_predicate = rules_data.rules, rules_data.predicate
-            messages = cls.fetch_message_by_header(rules, rules_predicate)
-            if not messages or len(messages) == 0:
+            with metrics.timer('search_query_seconds', resource_type=resource_type):
+                messages = list(cls.compiled_query(rules_data))
+            metrics.increment('search_matches_total', len(messages), resource_type=resource_type)
+            if not messages:
                 raise Exception('No messages found matching rules')
-            return list(messages)
+            return messages
         else:
             raise Exception('Invalid resource type')
 
+    """
+    Streams the ids of the resources matching the rules in chunks, read from a server side cursor
+    Arguments:
+        resource_type -> (str)     -> Resource like message 
+        rules_data    -> (RuleSet) -> Rules to filter
+        chunk_size    -> (int)     -> Ids per chunk
+    Returns: 
+        resource_ids -> (list) -> yields lists of resource ids filtered by rules
+    """
+    @classmethod
+    def iter_fetch(cls, resource_type, rules_data, chunk_size=1000):
+        if resource_type != 'message':
+            raise Exception('Invalid resource type')
+        messages = cls.compiled_query(rules_data)
+        chunk = []
+        for message_id in messages.iterator(chunk_size=chunk_size):
+            chunk.append(message_id)
+            if len(chunk) == chunk_size:
+                metrics.increment('search_matches_total', len(chunk), resource_type=resource_type)
+                yield chunk
+                chunk = []
+        if chunk:
+            metrics.increment('search_matches_total', len(chunk), resource_type=resource_type)
+            yield chunk
+
     """
     Helper to construct query given a column, operator and value
+    String operators are case sensitive, callers lower case both the column and the value so
+    the lower(column) indexes can be used
     Arguments:
         column_name -> (str) -> The db table column name
         operator    -> (str) -> The operator to use for query
@@ -43,13 +101,13 @@ class EmailSearch:
     def get_query(column_name, operator, value):
         field_lookup = f"{column_name}__"
         if operator == 'contains':
-            return Q(**{f"{field_lookup}icontains": value})
+            return Q(**{f"{field_lookup}contains": value})
         elif operator == 'not_contains':
-            return ~Q(**{f"{field_lookup}icontains": value})
-        elif operator == 'equals':
-            return Q(**{f"{field_lookup}iexact": value})
+            return ~Q(**{f"{field_lookup}contains": value})
+        elif operator in ('equal', 'equals'):
+            return Q(**{f"{field_lookup}exact": value})
         elif operator == 'not_equal':
-            return ~Q(**{f"{field_lookup}iexact": value})
+            return ~Q(**{f"{field_lookup}exact": value})
         elif operator == 'lesser_than':
             return Q(**{f"{field_lookup}lte": value})
         elif operator == 'greater_than':
@@ -66,12 +124,8 @@ class EmailSearch:
     """
     @staticmethod
     def get_header_name(field):
-        if field == 'from':
-            return ('header', 'From')
-        elif field == 'to':
-            return ('header', 'To')
-        elif field == 'subject':
-            return ('header', 'Subject')
+        if field in field_header_map:
+            return ('header', field_header_map[field])
         else:
             return (None, None)
 
@@ -84,7 +138,36 @@ class EmailSearch:
     """
     @staticmethod
     def get_header_value(value):
-        return ('value', value)
+        return ('value_lower', value.lower())
+
+    """
+    Given a field name in condition, returns the lower cased denormalized message column to query on
+    Arguments:
+        field -> (str) -> The field name in the condition
+    Returns: 
+        column_name -> (str) -> Annotated column name, None if the field is not denormalized
+    """
+    @classmethod
+    def get_denormalized_header_column(cls, field):
+        column = Message.HEADER_COLUMNS.get(field_header_map.get(field))
+        if not cls.use_denormalized_headers or not column:
+            return None
+        return f"{column}_lower"
+
+    """
+    Annotates the lower cased denormalized header columns the conditions are matched against
+    Arguments:
+        queryset -> (django queryset) -> Queryset of messages
+    Returns: 
+        queryset -> (django queryset) -> Annotated queryset
+    """
+    @classmethod
+    def annotate_header_columns(cls, queryset):
+        if not cls.use_denormalized_headers:
+            return queryset
+        return queryset.annotate(**{
+            f"{column}_lower": Lower(column) for column in Message.HEADER_COLUMNS.values()
+        })
 
     """
     In case if query must be performed on message table returns the column and value to query on
@@ -94,63 +177,116 @@ class EmailSearch:
     Returns: 
         query_object -> (tuple) -> Has the column name and value
     """
+    # The threshold is computed by the database when the query runs, so a compiled query stays valid
     @staticmethod
     def get_message_condition_column(field, value):
-        if field == 'date_received_days':
-            return ('message_id__internal_date', datetime.datetime.utcnow() - datetime.timedelta(days=value))
-        elif field == 'date_received_months':
-            return ('message_id__internal_date', datetime.datetime.utcnow() - datetime.timedelta(days=30*value))
-
-    """
-    Takes a list of conditions and construct query
-    Arguments:
-        conditions -> (Rule.conditions) -> List of conditions read from user input
-    Returns: 
-        message_query -> (django queryset) -> Has the queryset related to message table
-        header_query  -> (django queryset) -> Has the queryset related to message header table
-    """
-    @classmethod
-    def construct_query(cls, conditions):        
-        # We need to build a filter like this
-        # AND predicate -> for external table fields
-        # OR predicate  -> for headers & values [for both all & any]
-
-        # Example query filtering
-        # 
-        # .filter(
-        #     Q(message_id_id__internal_date__lt=datetime.now()-timedelta(days=1)) &
-        #     (
-        #         Q(header='From', value__icontains='') |
-        #         Q(header='Subject', value__icontains='')
-        #     )
-        # )
-        
-        message_query = Q()
-        header_query = Q()
-
-        message_condition_fields = ['date_received_days', 'date_received_months']
-        for condition in conditions:
-            field_name, predicate, field_value = condition.field, condition.predicate, condition.value
-        
-            if field_name in message_condition_fields:
-                column_name, column_value = cls.get_message_condition_column(field_name, field_value)
-                query = cls.get_query(column_name, predicate, column_value)
-                message_query &= query
-                
-            else:
-                header_name_column, header_name = cls.get_header_name(field_name)
-                header_value_column, header_value = cls.get_header_value(field_value)
-
-                header_name_query = cls.get_query(header_name_column, 'equals', header_name)
-                header_value_query = cls.get_query(header_value_column, predicate, header_value)
-
-                header_query |= header_name_query & header_value_query
-
-        logger.info(f"Constructing message and header queries for conditions")
-        return message_query, header_query
-    
-    """
-    Takes a list of conditions and construct query
+        days = value if field == 'date_received_days' else 30 * value
+        threshold = ExpressionWrapper(Now() - datetime.timedelta(days=days), output_field=DateTimeField())
+        return ('internal_date', threshold)
+
+    """
+    Compiles a condition into a query on the message table
+    Date conditions compare the received date with a threshold, lesser_than 2 days matches messages
+    received within the last 2 days. Header conditions use the denormalized message columns when
+    available, otherwise an EXISTS subquery on the message headers
+    Arguments:
+        condition       -> (Condition) -> Condition read from user input
+        pattern_matches -> (dict) -> Prefiltered message ids of substring conditions, or their PatternSlot,
+                                     see prefilter_patterns
+    Returns: 
+        query_object -> (django Q)
+    """
+    @classmethod
+    def compile_condition(cls, condition, pattern_matches=None):
+        field_name, predicate, field_value = condition.field, condition.predicate, condition.value
+
+        if pattern_matches and id(condition) in pattern_matches:
+            # Bound as a single array parameter, so the sql does not depend on the number of matches
+            query = Q(RawSQL(
+                f'"{Message._meta.db_table}"."{Message._meta.pk.column}" = ANY(%s)',
+                (pattern_matches[id(condition)],), output_field=BooleanField()
+            ))
+            return ~query if predicate == 'not_contains' else query
+
+        if field_name in ('date_received_days', 'date_received_months'):
+            column_name, threshold = cls.get_message_condition_column(field_name, field_value)
+            # Received less than n days ago is received after the threshold
+            operator = {'lesser_than': 'greater_than', 'greater_than': 'lesser_than'}[predicate]
+            return cls.get_query(column_name, operator, threshold)
+
+        # A negated predicate matches messages without any header value matching the positive one
+        negated = predicate.startswith('not_')
+        positive = predicate[len('not_'):] if negated else predicate
+        denormalized_column = cls.get_denormalized_header_column(field_name)
+        # The column joins the values of the header, a value without the separator is contained in it only
+        # when one of the values contains it
+        if denormalized_column and Message.HEADER_VALUE_SEPARATOR not in field_value:
+            query = cls.get_query(denormalized_column, positive, field_value.lower())
+            if positive == 'equal':
+                # Messages given the header several times compare it value by value
+                query |= (
+                    Q(**{f"{denormalized_column}__contains": Message.HEADER_VALUE_SEPARATOR}) &
+                    cls.get_header_values_query(field_name, positive, field_value)
+                )
+            if not negated:
+                return query
+            # The column is null for messages without the header, which have no value matching the positive one
+            return ~query | Q(**{f"{denormalized_column}__isnull": True})
+
+        query = cls.get_header_values_query(field_name, positive, field_value)
+        return ~query if negated else query
+
+    """
+    Compiles a positive header condition into an EXISTS subquery on the header values of the message
+    Arguments:
+        field     -> (str) -> The field name in the condition
+        predicate -> (str) -> contains or equal
+        value     -> (str) -> The value in the condition
+    Returns: 
+        query_object -> (django Q)
+    """
+    @classmethod
+    def get_header_values_query(cls, field, predicate, value):
+        header_name_column, header_name = cls.get_header_name(field)
+        header_value_column, header_value = cls.get_header_value(value)
+        header_values = (
+            MessageHeaderValues.objects
+            .annotate(value_lower=Lower('value'))
+            .filter(
+                Q(message_id=OuterRef('pk')) &
+                cls.get_query(header_name_column, 'equals', header_name) &
+                cls.get_query(header_value_column, predicate, header_value)
+            )
+        )
+        return Q(Exists(header_values))
+
+    """
+    Compiles conditions and nested rules combined by a predicate into a single query
+    Arguments:
+        conditions -> (list of Condition or Rule) -> Conditions and nested rules read from user input
+        predicate  -> (str) -> all or any
+        pattern_matches -> (dict) -> Prefiltered message ids of substring conditions, see prefilter_patterns
+    Returns: 
+        query_object -> (django Q)
+    """
+    @classmethod
+    def compile_rule(cls, conditions, predicate, pattern_matches=None):
+        queries = [
+            cls.compile_rule(condition.conditions, condition.predicate, pattern_matches) if isinstance(condition, Rule)
+            else cls.compile_condition(condition, pattern_matches)
+            for condition in conditions
+        ]
+        if not queries:
+            # Nothing to satisfy for all, nothing to match for any
+            return Q() if predicate == 'all' else Q(pk__in=[])
+
+        rule_query = queries[0]
+        for query in queries[1:]:
+            rule_query = rule_query & query if predicate == 'all' else rule_query | query
+        return rule_query
+
+    """
+    Takes a list of rules and construct a single query for them
     Arguments:
         rules -> (RuleSet) -> List of rules read from user input
         rule_predicate -> (RuleSet.predicate) -> Predicate for list of rules
@@ -158,38 +294,201 @@ class EmailSearch:
         queryset -> (django queryset) -> Has the message ids filtered based on rules
     """
     @classmethod
-    def fetch_message_by_header(cls, rules, rule_predicate):      
-        message_headers_queryset = MessageHeaderValues.objects.all()
-        rule_set_query = Q()
-
-        for rule in rules:
-            conditions_predicate = rule.predicate
-            message_query, header_query = cls.construct_query(rule.conditions)
-            rule_query = message_query & header_query
-
-            # In case of all, since our q is like if (header is 'from' & value is 'some_val') or (header is 'to' & value is 'some_val')
-            # we are explicitly matching all entries which match at least n conditions by a group by
-            # Eg select msg where (header & value) or (header & value) group by msg_id having count('id') = 2
-            logger.info(f"Filtering message based on message and header queries")
-            if conditions_predicate == 'all':
-                message_headers_queryset = (
-                    message_headers_queryset
-                    .filter(rule_query).values('message_id')
-                    .annotate(num_conditions=Count('id'))
-                    .filter(num_conditions=len(header_query))
-                    .values_list('message_id_id__message_id', flat=True)
-                    .distinct()
-                )
-            else:
-                message_headers_queryset = (
-                    message_headers_queryset
-                    .filter(rule_query)
-                    .values_list('message_id__message_id', flat=True)
-                    .distinct()
-                )
+    def fetch_message_by_header(cls, rules, rule_predicate):
+        pattern_matches = cls.prefilter_patterns(rules)
+        logger.info(f"Filtering message based on compiled rules")
+        return (
+            cls.annotate_header_columns(Message.objects.all())
+            .filter(cls.compile_rule(rules, rule_predicate, pattern_matches))
+            .values_list('message_id', flat=True)
+        )
+
+    """
+    Fingerprint of the code compiling the rules and of the schema they are compiled against, computed
+    once per process, so compiled queries cached on disk are not reused after an upgrade or a migration
+    Arguments:
+        None
+    Returns:
+        fingerprint -> (tuple) -> hash of the compiler sources and the latest applied migration of the models
+    """
+    @classmethod
+    def query_fingerprint(cls):
+        if cls.fingerprint is None:
+            digest = hashlib.sha256()
+            for source_path in (inspect.getfile(cls), inspect.getfile(Rule), inspect.getfile(Message)):
+                with open(source_path, 'rb') as source_file:
+                    digest.update(source_file.read())
+            applied_migrations = MigrationRecorder(connection).applied_migrations()
+            latest_migration = max(
+                (name for app_label, name in applied_migrations if app_label == Message._meta.app_label), default=None
+            )
+            cls.fingerprint = (digest.hexdigest(), latest_migration)
+        return cls.fingerprint
 
-            # Supports only all need to extend for any
-            rule_set_query &= rule_query
+    # Settings and versions the sql of the rules depends on, a rule set keeps a compiled query per key
+    @classmethod
+    def query_key(cls):
+        return (
+            'sql', connection.vendor, django.get_version(), *cls.query_fingerprint(),
+            cls.use_denormalized_headers, cls.multi_pattern_threshold,
+        )
 
-        message_headers_queryset.filter(rule_set_query)
-        return message_headers_queryset
+    """
+    Compiles the rules into the where clause of the message query, once per rule set
+    The clause is kept on the rule set, which RulesCache stores on disk, so later runs skip building the
+    query. Date thresholds are computed by the database and the prefiltered substring conditions are
+    PatternSlot parameters, so the clause does not depend on when it runs nor on the messages in db
+    Arguments:
+        rules_data -> (RuleSet) -> Rules to filter
+    Returns:
+        where  -> (str)  -> where clause with its placeholders
+        params -> (list) -> parameters of the clause, None for the pattern slots
+        slots  -> (list of tuple) -> index of the parameter and position of the condition of every pattern slot
+    """
+    @classmethod
+    def compile_rules(cls, rules_data):
+        key = cls.query_key()
+        compiled = rules_data.compiled_forms.get(key)
+        if compiled is not None:
+            return compiled
+
+        with metrics.timer('stage_seconds', stage='compile_rules'):
+            pattern_slots = {
+                id(condition): PatternSlot(position)
+                for conditions in cls.prefiltered_conditions(rules_data.rules).values()
+                for position, condition in conditions
+            }
+            queryset = cls.annotate_header_columns(Message.objects.all()).filter(
+                cls.compile_rule(rules_data.rules, rules_data.predicate, pattern_slots)
+            )
+            try:
+                where, params = queryset.query.where.as_sql(queryset.query.get_compiler(connection=connection), connection)
+            except EmptyResultSet:
+                where, params = 'FALSE', []
+            slots = [(idx, param.position) for idx, param in enumerate(params) if isinstance(param, PatternSlot)]
+            params = [None if isinstance(param, PatternSlot) else param for param in params]
+        compiled = rules_data.compiled_forms[key] = (where or 'TRUE', params, slots)
+        logger.info(f"Compiled rules into a query with {len(params)} parameters")
+        return compiled
+
+    """
+    Builds the message query of the rules from their compiled where clause, binding the primary keys
+    of the messages matching the prefiltered substring conditions
+    Arguments:
+        rules_data -> (RuleSet) -> Rules to filter
+    Returns:
+        queryset -> (django queryset) -> Has the message ids filtered based on rules
+    """
+    @classmethod
+    def compiled_query(cls, rules_data):
+        where, params, slots = cls.compile_rules(rules_data)
+        if slots:
+            positions = {id(condition): position for position, condition in enumerate(iter_conditions(rules_data.rules))}
+            matched_pks = {positions[key]: pks for key, pks in cls.prefilter_patterns(rules_data.rules).items()}
+            params = list(params)
+            for idx, position in slots:
+                params[idx] = matched_pks[position]
+        logger.info(f"Filtering message based on compiled rules")
+        return Message.objects.filter(RawSQL(where, params, output_field=BooleanField())).values_list('message_id', flat=True)
+
+    """
+    Escapes the wildcards of a LIKE pattern, postgres escapes them with a backslash by default
+    Arguments:
+        value -> (str) -> Value matched literally
+    Returns: 
+        value -> (str) -> Escaped value
+    """
+    @staticmethod
+    def escape_like(value):
+        return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+    """
+    Streams the lower cased values of a header field containing any of the needles, along with the
+    primary key of their message. The values are filtered by the database with a single LIKE ANY,
+    which the trigram indexes of the header columns serve, so only candidate rows are read
+    Arguments:
+        field   -> (str) -> The field name in the condition
+        needles -> (list of str) -> Lower cased substrings the values are matched against
+    Returns: 
+        values -> (iterator) -> (message primary key, lower cased header value) pairs
+    """
+    @classmethod
+    def iter_header_values(cls, field, needles):
+        column = Message.HEADER_COLUMNS.get(field_header_map.get(field))
+        if cls.use_denormalized_headers and column:
+            queryset, pk_column, value_column = Message.objects.all(), 'pk', column
+        else:
+            queryset, pk_column, value_column = (
+                MessageHeaderValues.objects.filter(header=field_header_map[field]), 'message_id', 'value'
+            )
+        model = queryset.model
+        candidates = RawSQL(
+            f'LOWER("{model._meta.db_table}"."{model._meta.get_field(value_column).column}") LIKE ANY(%s)',
+            ([f"%{cls.escape_like(needle)}%" for needle in needles],), output_field=BooleanField()
+        )
+        return (
+            queryset
+            .filter(candidates)
+            .annotate(value_lower=Lower(value_column))
+            .values_list(pk_column, 'value_lower')
+            .iterator()
+        )
+
+    """
+    Groups the contains / not_contains conditions of the fields having at least multi_pattern_threshold of them
+    Arguments:
+        rules -> (list of Condition or Rule) -> Conditions and rules read from user input
+    Returns:
+        conditions -> (dict) -> field to the position in iter_conditions order and the condition
+    """
+    @classmethod
+    def prefiltered_conditions(cls, rules):
+        grouped_conditions = {}
+        for position, condition in enumerate(iter_conditions(rules)):
+            # Needles with the separator of the denormalized values are compared value by value
+            if condition.predicate in ('contains', 'not_contains') and Message.HEADER_VALUE_SEPARATOR not in condition.value:
+                grouped_conditions.setdefault(condition.field, []).append((position, condition))
+        return {
+            field: conditions for field, conditions in grouped_conditions.items()
+            if len(conditions) >= cls.multi_pattern_threshold
+        }
+
+    """
+    For fields with many contains / not_contains conditions, selects the field values containing any of
+    their needles in the database and scans them once with a PatternMatcher holding all the needles, to
+    resolve the messages matching each condition
+    Arguments:
+        rules -> (list of Condition or Rule) -> Conditions and rules read from user input
+    Returns: 
+        pattern_matches -> (dict) -> id of the condition to the primary keys of the messages with
+                                     a value containing its needle
+    """
+    @classmethod
+    def prefilter_patterns(cls, rules):
+        pattern_matches = {}
+        for field, conditions in cls.prefiltered_conditions(rules).items():
+            matcher = PatternMatcher()
+            for idx, (_, condition) in enumerate(conditions):
+                matcher.add(condition.value.lower(), idx)
+            matched_pks = [set() for _ in conditions]
+            needles = [condition.value.lower() for _, condition in conditions]
+            for message_pk, value in cls.iter_header_values(field, needles):
+                for idx in matcher.search(value):
+                    matched_pks[idx].add(message_pk)
+            pattern_matches.update({
+                id(condition): sorted(matched_pks[idx]) for idx, (_, condition) in enumerate(conditions)
+            })
+            logger.info(f"Prefiltered {len(conditions)} substring conditions on {field} in a single scan")
+        return pattern_matches
+
+    """
+    Returns the query plan of the rules query, to verify the indexes it uses
+    Arguments:
+        rules_data -> (RuleSet) -> Rules to filter
+        options    -> (dict)    -> EXPLAIN options like analyze, buffers
+    Returns: 
+        plan -> (str) -> Query plan reported by the database
+    """
+    @classmethod
+    def explain(cls, rules_data, **options):
+        return cls.compiled_query(rules_data).explain(**options)
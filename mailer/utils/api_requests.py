@@ -1,7 +1,10 @@
+import random
 import requests
 import curlify
 import json
 import logging
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger('utils.api_request')
 
@@ -13,36 +16,91 @@ def json_decoder(response):
 
 
 class APIRequest:
-    def __init__(self, base_url):
+    """
+    Initialize api requests on a pooled keep-alive session
+    Arguments:
+        base_url        -> (str)   -> Base url the endpoints are relative to
+        pool_size       -> (int)   -> Connections kept alive per host
+        max_retries     -> (int)   -> Retries on connection errors and 429 / 5xx responses
+        backoff_factor  -> (float) -> Retry n waits backoff_factor * 2 ** (n - 1) seconds, unless told by Retry-After
+        log_sample_rate -> (float) -> Share of requests logged as curl commands at debug level
+    Returns:
+        None
+    """
+    def __init__(self, base_url, pool_size=10, max_retries=3, backoff_factor=0.5, log_sample_rate=1.0):
         self.base_url = base_url
+        self.log_sample_rate = log_sample_rate
+        retries = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
-    def get(self, endpoint=None, params=None, headers=None):
-        url = f"{self.base_url}/{endpoint}"
-        response = requests.get(url, params=params, headers=headers)
-        response.raise_for_status()
-        logger.info(curlify.to_curl(response.request))
-        return json_decoder(response)
-
-    def post(self, endpoint=None, data=None, json=None, headers=None):
-        url = f"{self.base_url}"
+    def get_url(self, endpoint=None):
         if endpoint:
-            url = f"{self.base_url}/{endpoint}"
-        
-        response = requests.post(url, data=data, json=json, headers=headers)
-        logger.info(curlify.to_curl(response.request)) # remove print statement
+            return f"{self.base_url}/{endpoint}"
+        return f"{self.base_url}"
+
+    """
+    Logs a one line summary of the request, the curl command is only built at debug level and
+    for a sample of the requests since it serializes the whole body. Streamed bodies, like the
+    multipart batches, cannot be serialized again once sent and are logged without them
+    Logging never raises, the request was already sent
+    Arguments:
+        response -> (requests.Response) -> Response of the request
+    Returns:
+        None
+    """
+    def log_request(self, response):
+        logger.info("%s %s %s %.3fs", response.request.method, response.url, response.status_code, response.elapsed.total_seconds())
+        if not logger.isEnabledFor(logging.DEBUG) or random.random() >= self.log_sample_rate:
+            return
+        request = response.request
+        try:
+            if request.body is None or isinstance(request.body, (str, bytes)):
+                logger.debug(curlify.to_curl(request))
+            else:
+                logger.debug(f"{request.method} {request.url} with a streamed {type(request.body).__name__} body")
+        except Exception as err:
+            logger.debug(f"Failed to log {request.method} {request.url} as curl: {err}")
+
+    """
+    Sends a request on the session
+    Arguments:
+        method   -> (str)  -> Http method
+        endpoint -> (str)  -> Endpoint relative to the base url
+        stream   -> (bool) -> Return the response undecoded with its body not yet read, the caller closes it
+        kwargs   -> (dict) -> Arguments of requests.Session.request
+    Returns:
+        response -> (dict or requests.Response) -> Decoded json, or the response if it is not json or streamed
+    """
+    def request(self, method, endpoint=None, stream=False, **kwargs):
+        response = self.session.request(method, self.get_url(endpoint), stream=stream, **kwargs)
+        self.log_request(response)
+        if stream and not response.ok:
+            response.close()
         response.raise_for_status()
+        if stream:
+            return response
         return json_decoder(response)
 
+    def get(self, endpoint=None, params=None, headers=None):
+        return self.request('GET', endpoint, params=params, headers=headers)
+
+    def post(self, endpoint=None, data=None, json=None, headers=None, stream=False):
+        return self.request('POST', endpoint, data=data, json=json, headers=headers, stream=stream)
+
     def put(self, endpoint=None, data=None, json=None, headers=None):
-        url = f"{self.base_url}/{endpoint}"
-        response = requests.put(url, data=data, json=json, headers=headers)
-        response.raise_for_status()
-        logger.info(curlify.to_curl(response.request))
-        return json_decoder(response)
+        return self.request('PUT', endpoint, data=data, json=json, headers=headers)
 
     def delete(self, endpoint=None, headers=None):
-        url = f"{self.base_url}/{endpoint}"
-        response = requests.delete(url, headers=headers)
-        response.raise_for_status()
-        logger.info(curlify.to_curl(response.request))
-        return json_decoder(response)
+        return self.request('DELETE', endpoint, headers=headers)
+
+    def close(self):
+        self.session.close()
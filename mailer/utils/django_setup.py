@@ -0,0 +1,24 @@
+import os
+import threading
+
+setup_lock = threading.Lock()
+
+"""
+Configures django on first use, modules using the orm call it before importing the models so that
+entry points only pay for django once they reach code that needs the db
+Calling it again is a no op
+Arguments:
+    settings_module -> (str) -> settings used unless DJANGO_SETTINGS_MODULE is set
+Returns:
+    None
+"""
+def setup_django(settings_module='settings'):
+    from django.apps import apps
+    if apps.ready:
+        return
+    with setup_lock:
+        if apps.ready:
+            return
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+        import django
+        django.setup()
@@ -0,0 +1,218 @@
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    """
+    Distribution of observed values, counted in cumulative buckets the way prometheus expects them
+    Arguments:
+        buckets -> (tuple) -> sorted upper bounds of the buckets
+    Returns:
+        None
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    """
+    Estimates a quantile from the buckets, as the upper bound of the bucket it falls in
+    Arguments:
+        quantile -> (float) -> quantile between 0 and 1
+    Returns:
+        value -> (float) -> estimated value, the max observed one for the unbounded bucket
+    """
+    def quantile(self, quantile):
+        if not self.count:
+            return None
+        rank, seen = quantile * self.count, 0
+        for upper_bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(upper_bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'min': self.min,
+            'max': self.max,
+            'mean': round(self.sum / self.count, 6) if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+        }
+
+
+class MetricsRegistry:
+    """
+    Thread safe registry of counters and histograms, identified by a name and a set of labels
+    Metrics are only kept in memory and exported once, at the end of a run
+    Arguments:
+        prefix -> (str) -> prefix of the exported metric names
+    Returns:
+        None
+    """
+    def __init__(self, prefix='mailer_'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        # Label values are exported as text, keeping them as strings also keeps the series sortable
+        # when a label carries both numbers and strings, like status=200 and status='failed'
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    """
+    Adds to a counter
+    Arguments:
+        name   -> (str)   -> metric name, like gmail_messages_fetched_total
+        amount -> (float) -> amount to add
+        labels -> (dict)  -> labels of the series, like method='messages.list'
+    Returns:
+        None
+    """
+    def increment(self, name, amount=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    """
+    Records a value in a histogram, created with the given buckets on its first observation
+    Arguments:
+        name    -> (str)   -> metric name, like gmail_batch_size
+        value   -> (float) -> observed value
+        buckets -> (tuple) -> upper bounds of the buckets, latency buckets by default
+        labels  -> (dict)  -> labels of the series
+    Returns:
+        None
+    """
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    """
+    Times the block and records its duration in seconds, whether or not it raised
+    Arguments:
+        name   -> (str)  -> metric name, like db_step_seconds
+        labels -> (dict) -> labels of the series
+    Returns:
+        None
+    """
+    @contextmanager
+    def timer(self, name, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    @staticmethod
+    def format_labels(labels, **extra):
+        labels = dict(labels, **extra)
+        if not labels:
+            return ''
+        values = ",".join(f'{name}="{escape_label(value)}"' for name, value in labels.items())
+        return "{" + values + "}"
+
+    """
+    Renders the metrics in the prometheus text exposition format, for the node exporter textfile collector
+    Arguments:
+        None
+    Returns:
+        text -> (str) -> exposition text
+    """
+    def to_prometheus(self):
+        lines, typed = [], set()
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = f"{self.prefix}{name}"
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric}{self.format_labels(labels)} {value}")
+
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                metric = f"{self.prefix}{name}"
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for upper_bound, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{metric}_bucket{self.format_labels(labels, le=upper_bound)} {cumulative}")
+                lines.append(f"{metric}_bucket{self.format_labels(labels, le='+Inf')} {histogram.count}")
+                lines.append(f"{metric}_sum{self.format_labels(labels)} {histogram.sum}")
+                lines.append(f"{metric}_count{self.format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    """
+    Summarizes the metrics, histograms are reduced to their count, sum, extremes and estimated quantiles
+    Arguments:
+        None
+    Returns:
+        summary -> (dict) -> counters and histograms, each a list of name, labels and values
+    """
+    def to_dict(self):
+        with self.lock:
+            return {
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'histograms': [
+                    {'name': name, 'labels': dict(labels), **histogram.summary()}
+                    for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0])
+                ],
+            }
+
+    """
+    Writes the metrics to a file, as json when the path ends with .json and as prometheus text otherwise
+    Arguments:
+        path -> (str) -> file to write
+    Returns:
+        None
+    """
+    def write(self, path):
+        if path.endswith('.json'):
+            content = json.dumps(self.to_dict(), indent=2)
+        else:
+            content = self.to_prometheus()
+        with open(path, 'w') as metrics_file:
+            metrics_file.write(content)
+
+
+# Registry the hot paths record to
+metrics = MetricsRegistry()
@@ -0,0 +1,109 @@
+import json
+
+
+class MultipartBatchBody:
+    """
+    multipart/mixed body of a batch request, encoded lazily as bytes chunks
+    requests sends iterables with chunked transfer encoding, and every iteration encodes the body
+    afresh so connection retries resend the whole body
+    Arguments:
+        request_configs -> (list) -> Configs like content id, http endpoint, body
+        boundary        -> (str)  -> Multipart boundary
+    Returns:
+        None
+    """
+    def __init__(self, request_configs, boundary='batch_boundary'):
+        self.request_configs = request_configs
+        self.boundary = boundary
+
+    def __iter__(self):
+        for idx, config in enumerate(self.request_configs):
+            content_id = config.get('content_id', f'item{idx}')
+            yield (
+                f'--{self.boundary}\r\n'
+                f'Content-Type: application/http\r\n'
+                f'Content-ID: <{content_id}>\r\n\r\n'
+                f'{config.get("method", "POST")} {config["endpoint"]} HTTP/1.1\r\n'
+                f'Content-Type: application/json\r\n\r\n'
+                f'{json.dumps(config["body"])}\r\n'
+            ).encode('utf-8')
+        yield f'--{self.boundary}--'.encode('utf-8')
+
+
+class BatchResponseParser:
+    """
+    Incremental parser of a multipart/mixed batch response
+    Chunks are fed as they are received and every complete part is parsed and released, so only
+    the part being received is buffered
+    Arguments:
+        boundary -> (str) -> Multipart boundary from the Content-Type of the response
+    Returns:
+        None
+    """
+    def __init__(self, boundary):
+        self.delimiter = f'--{boundary}'.encode('utf-8')
+        self.buffer = bytearray()
+        self.search_from = 0
+        self.preamble = True
+
+    """
+    Feeds a chunk of the response body
+    Arguments:
+        chunk -> (bytes) -> Next chunk of the body
+    Returns:
+        parts -> (list of tuple) -> (content id, status code, body) of the parts completed by the chunk
+    """
+    def feed(self, chunk):
+        self.buffer += chunk
+        parts = []
+        while True:
+            idx = self.buffer.find(self.delimiter, self.search_from)
+            if idx < 0:
+                # A delimiter may straddle the next chunk
+                self.search_from = max(0, len(self.buffer) - len(self.delimiter))
+                break
+            part = bytes(self.buffer[:idx])
+            del self.buffer[:idx + len(self.delimiter)]
+            self.search_from = 0
+            if not self.preamble and part.strip():
+                parts.append(self.parse_part(part))
+            self.preamble = False
+        return parts
+
+    """
+    Parses a part holding the http response of a request
+    Arguments:
+        part -> (bytes) -> Part between two delimiters
+    Returns:
+        part -> (tuple) -> (content id without the response- prefix, status code, body)
+    """
+    @staticmethod
+    def parse_part(part):
+        part_headers, _, http_response = part.strip(b'\r\n').partition(b'\r\n\r\n')
+        content_id = None
+        for line in part_headers.decode('utf-8').split('\r\n'):
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'content-id':
+                content_id = value.strip().strip('<>')
+                if content_id.startswith('response-'):
+                    content_id = content_id[len('response-'):]
+        response_head, _, body = http_response.partition(b'\r\n\r\n')
+        status_line = response_head.split(b'\r\n', 1)[0]
+        status_parts = status_line.split(b' ')
+        status = int(status_parts[1]) if status_line.startswith(b'HTTP/') and len(status_parts) > 1 else None
+        return content_id, status, body.strip().decode('utf-8')
+
+
+"""
+Generator over the parts of a batch response, read as a stream
+Arguments:
+    response   -> (requests.Response) -> Response of the batch request, requested with stream=True
+    chunk_size -> (int) -> Bytes read at a time
+Returns:
+    parts -> (tuple) -> yields (content id, status code, body) of every part
+"""
+def iter_batch_response(response, chunk_size=16384):
+    boundary = response.headers.get('Content-Type', '').split('boundary=')[-1].split(';')[0].strip('"')
+    parser = BatchResponseParser(boundary)
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        yield from parser.feed(chunk)
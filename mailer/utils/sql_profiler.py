@@ -0,0 +1,238 @@
+import re
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from mailer.utils.django_setup import setup_django
+setup_django()
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+
+from mailer.utils.metrics import metrics
+
+logger = logging.getLogger('mailer.sql_profiler')
+
+# Tables a sequential scan over is reported, the header values table grows with every header of every message
+FLAGGED_TABLES = ('db_messageheadervalues',)
+# Rows of multi row VALUES lists and IN lists are collapsed, so the statements of different batch sizes group together
+VALUES_ROWS_PATTERN = re.compile(r'(\((?:%s, )*%s\))(?:, \((?:%s, )*%s\))+')
+IN_LIST_PATTERN = re.compile(r'IN \((?:%s, )+%s\)')
+
+
+class SQLProfiler:
+    """
+    Captures the sql statements run while profiling, with their duration and row count, and explains
+    queries with EXPLAIN (ANALYZE, BUFFERS) to report sequential scans over the flagged tables
+    Statements are captured on every connection, including the ones threads open while profiling
+    Arguments:
+        flagged_tables -> (tuple) -> tables a sequential scan over is reported
+    Returns:
+        None
+    """
+    def __init__(self, flagged_tables=FLAGGED_TABLES):
+        self.flagged_tables = flagged_tables
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.plans = []
+        self.wrapped = []
+        self.explaining = threading.local()
+
+    @staticmethod
+    def normalize(sql):
+        return IN_LIST_PATTERN.sub('IN (%s, ...)', VALUES_ROWS_PATTERN.sub(r'\1, ...', sql))
+
+    """
+    Execute wrapper of django, times the statement and records it under its normalized sql
+    Arguments:
+        execute -> (callable) -> runs the statement
+        sql     -> (str)  -> statement with its placeholders
+        params  -> (list) -> parameters of the statement
+        many    -> (bool) -> whether executemany is used
+        context -> (dict) -> connection and cursor of the statement
+    Returns:
+        result -> () -> result of execute
+    """
+    def __call__(self, execute, sql, params, many, context):
+        if getattr(self.explaining, 'active', False):
+            return execute(sql, params, many, context)
+        started_at = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started_at
+            rowcount = getattr(context.get('cursor'), 'rowcount', -1)
+            key = self.normalize(sql)
+            with self.lock:
+                statement = self.statements.get(key)
+                if statement is None:
+                    # The first call is kept to explain the statement later
+                    statement = self.statements[key] = {
+                        'sql': key, 'calls': 0, 'total_seconds': 0, 'max_seconds': 0, 'rows': 0,
+                        'first_call': (sql, params),
+                    }
+                statement['calls'] += 1
+                statement['total_seconds'] += duration
+                statement['max_seconds'] = max(statement['max_seconds'], duration)
+                statement['rows'] += max(rowcount, 0)
+            metrics.observe('db_query_seconds', duration, statement=sql.split(None, 1)[0].upper())
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+            with self.lock:
+                self.wrapped.append(connection)
+
+    """
+    Captures the statements run in the block, on the open connections and on the ones opened meanwhile
+    Arguments:
+        None
+    Returns:
+        None
+    """
+    @contextmanager
+    def profile(self):
+        for conn in connections.all():
+            self.install(connection=conn)
+        connection_created.connect(self.install)
+        try:
+            yield self
+        finally:
+            connection_created.disconnect(self.install)
+            with self.lock:
+                wrapped, self.wrapped = self.wrapped, []
+            for conn in wrapped:
+                if self in conn.execute_wrappers:
+                    conn.execute_wrappers.remove(self)
+
+    """
+    Walks a json query plan and collects the sequential scans over the flagged tables
+    Arguments:
+        node -> (dict) -> plan node
+    Returns:
+        seq_scans -> (list of dict) -> relation, rows and time of the scans
+    """
+    def find_seq_scans(self, node):
+        seq_scans = []
+        if node.get('Node Type') == 'Seq Scan' and node.get('Relation Name') in self.flagged_tables:
+            seq_scans.append({
+                'relation': node['Relation Name'],
+                'filter': node.get('Filter'),
+                'actual_rows': node.get('Actual Rows'),
+                'rows_removed_by_filter': node.get('Rows Removed by Filter'),
+                'actual_total_ms': node.get('Actual Total Time'),
+                'shared_read_blocks': node.get('Shared Read Blocks'),
+            })
+        for child in node.get('Plans', []):
+            seq_scans.extend(self.find_seq_scans(child))
+        return seq_scans
+
+    """
+    Runs EXPLAIN (ANALYZE, BUFFERS) on a statement, which executes it, and records its plan
+    Arguments:
+        name   -> (str)  -> name the plan is reported under
+        sql    -> (str)  -> statement with its placeholders
+        params -> (list) -> parameters of the statement
+    Returns:
+        plan -> (dict) -> planning and execution time, sequential scans over the flagged tables and the plan
+    """
+    def explain(self, name, sql, params=None):
+        self.explaining.active = True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}", params)
+                result = cursor.fetchone()[0]
+        finally:
+            self.explaining.active = False
+        result = (json.loads(result) if isinstance(result, str) else result)[0]
+        plan = {
+            'name': name,
+            'sql': self.normalize(sql),
+            'planning_ms': result.get('Planning Time'),
+            'execution_ms': result.get('Execution Time'),
+            'seq_scans': self.find_seq_scans(result['Plan']),
+            'plan': result['Plan'],
+        }
+        for seq_scan in plan['seq_scans']:
+            logger.warning(
+                f"{name} scans {seq_scan['relation']} sequentially, {seq_scan['actual_rows']} rows kept and "
+                f"{seq_scan['rows_removed_by_filter'] or 0} filtered out in {seq_scan['actual_total_ms']}ms"
+            )
+        with self.lock:
+            self.plans.append(plan)
+        return plan
+
+    def explain_queryset(self, name, queryset):
+        sql, params = queryset.query.sql_with_params()
+        return self.explain(name, sql, params)
+
+    """
+    Explains the captured select statements reading from the flagged tables, with the parameters of
+    their first call
+    Arguments:
+        None
+    Returns:
+        plans -> (list of dict) -> plans of the statements
+    """
+    def explain_captured(self):
+        with self.lock:
+            statements = [
+                statement for statement in self.statements.values()
+                if statement['sql'].lstrip().upper().startswith('SELECT')
+                and any(f'"{table}"' in statement['sql'] for table in self.flagged_tables)
+            ]
+        return [
+            self.explain(f"captured statement {idx}", *statement['first_call'])
+            for idx, statement in enumerate(statements, 1)
+        ]
+
+    """
+    Summarizes the capture, statements ordered by the total time spent in them
+    Arguments:
+        limit -> (int) -> statements included, None for all of them
+    Returns:
+        report -> (dict) -> statements, plans and the sequential scans found in them
+    """
+    def report(self, limit=None):
+        with self.lock:
+            statements = sorted(self.statements.values(), key=lambda statement: -statement['total_seconds'])
+            plans = list(self.plans)
+        return {
+            'total_statements': sum(statement['calls'] for statement in statements),
+            'total_seconds': round(sum(statement['total_seconds'] for statement in statements), 6),
+            'statements': [
+                {
+                    key: round(value, 6) if isinstance(value, float) else value
+                    for key, value in statement.items() if key != 'first_call'
+                }
+                for statement in statements[:limit]
+            ],
+            'plans': plans,
+            'seq_scans': [dict(seq_scan, plan=plan['name']) for plan in plans for seq_scan in plan['seq_scans']],
+        }
+
+    """
+    Logs the slowest statements and the plans, and writes the whole report as json if a path is given
+    Arguments:
+        path  -> (str) -> json file the report is written to, None to only log it
+        limit -> (int) -> statements logged
+    Returns:
+        None
+    """
+    def log_report(self, path=None, limit=10):
+        report = self.report()
+        logger.info(f"Captured {report['total_statements']} statements taking {report['total_seconds']}s")
+        for statement in report['statements'][:limit]:
+            logger.info(
+                f"{statement['calls']} calls, {statement['total_seconds']}s total, "
+                f"{statement['max_seconds']}s max: {statement['sql'][:300]}"
+            )
+        for plan in report['plans']:
+            logger.info(
+                f"{plan['name']}: planned in {plan['planning_ms']}ms, executed in {plan['execution_ms']}ms, "
+                f"{len(plan['seq_scans'])} sequential scans over {', '.join(self.flagged_tables)}"
+            )
+        if path:
+            with open(path, 'w') as report_file:
+                json.dump(report, report_file, indent=2, default=str)
+            logger.info(f"Wrote sql profile to {path}")
@@ -0,0 +1,70 @@
+"""
+Fixtures shared by the tests, they run against the database of mailer/settings.py in a transaction
+which is rolled back, so the database is left untouched
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import datetime
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Same as PYTHONPATH=.:mailer, the settings module and the db app are imported from mailer/
+for path in (os.path.join(ROOT, 'mailer'), ROOT):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from mailer.utils.django_setup import setup_django
+setup_django()
+
+USER_EMAIL = 'tests@example.com'
+
+
+@pytest.fixture
+def rolled_back():
+    from django.db import transaction
+    with transaction.atomic():
+        yield
+        transaction.set_rollback(True)
+
+
+"""
+Builds a message in the format returned by gmail api
+Arguments:
+    message_id -> (str)  -> google message id, also used as the thread id
+    headers    -> (list of tuple) -> header name and value pairs, in order
+    days_ago   -> (int)  -> days since the message was received
+Returns:
+    message -> (dict)
+"""
+def make_message(message_id, headers, days_ago=0):
+    internal_date = datetime.datetime.now() - datetime.timedelta(days=days_ago)
+    return {
+        'id': message_id,
+        'threadId': message_id,
+        'historyId': '1',
+        'sizeEstimate': 1024,
+        'internalDate': str(int(internal_date.timestamp() * 1000)),
+        'snippet': '',
+        'labelIds': ['INBOX'],
+        'payload': {'headers': [{'name': name, 'value': value} for name, value in headers]},
+    }
+
+
+"""
+Persists messages with the processor of the test user, in the rolled back transaction
+Returns:
+    ingest -> (callable) -> takes the messages, returns their google message ids
+"""
+@pytest.fixture
+def ingest(rolled_back):
+    from mailer.ingestion.email_message_processor import GmailMessageProcessor
+    processor = GmailMessageProcessor()
+    processor.register_recipient(USER_EMAIL)
+
+    def ingest(messages):
+        processor.process_messages(messages)
+        return {message['id'] for message in messages}
+    return ingest
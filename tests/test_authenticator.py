@@ -0,0 +1,45 @@
+import json
+import datetime
+import threading
+
+from google.auth.exceptions import TransportError
+
+from mailer.authentication.authenticator import TokenRefresher
+
+
+class FlakyCredentials:
+    """
+    Credentials expiring right away whose first refresh fails with a network error
+    """
+    refresh_token = 'refresh-token'
+
+    def __init__(self):
+        self.expiry = datetime.datetime.utcnow()
+        self.token = 'expired-token'
+        self.refreshes = 0
+        self.refreshed = threading.Event()
+
+    def refresh(self, request):
+        self.refreshes += 1
+        if self.refreshes == 1:
+            raise TransportError('connection reset')
+        self.token = 'fresh-token'
+        self.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        self.refreshed.set()
+
+    def to_json(self):
+        return json.dumps({'token': self.token, 'refresh_token': self.refresh_token})
+
+
+def test_refresher_retries_network_errors_and_saves_credentials(tmp_path):
+    token_path = tmp_path / 'token.json'
+    credentials = FlakyCredentials()
+    refresher = TokenRefresher(credentials, margin=0, retry_interval=0.01, token_path=str(token_path))
+    refresher.start()
+    try:
+        assert credentials.refreshed.wait(5)
+    finally:
+        refresher.stop()
+        refresher.join(5)
+    assert credentials.refreshes == 2
+    assert json.loads(token_path.read_text())['token'] == 'fresh-token'
@@ -0,0 +1,114 @@
+import pytest
+
+from conftest import make_message
+from mailer.rules.rules_model import RuleSet
+from mailer.search.email_search import EmailSearch
+
+
+@pytest.fixture(params=[True, False], ids=['denormalized', 'header_values'])
+def use_denormalized_headers(request, monkeypatch):
+    monkeypatch.setattr(EmailSearch, 'use_denormalized_headers', request.param)
+    return request.param
+
+
+def search(rules, ingested_ids, predicate='all'):
+    rule_set = RuleSet(rules=rules, predicate=predicate)
+    return set(EmailSearch.compiled_query(rule_set)) & ingested_ids
+
+
+@pytest.mark.parametrize('predicate, value, expected', [
+    ('contains', 'invoice', {'search-with-subject'}),
+    ('not_contains', 'invoice', {'search-without-subject'}),
+    ('equal', 'your invoice', {'search-with-subject'}),
+    ('not_equal', 'your invoice', {'search-without-subject'}),
+    ('not_contains', 'receipt', {'search-with-subject', 'search-without-subject'}),
+])
+def test_missing_header_matches_negated_conditions(ingest, use_denormalized_headers, predicate, value, expected):
+    ingested_ids = ingest([
+        make_message('search-with-subject', [('From', 'billing@shop.com'), ('Subject', 'Your Invoice')]),
+        make_message('search-without-subject', [('From', 'billing@shop.com')]),
+    ])
+    rules = [{'field': 'subject', 'predicate': predicate, 'value': value}]
+    assert search(rules, ingested_ids) == expected
+
+
+def test_prefiltered_conditions_match_like_compiled_conditions(ingest, use_denormalized_headers, monkeypatch):
+    ingested_ids = ingest([
+        make_message('prefilter-news', [('From', 'News <news@letters.com>'), ('Subject', '50% off_today')]),
+        make_message('prefilter-boss', [('From', 'boss@work.com'), ('Subject', 'Quarterly report')]),
+        make_message('prefilter-shop', [('From', 'Shop <orders@SHOP.com>'), ('Subject', 'Order shipped')]),
+        make_message('prefilter-no-from', [('Subject', 'Path C:\\temp')]),
+    ])
+    needles = ['letters', 'shop.com', '50%', 'f_t', 'c:\\t', '%', 'report', 'nowhere']
+    rules = [
+        {'predicate': 'any', 'conditions': [
+            {'field': field, 'predicate': 'contains', 'value': needle}
+            for field in ('from', 'subject') for needle in needles
+        ]},
+        {'predicate': 'all', 'conditions': [
+            {'field': 'from', 'predicate': 'not_contains', 'value': needle} for needle in needles[:4]
+        ]},
+    ]
+    monkeypatch.setattr(EmailSearch, 'multi_pattern_threshold', 4)
+    assert EmailSearch.prefiltered_conditions(RuleSet(rules=rules, predicate='all').rules)
+    prefiltered = {predicate: search(rules, ingested_ids, predicate) for predicate in ('all', 'any')}
+
+    monkeypatch.setattr(EmailSearch, 'multi_pattern_threshold', 10 ** 9)
+    compiled = {predicate: search(rules, ingested_ids, predicate) for predicate in ('all', 'any')}
+    assert prefiltered == compiled
+    assert compiled['all'] == {'prefilter-boss', 'prefilter-no-from'}
+
+
+@pytest.mark.parametrize('multi_pattern_threshold', [4, 10 ** 9], ids=['prefiltered', 'compiled'])
+def test_rule_evaluator_matches_like_search(ingest, use_denormalized_headers, monkeypatch, multi_pattern_threshold):
+    from mailer.rules.rules_evaluator import RuleEvaluator
+    monkeypatch.setattr(EmailSearch, 'multi_pattern_threshold', multi_pattern_threshold)
+    messages = [
+        make_message('evaluate-single', [('From', 'alerts@bank.com'), ('To', 'me@home.com'), ('Subject', 'Statement')]),
+        make_message('evaluate-no-subject', [('From', 'alerts@bank.com'), ('To', 'me@home.com')], days_ago=3),
+        make_message('evaluate-no-headers', [('Date', 'Mon, 1 Jan 2024 00:00:00 +0000')]),
+        make_message('evaluate-two-subjects', [
+            ('From', 'friend@mail.com'), ('Subject', 'Lunch'), ('Subject', 'Statement ready'),
+        ]),
+        make_message('evaluate-two-senders', [
+            ('From', 'alerts@bank.com'), ('From', 'Friend <friend@mail.com>'), ('To', 'me@home.com'),
+        ], days_ago=40),
+    ]
+    ingested_ids = ingest(messages)
+    conditions = [
+        {'field': 'subject', 'predicate': 'contains', 'value': 'statement'},
+        {'field': 'subject', 'predicate': 'not_contains', 'value': 'lunch'},
+        {'field': 'subject', 'predicate': 'equal', 'value': 'statement ready'},
+        {'field': 'subject', 'predicate': 'not_equal', 'value': 'lunch'},
+        {'field': 'from', 'predicate': 'equal', 'value': 'friend <friend@mail.com>'},
+        {'field': 'from', 'predicate': 'not_equal', 'value': 'alerts@bank.com'},
+        {'field': 'from', 'predicate': 'contains', 'value': 'bank'},
+        {'field': 'from', 'predicate': 'not_contains', 'value': 'friend'},
+        {'field': 'from', 'predicate': 'not_contains', 'value': 'com\nfriend'},
+        {'field': 'from', 'predicate': 'contains', 'value': 'nowhere'},
+        {'field': 'from', 'predicate': 'contains', 'value': 'alerts'},
+        {'field': 'from', 'predicate': 'not_contains', 'value': 'mail.com'},
+        {'field': 'to', 'predicate': 'not_contains', 'value': 'home'},
+        {'field': 'date_received_days', 'predicate': 'lesser_than', 'value': 2},
+        {'field': 'date_received_months', 'predicate': 'greater_than', 'value': 1},
+    ]
+    rule_sets = [[condition] for condition in conditions] + [
+        conditions,
+        [{'predicate': 'any', 'conditions': conditions[:6]}, {'predicate': 'all', 'conditions': conditions[6:]}],
+    ]
+    assert EmailSearch.prefiltered_conditions(RuleSet(rules=conditions, predicate='all').rules) or multi_pattern_threshold > 4
+    for rules in rule_sets:
+        for predicate in ('all', 'any'):
+            evaluator = RuleEvaluator(RuleSet(rules=rules, predicate=predicate))
+            expected = set(evaluator.matching_ids(messages))
+            assert search(rules, ingested_ids, predicate) == expected, (rules, predicate)
+
+
+def test_query_key_changes_with_compiler_sources_and_migrations(monkeypatch):
+    source_hash, latest_migration = EmailSearch.query_fingerprint()
+    assert latest_migration is not None
+    key = EmailSearch.query_key()
+    assert source_hash in key and latest_migration in key
+
+    monkeypatch.setattr(EmailSearch, 'fingerprint', (source_hash, '0005_next'))
+    assert EmailSearch.query_key() != key
@@ -0,0 +1,37 @@
+import json
+
+from mailer.rules import rules_cache
+from mailer.rules.rules_cache import RulesCache, rules_digest
+from mailer.rules.rules_fetch import RulesFetch
+
+RULES = {
+    'predicate': 'all',
+    'rules': [{'predicate': 'any', 'conditions': [{'field': 'from', 'predicate': 'contains', 'value': 'news'}]}],
+    'actions': [{'attribute': 'message', 'name': 'mark', 'value': 'read'}],
+}
+
+
+def cached_rules(tmp_path, cache):
+    rules_path = tmp_path / 'rules.json'
+    rules_path.write_text(json.dumps(RULES))
+    rules_fetcher = RulesFetch.read_rules_from_file(str(rules_path), cache=cache)
+    rules_fetcher.construct_rules()
+    return rules_fetcher
+
+
+def test_digest_changes_with_rules_sources(monkeypatch):
+    digest = rules_digest(b'{}')
+    monkeypatch.setattr(rules_cache, 'sources_fingerprint', b'other version')
+    assert rules_digest(b'{}') != digest
+
+
+def test_unloadable_artifact_is_a_cache_miss(tmp_path, monkeypatch):
+    monkeypatch.setattr(RulesCache, 'compiled', {})
+    rules_fetcher = cached_rules(tmp_path, RulesCache(str(tmp_path / 'cache')))
+    artifact_path = RulesCache(str(tmp_path / 'cache')).path(rules_fetcher.digest)
+
+    monkeypatch.setattr(RulesCache, 'compiled', {})
+    with open(artifact_path, 'wb') as artifact_file:
+        # A pickle failing to load with an error other than an unpickling one
+        artifact_file.write(b"cbuiltins\nint\n(S'not a number'\ntR.")
+    assert RulesCache(str(tmp_path / 'cache')).get(rules_fetcher.digest) is None
@@ -0,0 +1,48 @@
+import datetime
+
+import pytest
+from googleapiclient.errors import HttpError
+
+from mailer.replay.replay_service import ReplayGmailService, ReplayRequest, replay_error
+from mailer.replay.synthetic_mailbox import SyntheticMailbox
+
+USER_EMAIL = 'sync-tests@example.com'
+
+
+@pytest.fixture
+def gmail_service(monkeypatch):
+    mailbox, messages = SyntheticMailbox(USER_EMAIL, 250, reply_rate=0, seed=7).generate()
+    service = ReplayGmailService(mailbox, messages)
+    list_messages = service.list_messages
+
+    # Listing fails from the second page on
+    def failing_list_messages(pageToken=None, **kwargs):
+        if pageToken:
+            def handler():
+                raise replay_error(500, 'backendError', 'Backend Error')
+            return ReplayRequest(service, handler)
+        return list_messages(**kwargs)
+    monkeypatch.setattr(service, 'list_messages', failing_list_messages)
+    return service
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_failed_page_stops_sync_without_advancing_cursor(rolled_back, gmail_service, workers):
+    from db.models import User
+    from mailer.ingestion.email_fetcher import GmailFetcher, PipelinedGmailFetcher, IngestionInterval
+    from mailer.ingestion.email_message_processor import GmailMessageProcessor
+    from mailer.ingestion.sync import sync
+
+    # Lists the messages received today, the default interval ends today
+    interval = IngestionInterval(end_date=datetime.date.today() + datetime.timedelta(days=1))
+    if workers > 1:
+        ingestion = PipelinedGmailFetcher(gmail_service, USER_EMAIL, interval, max_workers=workers)
+    else:
+        ingestion = GmailFetcher(gmail_service, USER_EMAIL, interval)
+    processor = GmailMessageProcessor()
+    processor.register_recipient(USER_EMAIL)
+
+    with pytest.raises(HttpError):
+        history_id, _ = sync(ingestion, processor, None)
+        processor.update_sync_cursor(history_id)
+    assert User.objects.get(email=USER_EMAIL).last_history_id is None